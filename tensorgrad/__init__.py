@@ -1,2 +1,2 @@
-from .tensor import Tensor, Function, Zero, Product, Sum, Variable, Copy, Ones, Derivative, make_distinct
+from .tensor import Tensor, Function, Zero, Product, Sum, Variable, Copy, Ones, Derivative, make_distinct, grad_all, jvp, hvp
 from .functions import frobenius2, einsum, kronecker, diag, sum, log, pow, trace, Unfold
@@ -0,0 +1,262 @@
+from collections import Counter
+import math
+import time
+from typing import Callable
+from sympy import Symbol, sympify
+
+from tensorgrad.functions import PowFunctionInfo
+from tensorgrad.tensor import Copy, Derivative, Function, MatchEdgesKey, Product, Sum, Tensor, Zero
+
+# An optional alternative to the greedy `full_simplify`. The normal simplify methods apply their rules
+# in a fixed order, so the final form depends on that order, and it is often not the cheapest to evaluate.
+# Here we instead collect all the equivalent forms we can reach using the existing rules (an "e-class"),
+# and extract the one with the lowest estimated evaluation cost.
+#
+# Note: Tensors are graphs rather than trees, so we don't maintain e-nodes pointing to e-classes of
+# sub-expressions like a classic e-graph would. Instead each sub-expression gets its own saturated e-class
+# (cached by its canonical form), and extraction rebuilds the parent from the cheapest children.
+# The rules below therefore only rewrite the root of a tensor, the children are handled by their e-classes.
+
+# Edge size assumed by the cost model for sizes not given in dims
+DEFAULT_SIZE = 10
+
+
+def _product(tensors: list[Tensor]) -> Tensor:
+    return tensors[0] if len(tensors) == 1 else Product(tensors)
+
+
+def associative_products(t: Tensor) -> Tensor | None:
+    """Flatten the nested products of a product."""
+    if isinstance(t, Product) and any(isinstance(u, Product) for u in t.tensors):
+        return Product.merge([u if isinstance(u, Product) else Product([u]) for u in t.tensors])
+    return None
+
+
+def associative_sums(t: Tensor) -> Tensor | None:
+    """Flatten the nested sums of a sum."""
+    if isinstance(t, Sum) and any(isinstance(u, Sum) for u in t.tensors):
+        weights, terms = [], []
+        for w, u in zip(t.weights, t.tensors):
+            ws, us = (u.weights, u.tensors) if isinstance(u, Sum) else ([1], [u])
+            weights.extend(w * w1 for w1 in ws)
+            terms.extend(us)
+        return Sum(terms, weights)
+    return None
+
+
+def merge_copies(t: Tensor) -> Tensor | None:
+    """Merge the Copy tensors of a product, and remove identity matrices."""
+    if isinstance(t, Product) and any(isinstance(u, Copy) for u in t.tensors):
+        return _product(Copy.simplify_outer(t.tensors))
+    return None
+
+
+def combine_pows(t: Tensor) -> Tensor | None:
+    """Combine and cancel the pow functions of a product."""
+    if isinstance(t, Product):
+        return _product(PowFunctionInfo.simplify_outer(t.tensors, Tensor._check_simplify()))
+    return None
+
+
+def distribute(t: Tensor) -> Tensor | None:
+    """Push a product through the first sum among its factors."""
+    for k, u in enumerate(t.tensors if isinstance(t, Product) else []):
+        if isinstance(u, Sum):
+            rest = t.tensors[:k] + t.tensors[k + 1 :]
+            return Sum([Product(rest + [v]) for v in u.tensors], u.weights)
+    return None
+
+
+def pull_out_weights(t: Tensor) -> Tensor | None:
+    """Pull the weights of single-term sums out of a product."""
+    if not isinstance(t, Product):
+        return None
+    weight, tensors = 1, []
+    for u in t.tensors:
+        if isinstance(u, Sum) and len(u.tensors) == 1:
+            weight *= u.weights[0]
+            u = u.tensors[0]
+        tensors.append(u)
+    if all(u is v for u, v in zip(tensors, t.tensors)):
+        return None
+    return Sum([_product(tensors)], [weight])
+
+
+def combine_terms(t: Tensor) -> Tensor | None:
+    """Combine the isomorphic terms of a sum, and drop the terms with weight zero."""
+    if not isinstance(t, Sum):
+        return None
+    counter = Counter()
+    for w, u in zip(t.weights, t.tensors):
+        counter[MatchEdgesKey(u)] += w
+    if len(counter) == len(t.tensors) and 0 not in counter.values():
+        return None
+    ws_terms = [(w, key.value) for key, w in counter.items() if w != 0 and not isinstance(key.value, Zero)]
+    if not ws_terms:
+        return Zero(**t.shape)
+    weights, terms = zip(*ws_terms)
+    return Sum(terms, weights)
+
+
+def function_expand(t: Tensor) -> Tensor | None:
+    """Write a fused function, like softmax, in terms of exp, sum and pow."""
+    if isinstance(t, Function) and t.fn_info.expand is not None:
+        expanded = t.fn_info.expand(*[u for u, *_ in t.inputs])
+        return expanded.rename(**{o: e for e, o in t.orig_out.items()})
+    return None
+
+
+# Each rule is a (name, rewrite) pair, where the rewrite returns None if it doesn't apply.
+# The greedy simplify is included as a rule too, both for the rewrites not listed here (like the simplify
+# methods of the functions), and so saturation always finds the greedy result.
+RULES: list[tuple[str, Callable[[Tensor], Tensor | None]]] = [
+    ("simplify", lambda t: t.simplify()),
+    ("associative_products", associative_products),
+    ("associative_sums", associative_sums),
+    ("merge_copies", merge_copies),
+    ("combine_pows", combine_pows),
+    ("distribute", distribute),
+    ("pull_out_weights", pull_out_weights),
+    ("combine_terms", combine_terms),
+    ("function_expand", function_expand),
+]
+
+
+class EClass:
+    def __init__(self, tensor: Tensor):
+        """A set of equivalent forms of a tensor, keyed by their isomorphism-aware canonical form."""
+        self.edges = tensor.edges
+        self.forms: dict[MatchEdgesKey, Tensor] = {}
+        self.add(tensor)
+
+    def add(self, tensor: Tensor) -> bool:
+        """Add a form to the e-class. Returns whether the form was new."""
+        assert tensor.edges == self.edges, f"{tensor.edges=} != {self.edges=}"
+        key = MatchEdgesKey(tensor)
+        if key in self.forms:
+            return False
+        self.forms[key] = tensor
+        return True
+
+    def __len__(self):
+        return len(self.forms)
+
+    def __iter__(self):
+        return iter(self.forms.values())
+
+
+def estimated_cost(tensor: Tensor, dims: dict[Symbol, int]) -> tuple[float, float]:
+    """Numerical (flops, peak) of the tensor. Tensors that can't be evaluated get an infinite cost."""
+    try:
+        cost = tensor.cost(dims)
+    except (ValueError, NotImplementedError):
+        return float("inf"), float("inf")
+    # Sizes not given in dims are assumed equal, like when Products choose their contraction order.
+    flops, peak = sympify(cost.flops), sympify(cost.peak)
+    guess = {s: DEFAULT_SIZE for s in flops.free_symbols | peak.free_symbols}
+    return float(flops.subs(guess)), float(peak.subs(guess))
+
+
+class Saturation:
+    def __init__(
+        self,
+        rules: list[tuple[str, Callable[[Tensor], Tensor | None]]] = None,
+        max_nodes: int = 50,
+        time_limit: float = 10.0,
+        dims: dict[Symbol, int] | None = None,
+    ):
+        """
+        Equality saturation using the existing simplification rules.
+
+        Args:
+            rules: The (name, rewrite) pairs to saturate with. Defaults to RULES.
+            max_nodes: The maximum number of forms to collect in each e-class.
+            time_limit: The total time in seconds to spend saturating before extracting.
+            dims: Optional edge sizes used by the cost model when extracting.
+        """
+        self.rules = RULES if rules is None else rules
+        self.max_nodes = max_nodes
+        self.deadline = time.monotonic() + time_limit
+        self.dims = {} if dims is None else dims
+        self.eclasses: dict[MatchEdgesKey, EClass] = {}
+        self.best: dict[MatchEdgesKey, Tensor] = {}
+
+    def saturate(self, tensor: Tensor) -> EClass:
+        """Apply the rules to every form in the e-class of tensor until no new forms are found,
+        or the budget runs out."""
+        key = MatchEdgesKey(tensor)
+        if (eclass := self.eclasses.get(key)) is not None:
+            return eclass
+        eclass = self.eclasses[key] = EClass(tensor)
+        todo = [tensor]
+        while todo and len(eclass) < self.max_nodes and time.monotonic() < self.deadline:
+            t = todo.pop()
+            for _name, rule in self.rules:
+                if len(eclass) >= self.max_nodes:
+                    break
+                try:
+                    new = rule(t)
+                except NotImplementedError:
+                    continue
+                if new is not None and eclass.add(new):
+                    todo.append(new)
+        return eclass
+
+    def extract(self, tensor: Tensor) -> Tensor:
+        """Return the cheapest tensor equivalent to the given one."""
+        key = MatchEdgesKey(tensor)
+        if (best := self.best.get(key)) is not None:
+            return best
+        candidates = []
+        for form in self.saturate(tensor):
+            candidates.append(form)
+            # Sub-expressions have their own e-classes, so the cheapest form of a parent may be
+            # built from the cheapest forms of its children.
+            if time.monotonic() < self.deadline and (rebuilt := self._rebuild(form)) is not None:
+                candidates.append(rebuilt)
+        best = min(candidates, key=lambda t: estimated_cost(t, self.dims))
+        self.best[key] = best
+        return best
+
+    def _rebuild(self, tensor: Tensor) -> Tensor | None:
+        if isinstance(tensor, Product):
+            return Product([self.extract(t) for t in tensor.tensors])
+        if isinstance(tensor, Sum):
+            return Sum([self.extract(t) for t in tensor.tensors], tensor.weights)
+        if isinstance(tensor, Function):
+            inputs = [(self.extract(t), *es) for t, *es in tensor.inputs]
+            return Function(tensor.fn_info, tensor.shape_out, *inputs, orig_out=tensor.orig_out)
+        return None
+
+
+def saturate_simplify(
+    tensor: Tensor,
+    max_nodes: int = 50,
+    time_limit: float = 10.0,
+    dims: dict[Symbol, int] | None = None,
+) -> Tensor:
+    """Simplify a tensor using equality saturation, and return the cheapest equivalent form found.
+
+    Derivatives are first pushed all the way through, since they can't be evaluated, and so have no cost.
+
+    Args:
+        tensor: The tensor to simplify.
+        max_nodes: The maximum number of equivalent forms to collect for each sub-expression.
+        time_limit: The time budget in seconds.
+        dims: Optional edge sizes for the cost model. If not given, all sizes are assumed equal.
+    """
+    greedy = tensor.full_simplify() if _has_derivative(tensor) else tensor
+    res = Saturation(max_nodes=max_nodes, time_limit=time_limit, dims=dims).extract(greedy)
+    assert res.edges == tensor.edges, f"Edges changed from {tensor.edges} to {res.edges}"
+    return res
+
+
+def _has_derivative(tensor: Tensor) -> bool:
+    if isinstance(tensor, Derivative):
+        return True
+    if isinstance(tensor, (Product, Sum)):
+        return any(_has_derivative(t) for t in tensor.tensors)
+    if isinstance(tensor, Function):
+        return any(_has_derivative(t) for t, *_ in tensor.inputs)
+    # Other tensor types without a cost model, like Expectation, need to be simplified away too
+    return type(tensor)._inner_cost is Tensor._inner_cost
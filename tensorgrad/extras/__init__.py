@@ -1 +1,2 @@
 from .expectation import Expectation
+from .scan import Scan
@@ -1,8 +1,12 @@
+from functools import cached_property
+from typing import Any, Iterable
+import sympy
 from sympy import Symbol
 import torch
 from tensorgrad.tensor import (
     Constant,
     Derivative,
+    Function,
     Product,
     Sum,
     Tensor,
@@ -10,6 +14,7 @@ from tensorgrad.tensor import (
     add_structural_graph,
     unused_edge_names,
     Copy,
+    MatchEdgesKey,
     Zero,
 )
 import tensorgrad.functions as F
@@ -24,6 +29,9 @@ class Expectation(Tensor):
         mu: None | Tensor = None,
         covar: None | Tensor = None,
         covar_names: None | dict[str, str] = None,
+        samples: int = 10_000,
+        chunk_size: int = 1_000,
+        antithetic: bool = False,
     ):
         """
         Take the Expectation of a tensor with respect to a variable, assumed to have a multi-normal
@@ -42,6 +50,11 @@ class Expectation(Tensor):
             covar (Tensor): The covariance tensor. Defaults to the identity tensor.
             covar_names (dict[str, str]): Map from original (wrt) name to covar name.
             Note: It is not a map from wrt.original name, like in the Derivative class.
+            samples (int): Expectations that can't be simplified away are evaluated by Monte-Carlo sampling,
+                using this many samples.
+            chunk_size (int): The samples are drawn in chunks of this size, which bounds the memory used
+                by the batched evaluation.
+            antithetic (bool): Pair each sample z with -z, which removes the variance of the odd terms.
         """
         self.tensor = tensor
         self._shape = tensor.shape
@@ -67,22 +80,51 @@ class Expectation(Tensor):
             assert any((k in s and v in s) for s in covar.symmetries), f"{k}, {v} should be symmetric"
         self.covar_names = covar_names
         self.covar = covar
+        self.samples = samples
+        self.chunk_size = chunk_size
+        self.antithetic = antithetic
 
         # Compute the mapping between the two sets of edge names in covar:
         # self.covar_out_edges = [e for e in covar.edges if e not in mu.edges]
 
-    def evaluate(
-        self,
-        values: dict["Variable", torch.Tensor],
-        dims: dict[Symbol, int] | None = None,
-    ) -> torch.Tensor:
-        # TODO: Could do a numerical integration here
-        # A neat approach would be if could substitute self.wrt with a tensor with an extra edge.
-        # This edge would be "number of samples" and we'd evantually take the mean over it.
-        # So we'd add a method tensor.substitute(variable_old, variable_new) which would require
-        # that variable_new's edges are a superset of variable_old's edges.
-        # It would be nice to have one more application of such a method to help inform the design.
-        raise NotImplementedError
+    def _inner_evaluate(self, values: dict[Tensor, torch.Tensor], dims: dict[Symbol, int]) -> torch.Tensor:
+        # Monte-Carlo estimate. Rather than evaluating the tensor once per sample, we replace wrt with a
+        # variable that has an extra samples edge, and evaluate the tensor for a whole chunk of samples at once.
+        orig_names = [self.wrt.orig[e] for e in self.wrt.edges]
+        edge = unused_edge_names(["samples"], self.edges | set(orig_names))["samples"]
+        size = sympy.Dummy("samples")
+        shape = {self.wrt.orig[e]: self.wrt.shape[e] for e in self.wrt.edges} | {edge: size}
+        sample_var = Variable(f"{self.wrt.name} samples", **shape)
+        batched = _add_sample_edge(self.tensor, self.wrt, sample_var, edge)
+
+        mu = self.mu.evaluate(values, dims).align_to(*self.wrt.edges).rename(None)
+        out_edges = [self.covar_names[e] for e in self.wrt.edges]
+        covar = self.covar.evaluate(values, dims).align_to(*self.wrt.edges, *out_edges).rename(None)
+        n = mu.numel()
+        L, info = torch.linalg.cholesky_ex(covar.reshape(n, n))
+        if info:
+            # The covariance is only positive semi-definite
+            eigvals, eigvecs = torch.linalg.eigh(covar.reshape(n, n))
+            L = eigvecs * eigvals.clamp(min=0).sqrt()
+
+        # Values that don't depend on the samples are computed in the first chunk, and reused by the others.
+        # This is a local copy, so the intermediate values of the chunks don't leak into the caller's values.
+        invariant = values.copy()
+        total = 0
+        for start in range(0, self.samples, self.chunk_size):
+            m = min(self.chunk_size, self.samples - start)
+            if self.antithetic:
+                # Pairs of samples mirrored around the mean cancel the odd moments of the noise
+                z = torch.randn(n, (m + 1) // 2)
+                z = torch.cat([z, -z], dim=1)[:, :m]
+            else:
+                z = torch.randn(n, m)
+            x = (mu.reshape(n, 1) + L @ z).reshape(*mu.shape, m).rename(*orig_names, edge)
+            chunk_values = invariant | {sample_var: x}
+            value = batched.evaluate(chunk_values, dims | {size: m})
+            invariant |= {t: v for t, v in chunk_values.items() if not t.depends_on(sample_var)}
+            total = total + value.sum(edge)
+        return (total / self.samples).align_to(*self.edges)
 
     def simplify(self, args=None):
         # We don't currently support Product functions directly, so we prefer to expand them.
@@ -95,13 +137,16 @@ class Expectation(Tensor):
 
         if args["grad_steps"] == 0:
             # We just steal the grad_steps name for now
-            res = Expectation(inner, self.wrt, self.mu, self.covar, self.covar_names)
+            res = Expectation(inner, self.wrt, self.mu, self.covar, self.covar_names, **self._sampling)
         else:
             args["grad_steps"] -= 1
 
         if isinstance(inner, Sum):
             return Sum(
-                [Expectation(t, self.wrt, self.mu, self.covar, self.covar_names) for t in inner.tensors],
+                [
+                    Expectation(t, self.wrt, self.mu, self.covar, self.covar_names, **self._sampling)
+                    for t in inner.tensors
+                ],
                 inner.weights,
             )
 
@@ -115,6 +160,10 @@ class Expectation(Tensor):
 
         if isinstance(inner, Product):
             prod = inner
+            # If wrt only occurs directly in the product, we can use Isserlis' theorem
+            if all(t == self.wrt for t in prod.tensors if t.depends_on(self.wrt)):
+                return self._isserlis(prod).simplify(args=args)
+
             # Right now we only support expectations of products where wrt is directly in the product.
             if self.wrt in prod.tensors:
                 # 1) Look for an instance of wrt in the product
@@ -132,7 +181,9 @@ class Expectation(Tensor):
                 rest = Product(subs)
 
                 # 3) Expand: x * rest = (x - mu + mu) * rest = mu * rest + (x - mu) * rest
-                res = mu @ Expectation(rest, self.wrt, self.mu, self.covar, self.covar_names)
+                res = mu @ Expectation(
+                    rest, self.wrt, self.mu, self.covar, self.covar_names, **self._sampling
+                )
                 assert res.edges == self.edges, f"{res.edges=} != {self.edges=}"
 
                 # Before we can rename covar with iso_rename, we have to make sure it there's
@@ -158,26 +209,90 @@ class Expectation(Tensor):
                     self.mu,
                     self.covar,
                     self.covar_names,
+                    **self._sampling,
                 )
                 assert res.edges == self.edges, f"{res.edges=} != {self.edges=}"
                 return res.simplify(args=args)
 
         # If nothing was found that we know how to simplify, we just return the original
-        return Expectation(inner, self.wrt, self.mu, self.covar, self.covar_names)
+        return Expectation(inner, self.wrt, self.mu, self.covar, self.covar_names, **self._sampling)
+
+    def _isserlis(self, prod: Product) -> Tensor:
+        """The expectation of a product where wrt only occurs as factors of the product.
+
+        By Isserlis' (or Wick's) theorem, the expectation is a sum over the ways of pairing up the occurrences
+        of wrt, where each pair is replaced by the covariance, and each unpaired occurrence by the mean.
+        Pairings often give isomorphic terms, so we combine those as we go, rather than expanding the
+        pairings one factor at a time like Stein's lemma in simplify.
+        """
+        xs = [t for t in prod.tensors if t.depends_on(self.wrt)]
+        rest = [t for t in prod.tensors if not t.depends_on(self.wrt)]
+        # The map from the edges of wrt to the edges of each occurrence
+        renames = [next(self.wrt.isomorphisms(x)) for x in xs]
+        used = {e for t in prod.tensors for e in t.edges} | set(self.covar_names.values())
+
+        def pair(a: dict[str, str], b: dict[str, str]) -> Tensor:
+            # The covariance between the occurrences with edge maps a and b. If the two occurrences are
+            # contracted with each other, we give b fresh names and join them with identities.
+            clash = {e for e in self.wrt.edges if b[e] in a.values()}
+            fresh = unused_edge_names([b[e] for e in clash], used)
+            used.update(fresh.values())
+            covar = self.covar.rename(**{self.covar_names[e]: fresh.get(b[e], b[e]) for e in self.wrt.edges} | a)
+            joins = [Copy(self.wrt.shape[e], b[e], fresh[b[e]]) for e in clash]
+            return Product([covar] + joins) if joins else covar
+
+        def pairings(todo: list[int]) -> Iterable[list[Tensor]]:
+            if not todo:
+                yield []
+                return
+            first, *others = todo
+            if not isinstance(self.mu, Zero):
+                for factors in pairings(others):
+                    yield [self.mu.rename(**renames[first])] + factors
+            for k, second in enumerate(others):
+                covar = pair(renames[first], renames[second])
+                for factors in pairings(others[:k] + others[k + 1 :]):
+                    yield [covar] + factors
+
+        terms = {}
+        for factors in pairings(list(range(len(xs)))):
+            term = Product(rest + factors)
+            assert term.edges == prod.edges, f"{term.edges=} != {prod.edges=}"
+            key = MatchEdgesKey(term)
+            if key in terms:
+                terms[key][1] += 1
+            else:
+                terms[key] = [term, 1]
+        if not terms:
+            return Zero(**prod.shape)
+        return Sum(*zip(*terms.values()))
 
     def grad(self, x: Variable, new_names: dict[str, str] | None = None) -> Tensor:
         new_names = self._check_grad(x, new_names)
         # TODO: There's some issue here if x == self.wrt
-        res = Expectation(Derivative(self.tensor, x, new_names), self.wrt, self.covar, self.covar_names)
+        res = Expectation(
+            Derivative(self.tensor, x, new_names),
+            self.wrt,
+            mu=self.mu,
+            covar=self.covar,
+            covar_names=self.covar_names,
+            **self._sampling,
+        )
         assert res.shape == self.shape | {new_names[k]: s for k, s in x.shape.items()}
         return res
 
+    @property
+    def _sampling(self) -> dict[str, Any]:
+        """The Monte-Carlo options, passed on to the expectations made from this one."""
+        return {"samples": self.samples, "chunk_size": self.chunk_size, "antithetic": self.antithetic}
+
     def __repr__(self):
         return f"E[{self.tensor}]"
 
     def structural_graph(self) -> tuple[nx.MultiDiGraph, dict[str, int]]:
         G = nx.MultiDiGraph()
-        G.add_node(0, name=type(self).__name__, tensor=self)
+        # Expectations sampled differently don't share cached values. The chunk size only affects memory.
+        G.add_node(0, name=(type(self).__name__, self.samples, self.antithetic), tensor=self)
         G, t_edges = add_structural_graph(G, self.tensor, root_edge_label="self.tensor")
         G, _ = add_structural_graph(G, self.wrt, root_edge_label="self.wrt")
         G, _ = add_structural_graph(G, self.mu, root_edge_label="self.mu")
@@ -188,9 +303,56 @@ class Expectation(Tensor):
     def rename(self, **kwargs: dict[str, str]):
         kwargs = self._check_rename(kwargs)
         # The variables, wrt, mu, covar shouldn't influence our free edge names
-        res = Expectation(self.tensor.rename(**kwargs), self.wrt, self.mu, self.covar, self.covar_names)
+        res = Expectation(
+            self.tensor.rename(**kwargs), self.wrt, self.mu, self.covar, self.covar_names, **self._sampling
+        )
         assert res.edges == {kwargs.get(e, e) for e in self.edges}
         return res
 
-    def depends_on(self, x: "Variable") -> bool:
-        return self.tensor.depends_on(x)
+    @cached_property
+    def dependencies(self) -> frozenset[tuple]:
+        return self.tensor.dependencies | self.mu.dependencies | self.covar.dependencies
+
+    def _inner_substitute(self, replacements: dict[tuple, Tensor], memo: dict[int, Tensor]) -> Tensor:
+        if self.wrt.key in replacements:
+            raise ValueError(f"Can't substitute {self.wrt}, since the expectation is taken over it")
+        return Expectation(
+            self.tensor._substitute(replacements, memo),
+            self.wrt,
+            self.mu._substitute(replacements, memo),
+            self.covar._substitute(replacements, memo),
+            self.covar_names,
+            **self._sampling,
+        )
+
+
+def _add_sample_edge(t: Tensor, wrt: Variable, samples: Variable, edge: str) -> Tensor:
+    """Replace wrt in t by the samples variable, which has the edges of wrt plus the samples edge.
+    The result has the edges of t plus the samples edge, if t depends on wrt."""
+    if not t.depends_on(wrt):
+        return t
+    if isinstance(t, Variable):
+        return samples.rename(**{o: e for e, o in t.orig.items()})
+    if isinstance(t, Product):
+        # Every factor depending on wrt gets its own samples edge, and they are joined by a Copy tensor
+        used = {e for u in t.tensors for e in u.edges} | {edge}
+        factors, names = [], []
+        for u in t.tensors:
+            if u.depends_on(wrt):
+                name = unused_edge_names([edge], used)[edge]
+                used.add(name)
+                names.append(name)
+                u = _add_sample_edge(u, wrt, samples, edge).rename(**{edge: name})
+            factors.append(u)
+        return Product(factors + [Copy(samples.shape[edge], *names, edge)])
+    if isinstance(t, Sum):
+        return Sum([_add_sample_edge(u, wrt, samples, edge) for u in t.tensors], t.weights)
+    if isinstance(t, Function):
+        if sum(u.depends_on(wrt) for u, *_ in t.inputs) > 1:
+            raise NotImplementedError("Can't sample functions with several inputs depending on the variable")
+        inputs = [(_add_sample_edge(u, wrt, samples, edge), *es) for u, *es in t.inputs]
+        return Function(t.fn_info, t.shape_out, *inputs, orig_out=t.orig_out)
+    if isinstance(t, Expectation) and not (t.mu.depends_on(wrt) or t.covar.depends_on(wrt)):
+        inner = _add_sample_edge(t.tensor, wrt, samples, edge)
+        return Expectation(inner, t.wrt, t.mu, t.covar, t.covar_names, **t._sampling)
+    raise NotImplementedError(f"Can't sample expectations of {type(t).__name__}, try simplifying first")
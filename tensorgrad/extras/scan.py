@@ -0,0 +1,262 @@
+from functools import cached_property
+from typing import Any, Optional
+import networkx as nx
+import sympy
+from sympy import Symbol
+import torch
+from tensorgrad.tensor import (
+    Cost,
+    Derivative,
+    Product,
+    Sum,
+    Tensor,
+    Variable,
+    Zero,
+    _simplify_all,
+    _sum_exprs,
+    add_structural_graph,
+    unused_edge_names,
+)
+
+
+class Scan(Tensor):
+    def __init__(
+        self,
+        carries: list[tuple[Variable, Tensor, Tensor]],
+        inputs: list[tuple[Variable, Tensor]],
+        seq: str,
+        output: int = 0,
+        orig_out: Optional[dict[str, str]] = None,
+    ):
+        """
+        A loop over the sequence edge of the inputs, updating a number of carries at each step.
+        The value of the tensor is the final value of one of the carries.
+
+        For example, an RNN is Scan([(h, tanh(W_hh @ h + W_ih @ x), h0)], [(x, xs)], "seq"),
+        where xs is the input sequence, with the edges of x plus "seq".
+
+        Unlike unrolling the loop, the expression (and its derivatives) don't grow with the sequence length.
+
+        Args:
+            carries: A list of (h, step, init) triples. h is the variable holding the carry inside the step
+                expressions, step computes the next value of h from the carries and inputs, and init is the
+                initial value. step and init must have the same shape as h.
+            inputs: A list of (x, xs) pairs. x is the variable holding the current element of the sequence xs,
+                which must have the edges of x plus seq.
+            seq: The sequence edge of the inputs. It is consumed by the loop.
+            output: The index of the carry whose final value is returned.
+            orig_out: Map from the (possibly renamed) output edges to the edges of the output carry.
+        """
+        if not inputs:
+            raise ValueError("Scan needs at least one input, to define the length of the sequence")
+        for h, step, init in carries:
+            if step.shape != h.shape or init.shape != h.shape:
+                raise ValueError(f"The step and init must have the shape of the carry, {h.shape=}")
+        lengths = set()
+        for x, xs in inputs:
+            if seq in x.edges or xs.shape != x.shape | {seq: xs.shape.get(seq)}:
+                raise ValueError(f"The sequence must have the edges of x plus {seq}, got {xs.shape=}")
+            lengths.add(xs.shape[seq])
+        if len(lengths) != 1:
+            raise ValueError(f"All sequences must have the same length, got {lengths}")
+        self.carries = list(carries)
+        self.inputs = list(inputs)
+        self.seq = seq
+        self.output = output
+        h_out = self.carries[output][0]
+        self.orig_out = {e: e for e in h_out.edges} if orig_out is None else orig_out
+        assert set(self.orig_out.values()) == h_out.edges, f"{self.orig_out=} {h_out.edges=}"
+        self._shape = {e: h_out.shape[o] for e, o in self.orig_out.items()}
+
+    @property
+    def loop_variables(self) -> list[Variable]:
+        return [h for h, _, _ in self.carries] + [x for x, _ in self.inputs]
+
+    def rename(self, **kwargs: dict[str, str]):
+        kwargs = self._check_rename(kwargs)
+        # Only the output edges are free, the steps are closed expressions in the carries and inputs
+        orig_out = {kwargs.get(e, e): o for e, o in self.orig_out.items()}
+        res = Scan(self.carries, self.inputs, self.seq, self.output, orig_out)
+        assert set(res.edges) == {kwargs.get(e, e) for e in self.edges}
+        return res
+
+    def simplify(self, args: dict[str, Any] = None):
+        args = self._check_simplify(args)
+        tensors = [t for _, step, init in self.carries for t in (step, init)] + [xs for _, xs in self.inputs]
+        simplified = iter(_simplify_all(tensors, args))
+        carries = [(h, next(simplified), next(simplified)) for h, _, _ in self.carries]
+        inputs = [(x, next(simplified)) for x, _ in self.inputs]
+        return Scan(carries, inputs, self.seq, self.output, self.orig_out)
+
+    def grad(self, x: Variable, new_names: Optional[dict[str, str]] = None) -> Tensor:
+        new_names = self._check_grad(x, new_names)
+        if not self.depends_on(x):
+            return Zero(**(self.shape | {new_names[o]: x.shape[e] for e, o in x.orig.items()}))
+
+        # Forward mode: For each carry h we add a tangent carry J = dh/dx, with the edges of h plus the new
+        # edges of x, and updated by the chain rule
+        #     J' = sum_m d step / d h_m J_m + sum_i d step / d x_i dx_i + d step / d x
+        # where dx_i is the derivative of the i-th input element. The derivatives of the step treat the carries
+        # and inputs as independent variables, so they are just ordinary derivatives of the step expression.
+        used = {key[0] for key in self.dependencies} | {v.name for v in self.loop_variables}
+
+        def fresh_variable(name: str, shape: dict[str, Symbol]) -> Variable:
+            while name in used:
+                name += "'"
+            used.add(name)
+            return Variable(name, **shape)
+
+        def tangent_names(edges: set[str]) -> dict[str, str]:
+            # The new edges of x in a tangent, named after the original edges of x, avoiding the given edges.
+            return unused_edge_names([x.orig[e] for e in x.edges], edges, suffix="_")
+
+        tangents = []
+        for h, _, _ in self.carries:
+            names = tangent_names(h.edges)
+            shape = h.shape | {names[o]: x.shape[e] for e, o in x.orig.items()}
+            tangents.append((fresh_variable(f"d{h.name}/d{x.name}", shape), names))
+        input_tangents = []
+        for xi, xs in self.inputs:
+            if not xs.depends_on(x):
+                continue
+            names = tangent_names(xs.edges)
+            dxs = Derivative(xs, x, names)
+            shape = xi.shape | {names[o]: x.shape[e] for e, o in x.orig.items()}
+            input_tangents.append((xi, fresh_variable(f"d{xi.name}/d{x.name}", shape), names, dxs))
+
+        def contract(step: Tensor, v: Variable, tangent: Variable, v_names: dict[str, str], names: dict[str, str]):
+            # d step / d v, with the edges of v contracted with the tangent of v. The new edges of the tangent
+            # are renamed to the names used by the tangent of this step.
+            inner = unused_edge_names([v.orig[e] for e in v.edges], step.edges | set(names.values()), suffix="_")
+            d = Derivative(step, v, inner)
+            rename = {e: inner[v.orig[e]] for e in v.edges} | {v_names[o]: names[o] for o in names}
+            return Product([d, tangent.rename(**rename)])
+
+        new_carries = list(self.carries)
+        for (h, step, init), (J, names) in zip(self.carries, tangents):
+            terms = [
+                contract(step, h_m, J_m, names_m, names)
+                for (h_m, _, _), (J_m, names_m) in zip(self.carries, tangents)
+                if step.depends_on(h_m)
+            ]
+            terms += [
+                contract(step, xi, dxi, names_i, names)
+                for xi, dxi, names_i, _ in input_tangents
+                if step.depends_on(xi)
+            ]
+            if step.depends_on(x):
+                terms.append(Derivative(step, x, names))
+            step_tangent = Sum(terms) if terms else Zero(**J.shape)
+            init_tangent = Derivative(init, x, names) if init.depends_on(x) else Zero(**J.shape)
+            new_carries.append((J, step_tangent, init_tangent))
+        new_inputs = self.inputs + [(dxi, dxs) for _, dxi, _, dxs in input_tangents]
+
+        J_out, names_out = tangents[self.output]
+        orig_out = self.orig_out | {new_names[o]: names_out[o] for o in new_names}
+        res = Scan(new_carries, new_inputs, self.seq, len(self.carries) + self.output, orig_out)
+        assert res.edges == self.edges | set(new_names.values()), f"{res.edges=} {self.edges=} {new_names=}"
+        return res
+
+    def __repr__(self):
+        carries = ", ".join(f"({h}, {step}, {init})" for h, step, init in self.carries)
+        inputs = ", ".join(f"({x}, {xs})" for x, xs in self.inputs)
+        args = [f"[{carries}]", f"[{inputs}]", f'"{self.seq}"', f"output={self.output}"]
+        if any(e != o for e, o in self.orig_out.items()):
+            args.append(f"orig_out={self.orig_out}")
+        return f"Scan({', '.join(args)})"
+
+    def structural_graph(self) -> tuple[nx.MultiDiGraph, dict[str, int]]:
+        G = nx.MultiDiGraph()
+        G.add_node(0, name=(type(self).__name__, self.output), tensor=self)
+        # The sequence edges of all the inputs are joined in one node
+        seq_node = G.number_of_nodes()
+        G.add_node(seq_node, name="Sequence")
+        G.add_edge(0, seq_node)
+        h_edges = []
+        for k, (h, step, init) in enumerate(self.carries):
+            G, hs = add_structural_graph(G, h, root_edge_label=f"carry {k}")
+            G, steps = add_structural_graph(G, step, root_edge_label=f"step {k}")
+            G, inits = add_structural_graph(G, init, root_edge_label=f"init {k}")
+            # The edges of the step and init are the edges of the carry
+            for e, node in hs.items():
+                G.add_edge(steps[e], node)
+                G.add_edge(inits[e], node)
+            h_edges.append(hs)
+        for k, (x, xs) in enumerate(self.inputs):
+            G, x_nodes = add_structural_graph(G, x, root_edge_label=f"input {k}")
+            G, xs_nodes = add_structural_graph(G, xs, root_edge_label=f"sequence {k}")
+            for e, node in x_nodes.items():
+                G.add_edge(xs_nodes[e], node)
+            G.add_edge(xs_nodes[self.seq], seq_node)
+        edges = {}
+        for e, o in self.orig_out.items():
+            node = G.number_of_nodes()
+            G.add_node(node, name="Output Edge")
+            G.add_edge(h_edges[self.output][o], node)
+            edges[e] = node
+        return G, edges
+
+    @cached_property
+    def dependencies(self) -> frozenset[tuple]:
+        deps = frozenset().union(
+            *(step.dependencies | init.dependencies for _, step, init in self.carries),
+            *(xs.dependencies for _, xs in self.inputs),
+        )
+        # The carries and inputs are bound by the loop
+        return deps - {v.key for v in self.loop_variables}
+
+    def _inner_substitute(self, replacements: dict[tuple, Tensor], memo: dict[int, Tensor]) -> Tensor:
+        # The carries and inputs are bound by the loop, so they are never replaced inside the steps
+        loop_keys = {v.key for v in self.loop_variables}
+        inner = {k: t for k, t in replacements.items() if k not in loop_keys}
+        inner_memo = memo if len(inner) == len(replacements) else {}
+        carries = [
+            (h, step._substitute(inner, inner_memo), init._substitute(replacements, memo))
+            for h, step, init in self.carries
+        ]
+        inputs = [(x, xs._substitute(replacements, memo)) for x, xs in self.inputs]
+        return Scan(carries, inputs, self.seq, self.output, self.orig_out)
+
+    def _inner_evaluate(self, values: dict[Tensor, torch.Tensor], dims: dict[Symbol, int]) -> torch.Tensor:
+        carries = [self._carry_value(h, init.evaluate(values, dims)) for h, _, init in self.carries]
+        sequences = []
+        for x, xs in self.inputs:
+            value = xs.evaluate(values, dims)
+            # Move the sequence edge first, and use the original names of x for the rest
+            value = value.align_to(self.seq, *x.edges).rename(None)
+            sequences.append((x, value, tuple(x.orig[e] for e in x.edges)))
+        # Values that don't depend on the carries or inputs are the same in every step, so we only
+        # evaluate them once.
+        loop_keys = {v.key for v in self.loop_variables}
+        invariant = {t: v for t, v in values.items() if not t.dependencies & loop_keys}
+        length = sequences[0][1].shape[0]
+        for i in range(length):
+            step_values = invariant.copy()
+            for (h, _, _), carry in zip(self.carries, carries):
+                step_values[h] = carry
+            for x, value, names in sequences:
+                step_values[x] = value[i].rename(*names)
+            carries = [self._carry_value(h, step.evaluate(step_values, dims)) for h, step, _ in self.carries]
+            invariant |= {t: v for t, v in step_values.items() if not t.dependencies & loop_keys}
+        h_out = self.carries[self.output][0]
+        # The carries use the original names of the variables
+        to_out = {h_out.orig[o]: e for e, o in self.orig_out.items()}
+        out = carries[self.output]
+        return out.rename(*(to_out[n] for n in out.names)).align_to(*self.edges)
+
+    @staticmethod
+    def _carry_value(h: Variable, value: torch.Tensor) -> torch.Tensor:
+        """Rename the value of the edges of h to the original names of h, like the values of a Variable."""
+        return value.align_to(*h.edges).rename(*(h.orig[e] for e in h.edges))
+
+    def _inner_cost(self, dims: dict[Symbol, int]) -> Cost:
+        length = self.inputs[0][1].shape[self.seq]
+        length = dims.get(length, length)
+        steps = [step._inner_cost(dims) for _, step, _ in self.carries]
+        others = [init._inner_cost(dims) for _, _, init in self.carries] + [
+            xs._inner_cost(dims) for _, xs in self.inputs
+        ]
+        flops = length * _sum_exprs(c.flops for c in steps) + _sum_exprs(c.flops for c in others)
+        peak = sympy.Max(*(c.peak for c in steps + others))
+        size = steps[self.output].size
+        return Cost(flops, peak, size)
@@ -1,8 +1,9 @@
 from collections import defaultdict
 import itertools
 import math
+import numbers
 import re
-from typing import Any
+from typing import Any, Iterable
 from sympy import Symbol
 import torch
 from tensorgrad.tensor import (
@@ -21,6 +22,7 @@ from tensorgrad.tensor import (
 )
 from fractions import Fraction
 
+from tensorgrad import profiling
 from tensorgrad.utils import DisjointSets
 
 # We include a "sum" function, which overloads the python sum. So we keep a reference
@@ -37,16 +39,101 @@ _sum = sum
 
 
 def taylor(f: Tensor, wrt: Variable, eps: Tensor, n: int) -> Tensor:
-    """Return the nth order Taylor approximation of f at x+eps."""
+    """Return the nth order Taylor approximation of f at x+eps.
+
+    The k-th term is D^k f[eps, ..., eps] / k!. Since eps doesn't depend on x, that's the derivative of the
+    (k-1)-th directional derivative in the direction eps, so we compute the orders one from the other, contracting
+    eps as soon as it appears. The new edges of the derivatives are never more than those of a single grad.
+    """
     if eps.edges != wrt.edges:
         raise ValueError("eps must have the same edges as wrt.")
-    total = f
-    for i in range(1, n + 1):
-        # TODO: If the wrt edges are not available, this will throw an error.
-        # We should rename wrt and eps to be distinct from the edges of f.
-        fg = f.grad(wrt, new_names={e: e for e in wrt.edges})
-        total += fg @ eps / math.factorial(i)
-    return total
+    if eps.depends_on(wrt):
+        raise ValueError("eps can't depend on wrt.")
+    weights, terms = [1], [f]
+    term = f.full_simplify()
+    for k in range(1, n + 1):
+        # The new edges of wrt avoid the edges of f, so eps is renamed to match them
+        names = term._check_grad(wrt, None)
+        term = (term.grad(wrt, names) @ eps.rename(**{e: names[wrt.orig[e]] for e in wrt.edges})).full_simplify()
+        weights.append(Fraction(1, math.factorial(k)))
+        terms.append(term)
+    return Sum(terms, weights)
+
+
+def grad(t: Tensor, x: Variable, order: int = 1, new_names: list[dict[str, str]] | None = None) -> Tensor:
+    """The order-th derivative of t with respect to x, fully simplified.
+
+    Nested derivatives are symmetric in the groups of new edges they create, so the terms of t.grad(x).grad(x)
+    come in classes that are equal up to permuting the groups. We keep just one representative of each class,
+    with the size of the class as its weight, and only expand the classes again at the end.
+
+    Args:
+        t: The tensor to differentiate.
+        x: The variable to take the derivatives with respect to.
+        order: The number of derivatives to take.
+        new_names: Optional list of new_names (like in Tensor.grad), one for each derivative.
+    """
+    if new_names is not None and len(new_names) != order:
+        raise ValueError(f"Expected {order} new_names, got {len(new_names)}")
+    groups = []
+    # D^j t = Sym_j(res), where Sym_j averages over the permutations of the j groups of new edges.
+    res = t.full_simplify()
+    for j in range(order):
+        names = res._check_grad(x, None if new_names is None else new_names[j])
+        groups.append([names[o] for o in x.orig.values()])
+        res = _combine_permuted_terms(res.grad(x, names).full_simplify(), groups)
+    if order <= 1:
+        return res
+    # Sym(res) = sum_c w_c / |orbit_c| sum_{s in orbit_c} s
+    weights, tensors = [], []
+    for w, rep in zip(*_terms(res)):
+        orbit = {MatchEdgesKey(u): u for u in _permute_groups(rep, groups)}.values()
+        # Keep the weights exact, like the weights created by the rest of the library
+        weight = Fraction(w, len(orbit)) if isinstance(w, numbers.Rational) else w / len(orbit)
+        if isinstance(weight, Fraction) and weight.denominator == 1:
+            weight = int(weight)
+        weights.extend([weight] * len(orbit))
+        tensors.extend(orbit)
+    return Sum(tensors, weights) if tensors else res
+
+
+def _terms(t: Tensor) -> tuple[list[Any], list[Tensor]]:
+    if isinstance(t, Zero):
+        return [], []
+    if isinstance(t, Sum):
+        return t.weights, t.tensors
+    return [1], [t]
+
+
+def _permute_groups(t: Tensor, groups: list[list[str]]) -> Iterable[Tensor]:
+    """All the renamings of t that permute the groups of edges."""
+    for perm in itertools.permutations(groups):
+        yield t.rename(**{e: f for g, h in zip(groups, perm) for e, f in zip(g, h)})
+
+
+def _combine_permuted_terms(t: Tensor, groups: list[list[str]]) -> Tensor:
+    """Combine the terms of t that are equal up to permuting the groups of edges.
+    The result is only equal to t after symmetrizing over the groups."""
+    if len(groups) <= 1:
+        return t
+    # Terms that are equal after forgetting which group each edge belongs to are candidates for combining.
+    # The labels keep the position of the edge within its group, so we only need to check group permutations.
+    labels = {e: ("Derivative Edge", i) for g in groups for i, e in enumerate(g)}
+    classes: dict[MatchEdgesKey, list[list]] = defaultdict(list)
+    for w, u in zip(*_terms(t)):
+        candidates = classes[MatchEdgesKey(u, **labels)]
+        permuted = [MatchEdgesKey(v) for v in _permute_groups(u, groups)] if candidates else []
+        for entry in candidates:
+            if any(entry[2] == key for key in permuted):
+                entry[0] += w
+                break
+        else:
+            candidates.append([w, u, MatchEdgesKey(u)])
+    ws_terms = [(w, u) for entries in classes.values() for w, u, _ in entries if w != 0]
+    if not ws_terms:
+        return Zero(**t.shape)
+    weights, terms = zip(*ws_terms)
+    return Sum(terms, weights)
 
 
 def frobenius2(t: Tensor) -> Tensor:
@@ -54,12 +141,51 @@ def frobenius2(t: Tensor) -> Tensor:
 
 
 def symmetrize(t: Tensor) -> Tensor:
-    """Sum over all permutations of the edges."""
+    """Sum over all permutations of the edges.
+
+    Permutations that differ by an automorphism of t give the same term, so we only include one permutation
+    from each coset of the automorphism group, weighted by the size of the group.
+    """
+    edges = list(t.edges)
+    if len(edges) <= 1:
+        return t
+    size, renames = _symmetric_cosets(t)
+    return Sum([t.rename(**rename) for rename in renames], [size] * len(renames))
+
+
+def _symmetric_cosets(t: Tensor) -> tuple[int, list[dict[str, str]]]:
+    """The size of the automorphism group of t, and a renaming of the edges for each of its cosets
+    in the group of all permutations of the edges."""
     edges = list(t.edges)
-    res = 0
+    orbits = [sorted(orbit) for orbit in t.symmetries]
+    # The automorphisms always permute the orbits, so the group is at most the product of the symmetric
+    # groups of the orbits. If t is invariant under swapping neighbours in each orbit, it's all of it.
+    key = MatchEdgesKey(t)
+    if all(MatchEdgesKey(t.rename(**{a: b, b: a})) == key for orbit in orbits for a, b in zip(orbit, orbit[1:])):
+        # Each coset is given by which edges the orbits are mapped to, so we map every orbit to a
+        # subset of the edges in sorted order.
+        def assignments(orbits: list[list[str]], free: list[str]) -> Iterable[dict[str, str]]:
+            if not orbits:
+                yield {}
+                return
+            (orbit, *rest) = orbits
+            for targets in itertools.combinations(free, len(orbit)):
+                remaining = [e for e in free if e not in targets]
+                for rename in assignments(rest, remaining):
+                    yield dict(zip(orbit, targets)) | rename
+
+        return math.prod(math.factorial(len(orbit)) for orbit in orbits), list(assignments(orbits, edges))
+    # Otherwise, e.g. for cyclic symmetries, we find the group explicitly and skip the permutations
+    # in the cosets we have already seen.
+    group = [tuple(mapping[e] for e in edges) for mapping in t.isomorphisms(t)]
+    index = {e: i for i, e in enumerate(edges)}
+    seen, renames = set(), []
     for perm in itertools.permutations(edges):
-        res += t.rename(**dict(zip(edges, perm)))
-    return res
+        if perm in seen:
+            continue
+        seen.update(tuple(perm[index[e]] for e in g) for g in group)
+        renames.append(dict(zip(edges, perm)))
+    return len(group), renames
 
 
 def einsum(tensors, output_edges):
@@ -314,16 +440,19 @@ def dot(t1: Tensor, t2: Tensor, dims: list[str]) -> Tensor:
     return sum(t1 * t2, dims)
 
 
+class LogFunctionInfo(FunctionInfo):
+    def __init__(self):
+        super().__init__("log", eval=self.eval, derivative=self.derivative, elementwise=True)
+
+    def eval(self, x):
+        return torch.log(x)
+
+    def derivative(self, i: int, new_edges: dict[str, Symbol], t: Tensor):
+        return pow(t, -1)
+
+
 def log(t: Tensor) -> Tensor:
-    return Function(
-        FunctionInfo(
-            "log",
-            eval=lambda x: torch.log(x),
-            derivative=lambda _i, _new_edges, t: pow(t, -1),
-        ),
-        [],
-        (t,),
-    )
+    return Function(LogFunctionInfo(), [], (t,))
 
 
 def tanh(t: Tensor) -> Tensor:
@@ -334,7 +463,9 @@ def tanh(t: Tensor) -> Tensor:
 
 class PowFunctionInfo(FunctionInfo):
     def __init__(self, k: int):
-        super().__init__(f"pow({k})", eval=self.eval, derivative=self.derivative, simplify=self.simplify)
+        super().__init__(
+            f"pow({k})", eval=self.eval, derivative=self.derivative, simplify=self.simplify, elementwise=True
+        )
         self.k = k
 
     def eval(self, x):
@@ -403,11 +534,13 @@ class PowFunctionInfo(FunctionInfo):
         #  - Finally we could try to recreate some pow functions from the remaining subgraphs,
         #    but it's not clear that this is actually useful.
 
-        tensors = cls._combine_powers(tensors)
+        with profiling.timed("PowFunctionInfo._combine_powers"):
+            tensors = cls._combine_powers(tensors)
         assert Product(tensors).edges == original_edges
 
         if args["factor_components"]:
-            tensors = cls._combine_components(tensors)
+            with profiling.timed("PowFunctionInfo._combine_components"):
+                tensors = cls._combine_components(tensors)
             assert Product(tensors).edges == original_edges
 
         # We have to merge products here because we might otherwise have undone part of the simplification
@@ -418,65 +551,67 @@ class PowFunctionInfo(FunctionInfo):
 
     @classmethod
     def _combine_powers(cls, tensors: list[Tensor]) -> list[Tensor]:
+        # We index the product once, and only rebuild the index when a combination actually happens.
+        # Tensors that are not combined are kept as the same objects, so their cached hashes are reused.
+        index = _ProductIndex(tensors)
         seen = set()
-        # for _ in range(3):
         while True:
-            # Find the next power function we haven't seen yet
-            try:
-                i, t = next(
-                    (i, t)
-                    for i, t in enumerate(tensors)
-                    if isinstance(t, Function) and isinstance(t.fn_info, PowFunctionInfo) and t not in seen
-                )
-            except StopIteration:
+            # Find the next power function we haven't seen yet. We use ids rather than equality,
+            # since equality is an isomorphism test.
+            i = next((i for i in index.pows if id(index.tensors[i]) not in seen), None)
+            if i is None:
                 break
-            seen.add(t)
+            t = index.tensors[i]
+            seen.add(id(t))
 
-            power_weight = t.fn_info.k
             ((inner, *_es),) = t.inputs
 
-            hyperedges = {
-                e: min(c.edges)
-                for c in tensors
-                if isinstance(c, Copy) and c.edges & inner.edges
-                for e in c.edges
-            }
-            partition = defaultdict(list)
+            # We remove the tensor, as well as all Copy's that it's connected to,
+            # which makes the rest of the graph fall apart.
+            copy_ids = index.adjacent_copies(inner.edges)
+            hyperedges = {e: min(index.tensors[j].edges) for j in copy_ids for e in index.tensors[j].edges}
 
             # We can't just call t.rename(**hyperedges) here, since some tensors might be adjacent to the
             # same hyperedge multiple times. Instead we give MatchEdgesKey the names, and it will perform
             # the isomorphism check correctly.
-            partition[MatchEdgesKey(inner, **hyperedges)].append((power_weight, inner))
-
-            # We remove the tensor, as well as all Copy's that it's connected to,
-            # which makes the rest of the graph fall apart.
-            others = tensors[:i] + tensors[i + 1 :]
-            copys = [t for t in others if isinstance(t, Copy) and t.edges & inner.edges]
-            others = [t for t in others if not (isinstance(t, Copy) and t.edges & inner.edges)]
-            for comp in Product(others).components():
-                power_weight = 1
+            # Each entry is (power_weight, base, original), where original is the tensor to keep if
+            # nothing gets combined.
+            partition = defaultdict(list)
+            partition[MatchEdgesKey(inner, **hyperedges)].append((t.fn_info.k, inner, t))
+            for comp in index.components(exclude={i} | copy_ids):
+                power_weight, base = 1, comp
                 if len(comp.tensors) == 1:
-                    comp = comp.tensors[0]
-                    if isinstance(comp, Function) and isinstance(comp.fn_info, PowFunctionInfo):
-                        power_weight = comp.fn_info.k
-                        ((comp, *_es),) = comp.inputs
-                partition[MatchEdgesKey(comp, **hyperedges)].append((power_weight, comp))
+                    base = comp.tensors[0]
+                    if isinstance(base, Function) and isinstance(base.fn_info, PowFunctionInfo):
+                        power_weight = base.fn_info.k
+                        ((base, *_es),) = base.inputs
+                partition[MatchEdgesKey(base, **hyperedges)].append((power_weight, base, comp))
 
             # Now we have a partition of tensors that share the same edges, and we can combine them.
             # Or in some cases they cancel each other.
-            tensors = copys
+            if all(len(ts) == 1 for ts in partition.values()):
+                continue
+            new_tensors = [index.tensors[j] for j in copy_ids]
             for ts in partition.values():
-                w = _sum(w for w, t in ts)
+                if len(ts) == 1:
+                    ((_, _, original),) = ts
+                    new_tensors.extend(original.tensors if isinstance(original, Product) else [original])
+                    continue
+                profiling.fired("PowFunctionInfo._combine_powers")
+                w = _sum(w for w, _, _ in ts)
                 t0 = ts[0][1]
-                if w == 1:
-                    tensors.append(t0)
+                # Like in simplify, the pow of a Copy (of order > 0) is just the Copy. This matters, since
+                # the Ones left behind would otherwise keep getting combined into ever higher powers.
+                if w == 1 or w != 0 and isinstance(t0, Copy) and t0.order > 0:
+                    new_tensors.append(t0)
                 else:
-                    tensors.append(pow(t0, w))
+                    new_tensors.append(pow(t0, w))
                 # The remaining tensors have been reduced to ones. This prevents leaving unattached edges
                 # on the copy tensors.
-                for _, t in ts[1:]:
-                    tensors.append(Ones(**t.shape))
-        return tensors
+                for _, t1, _ in ts[1:]:
+                    new_tensors.extend(Ones(**t1.shape).tensors)
+            index = _ProductIndex(new_tensors)
+        return index.tensors
 
     @classmethod
     def _combine_components(cls, tensors: list[Tensor]) -> list[Tensor]:
@@ -499,6 +634,48 @@ class PowFunctionInfo(FunctionInfo):
         return tensors
 
 
+class _ProductIndex:
+    def __init__(self, tensors: list[Tensor]):
+        """An index of the tensors in a product, used to find pow factors, Copy hyperedges and
+        connected components without rescanning the whole product."""
+        self.tensors = tensors
+        self.pows = [
+            i for i, t in enumerate(tensors) if isinstance(t, Function) and isinstance(t.fn_info, PowFunctionInfo)
+        ]
+        self.edge_index = defaultdict(list)
+        for i, t in enumerate(tensors):
+            for e in t.edges:
+                self.edge_index[e].append(i)
+        # Components are cached by their members, so repeated components keep their cached hashes.
+        self._components = {}
+
+    def adjacent_copies(self, edges: Iterable[str]) -> set[int]:
+        """Indices of the Copy tensors with any of the given edges."""
+        return {i for e in edges for i in self.edge_index[e] if isinstance(self.tensors[i], Copy)}
+
+    def components(self, exclude: set[int]) -> list[Product]:
+        """The connected components of the product, after removing the excluded tensors."""
+        ds = DisjointSets()
+        for i in range(len(self.tensors)):
+            if i not in exclude:
+                ds.find(i)
+        for ids in self.edge_index.values():
+            ids = [i for i in ids if i not in exclude]
+            if len(ids) == 2:
+                ds.union(*ids)
+        groups = defaultdict(list)
+        for i in range(len(self.tensors)):
+            if i not in exclude:
+                groups[ds.find(i)].append(i)
+        res = []
+        for ids in groups.values():
+            key = tuple(ids)
+            if key not in self._components:
+                self._components[key] = Product([self.tensors[i] for i in ids])
+            res.append(self._components[key])
+        return res
+
+
 def pow(tensor: Tensor, k: int) -> Tensor:
     """Elementwise t^k"""
     if k == 0:
@@ -513,38 +690,174 @@ def sqrt(tensor: Tensor) -> Tensor:
     return Function(PowFunctionInfo(Fraction(1, 2)), [], (tensor,))
 
 
+class ExpFunctionInfo(FunctionInfo):
+    def __init__(self):
+        super().__init__("exp", eval=self.eval, derivative=self.derivative, elementwise=True)
+
+    def eval(self, x):
+        return torch.exp(x)
+
+    def derivative(self, i: int, new_edges: dict[str, Symbol], t: Tensor):
+        return exp(t)
+
+
 def exp(t: Tensor) -> Tensor:
-    return Function(
-        FunctionInfo(
-            "exp",
-            eval=lambda x: torch.exp(x),
-            derivative=lambda _i, _nn, t: exp(t),
-        ),
-        [],
-        (t,),
-    )
+    return Function(ExpFunctionInfo(), [], (t,))
 
 
-def softmax(t: Tensor, dims: list[str]) -> Tensor:
+def _logsumexp(x: torch.Tensor, dims: list[str], keepdim: bool) -> torch.Tensor:
+    names = x.names if keepdim else tuple(n for n in x.names if n not in dims)
+    adims = tuple(x.names.index(d) for d in dims)
+    return torch.logsumexp(x.rename(None), adims, keepdim).rename(*names)
+
+
+def _log_softmax(x: torch.Tensor, dims: list[str]) -> torch.Tensor:
+    if len(dims) == 1:
+        return torch.log_softmax(x.rename(None), x.names.index(dims[0])).rename(*x.names)
+    return x - _logsumexp(x, dims, keepdim=True)
+
+
+def _check_dims(t: Tensor, dims: list[str]) -> list[str]:
     if set(dims) - set(t.edges):
         raise ValueError("dims must be a subset of t.edges")
-    e = exp(t)
-    return e * pow(sum(e, dims, keepdims=True), -1)
+    return list(dims)
+
+
+def _identity(t: Tensor, connection: dict[str, str]) -> Tensor:
+    """The identity matrix between the given edges of t and their connection edges"""
+    return Product([Copy(t.shape[e], e, c) for e, c in connection.items()])
+
+
+def _broadcast(t: Tensor, shape: dict[str, Symbol]) -> Tensor:
+    return t @ Ones(**shape) if shape else t
+
+
+# Softmax and friends are fused functions, rather than compositions of exp, sum and pow, so they can be
+# evaluated stably without the full-size intermediates. Their derivatives are written in terms of softmax
+# itself, which keeps the higher derivatives compact. The composition is still available as the expand rule.
+
+
+class SoftmaxFunctionInfo(FunctionInfo):
+    def __init__(self, dims: list[str]):
+        super().__init__("softmax", eval=self.eval, derivative=self.derivative, expand=self.expand)
+        self.dims = dims
+
+    def eval(self, x):
+        if len(self.dims) == 1:
+            return torch.softmax(x.rename(None), x.names.index(self.dims[0])).rename(*x.names)
+        return _log_softmax(x, self.dims).exp()
+
+    def derivative(self, i: int, new_edges: dict[str, Symbol], t: Tensor):
+        # d s_i / d t_j = s_i (δ_ij - s_j)
+        connection = dict(zip(self.dims, new_edges))
+        s = softmax(t, self.dims)
+        return s * _identity(t, connection) - s * s.rename(**connection)
+
+    def expand(self, t: Tensor):
+        e = exp(t)
+        return e * pow(sum(e, self.dims, keepdims=True), -1)
+
+
+def softmax(t: Tensor, dims: list[str]) -> Tensor:
+    dims = _check_dims(t, dims)
+    return Function(SoftmaxFunctionInfo(dims), {d: t.shape[d] for d in dims}, (t, *dims))
+
+
+class LogSoftmaxFunctionInfo(FunctionInfo):
+    def __init__(self, dims: list[str]):
+        super().__init__("log_softmax", eval=self.eval, derivative=self.derivative, expand=self.expand)
+        self.dims = dims
+
+    def eval(self, x):
+        return _log_softmax(x, self.dims)
+
+    def derivative(self, i: int, new_edges: dict[str, Symbol], t: Tensor):
+        # d (t_i - logsumexp(t)) / d t_j = δ_ij - s_j
+        connection = dict(zip(self.dims, new_edges))
+        broadcast = {e: s for e, s in t.shape.items() if e not in self.dims}
+        s = softmax(t, self.dims).rename(**connection)
+        return _broadcast(_identity(t, connection), broadcast) - s @ Ones(**{d: t.shape[d] for d in self.dims})
+
+    def expand(self, t: Tensor):
+        return log(SoftmaxFunctionInfo(self.dims).expand(t))
+
+
+def log_softmax(t: Tensor, dims: list[str]) -> Tensor:
+    dims = _check_dims(t, dims)
+    return Function(LogSoftmaxFunctionInfo(dims), {d: t.shape[d] for d in dims}, (t, *dims))
+
+
+class LogSumExpFunctionInfo(FunctionInfo):
+    def __init__(self, dims: list[str]):
+        super().__init__("logsumexp", eval=self.eval, derivative=self.derivative, expand=self.expand)
+        self.dims = dims
+
+    def eval(self, x):
+        return _logsumexp(x, self.dims, keepdim=False)
+
+    def derivative(self, i: int, new_edges: dict[str, Symbol], t: Tensor):
+        return softmax(t, self.dims).rename(**dict(zip(self.dims, new_edges)))
+
+    def expand(self, t: Tensor):
+        return log(sum(exp(t), self.dims))
+
+
+def logsumexp(t: Tensor, dims: list[str]) -> Tensor:
+    dims = _check_dims(t, dims)
+    return Function(LogSumExpFunctionInfo(dims), {}, (t, *dims))
 
 
 def pairwise_distance(t1: Tensor, t2: Tensor, dims: list[str]):
     return pow(t1 - t2, 2).sum(dims)
 
 
+class CrossEntropyFunctionInfo(FunctionInfo):
+    def __init__(self, dims: list[str], batch: list[str]):
+        # Function inputs can't share broadcasted edges, so the edges shared by the logits and the targets,
+        # other than dims, are input edges to both, and are returned as output edges.
+        super().__init__("cross_entropy", eval=self.eval, derivative=self.derivative, expand=self.expand)
+        self.dims = dims
+        self.batch = batch
+
+    def eval(self, x, y):
+        ids = {n: i for i, n in enumerate(dict.fromkeys(x.names + y.names))}
+        out = self.batch + [n for n in x.names + y.names if n not in self.dims + self.batch]
+        logp = _log_softmax(x, self.dims)
+        res = torch.einsum(
+            logp.rename(None), [ids[n] for n in x.names], y.rename(None), [ids[n] for n in y.names], [ids[n] for n in out]
+        )
+        return -res.rename(*out)
+
+    def derivative(self, i: int, new_edges: dict[str, Symbol], t: Tensor, y: Tensor):
+        connection = dict(zip(self.dims + self.batch, new_edges))
+        t_broadcast = {e: s for e, s in t.shape.items() if e not in connection}
+        y_broadcast = {e: s for e, s in y.shape.items() if e not in connection}
+        if i == 0:
+            # d/dt -sum(y log_softmax(t)) = sum(y) softmax(t) - y
+            part = sum(y, self.dims, keepdims=True) * softmax(t, self.dims) - _broadcast(y, t_broadcast)
+        else:
+            part = -_broadcast(log_softmax(t, self.dims), y_broadcast)
+        # The output is diagonal in the batch edges
+        return part.rename(**connection) * _identity(t, {b: connection[b] for b in self.batch})
+
+    def expand(self, t: Tensor, y: Tensor):
+        return -sum(y * log(SoftmaxFunctionInfo(self.dims).expand(t)), self.dims)
+
+
 def cross_entropy(t: Tensor, y: Tensor, dims: list[str]) -> Tensor:
-    if set(dims) - set(t.edges):
-        raise ValueError("dims must be a subset of t.edges")
-    return -sum(y * log(softmax(t, dims)), dims)
+    dims = _check_dims(t, dims)
+    batch = [e for e in t.edges if e in y.edges and e not in dims]
+    return Function(
+        CrossEntropyFunctionInfo(dims, batch),
+        {e: t.shape[e] for e in batch},
+        (t, *dims, *batch),
+        (y, *dims, *batch),
+    )
 
 
 class ReluFunctionInfo(FunctionInfo):
     def __init__(self):
-        super().__init__("relu", eval=self.eval, derivative=self.derivative)
+        super().__init__("relu", eval=self.eval, derivative=self.derivative, elementwise=True)
 
     def eval(self, x):
         return torch.relu(x)
@@ -558,16 +871,19 @@ def relu(t: Tensor) -> Tensor:
     return Function(ReluFunctionInfo(), [], (t,))
 
 
+class AbsFunctionInfo(FunctionInfo):
+    def __init__(self):
+        super().__init__("abs", eval=self.eval, derivative=self.derivative, elementwise=True)
+
+    def eval(self, x):
+        return x.abs()
+
+    def derivative(self, i: int, new_edges: dict[str, Symbol], t: Tensor):
+        return sign(t)
+
+
 def abs(t: Tensor) -> Tensor:
-    return Function(
-        FunctionInfo(
-            "abs",
-            eval=lambda x: x.abs(),
-            derivative=lambda _i, new_edges, t: sign(t),
-        ),
-        [],
-        (t,),
-    )
+    return Function(AbsFunctionInfo(), [], (t,))
 
 
 def sign(t: Tensor) -> Tensor:
@@ -575,71 +891,306 @@ def sign(t: Tensor) -> Tensor:
     return 2 * gt0(t) - 1
 
 
+class Gt0FunctionInfo(FunctionInfo):
+    def __init__(self):
+        super().__init__("gt", eval=self.eval, derivative=self.derivative, elementwise=True)
+
+    def eval(self, x):
+        return torch.where(x.rename(None) > 0, 1.0, 0.0).rename(*x.names)
+
+    def derivative(self, i: int, new_edges: dict[str, Symbol], t: Tensor):
+        return Zero(**t.shape)
+
+
 def gt0(t: Tensor) -> Tensor:
     """Returns a tensor that's 1 where t is > 0 else 0 elsewhere"""
+    return Function(Gt0FunctionInfo(), [], (t,))
 
-    return Function(
-        FunctionInfo(
-            "gt",
-            eval=lambda x: torch.where(x.rename(None) > 0, 1.0, 0.0).rename(*x.names),
-            derivative=lambda _i, new_edges, t: Zero(**t.shape),
-        ),
-        [],
-        (t,),
-    )
 
+# The max family reduces over a set of edges. They are evaluated by moving the reduced edges last and flattening
+# them, so each is a single torch reduction (and a scatter for the one-hot masks), whatever the number of edges.
+# The derivatives are one-hot masks of the selected entries, rather than dense comparisons against the maximum.
 
-def gt(t: Tensor, dim: str | tuple[str] = (), keepdim=False) -> Tensor:
-    """Returns a tensor that's 1 for the largest index in the row (along dim), 0 elsewhere."""
-    if isinstance(dim, str):
-        dim = (dim,)
 
-    def inner(x):
-        indices = torch.max(x, dim=dim).indices
-        one_hot = torch.zeros_like(x)
-        one_hot.scatter_(dim=dim, index=indices.unsqueeze(x.names.index(dim)), value=1)
+def _flatten_dims(x: torch.Tensor, dims: list[str]) -> tuple[torch.Tensor, tuple[str, ...], torch.Size]:
+    """Move dims last and flatten them into one axis. Returns the unnamed tensor, the names of the other edges
+    and the sizes of dims."""
+    batch = tuple(n for n in x.names if n not in dims)
+    aligned = x.align_to(*batch, *dims).rename(None)
+    return aligned.flatten(len(batch)), batch, aligned.shape[len(batch) :]
 
-    return Function(
-        FunctionInfo(
-            "gt",
-            eval=lambda x: inner(x),
-            derivative=lambda _i, new_edges, t: Zero(**(t.shape | new_edges)),
-        ),
-        [],
-        (t, dim),
-    )
 
+def _check_reduce_dims(t: Tensor, dim: str | Iterable[str]) -> list[str]:
+    dims = [dim] if isinstance(dim, str) else list(dim)
+    return _check_dims(t, dims) if dims else list(t.edges)
 
-def max(t: Tensor, dim: str | tuple[str] = (), keepdim=False) -> Tensor:
-    """Returns the sum of each row of the input tensor in the given dimension dim.
-    If dim is a list of dimensions, reduce over all of them.
 
-    If keepdim is True, the output tensor is of the same size as input except in the dimension(s)
-    dim where it is of size 1. Otherwise, dim is squeezed (see torch.squeeze()), resulting in the
-    output tensor having 1 (or len(dim)) fewer dimension(s).
+class MaxFunctionInfo(FunctionInfo):
+    def __init__(self, dims: list[str]):
+        super().__init__("max", eval=self.eval, derivative=self.derivative)
+        self.dims = dims
+
+    def eval(self, x):
+        flat, batch, _ = _flatten_dims(x, self.dims)
+        return flat.amax(-1).rename(*batch)
+
+    def derivative(self, i: int, new_edges: dict[str, Symbol], t: Tensor):
+        return argmax(t, self.dims).rename(**dict(zip(self.dims, new_edges)))
+
+
+def max(t: Tensor, dim: str | Iterable[str] = (), keepdim=False) -> Tensor:
+    """The maximum of t over the given edges, or over all edges if dim is empty.
+
+    If keepdim is True, the maximum is broadcasted back over the reduced edges, so the output has the
+    same edges as t.
     """
-    if isinstance(dim, str):
-        dim = (dim,)
-    if dim == ():
-        dim = tuple(t.edges)
-
-    def eval_max(x):
-        names = x.names if keepdim else tuple(n for n in x.names if n not in dim)
-        adim = tuple(x.names.index(d) for d in dim)
-        return torch.amax(x.rename(None), adim, keepdim).rename(*names)
-
-    func = Function(
-        FunctionInfo(
-            "max",
-            eval=eval_max,
-            derivative=lambda _i, _nn, t: gt(t, dim, keepdim),
-        ),
-        [],
-        (t, *dim),
-    )
+    dims = _check_reduce_dims(t, dim)
+    res = Function(MaxFunctionInfo(dims), {}, (t, *dims))
     if keepdim:
-        func @= Ones(**{d: t.shape[d] for d in dim})
-    return func
+        res @= Ones(**{d: t.shape[d] for d in dims})
+    return res
+
+
+class ArgmaxFunctionInfo(FunctionInfo):
+    def __init__(self, dims: list[str]):
+        super().__init__("argmax", eval=self.eval, derivative=self.derivative)
+        self.dims = dims
+
+    def eval(self, x):
+        flat, batch, sizes = _flatten_dims(x, self.dims)
+        one_hot = torch.zeros_like(flat).scatter_(-1, flat.argmax(-1, keepdim=True), 1.0)
+        return one_hot.unflatten(-1, sizes).rename(*batch, *self.dims)
+
+    def derivative(self, i: int, new_edges: dict[str, Symbol], t: Tensor):
+        return Zero(**(t.shape | new_edges))
+
+
+def argmax(t: Tensor, dim: str | Iterable[str] = ()) -> Tensor:
+    """A one-hot tensor with the edges of t, that's 1 at the largest entry over the given edges
+    (or all edges if dim is empty) and 0 elsewhere. Ties are broken like torch.argmax."""
+    dims = _check_reduce_dims(t, dim)
+    return Function(ArgmaxFunctionInfo(dims), {d: t.shape[d] for d in dims}, (t, *dims))
+
+
+def gt(t: Tensor, dim: str | Iterable[str] = (), keepdim=False) -> Tensor:
+    """Returns a tensor that's 1 for the largest index in the row (along dim), 0 elsewhere.
+    The output always has the edges of t, so keepdim has no effect."""
+    return argmax(t, dim)
+
+
+class TopKFunctionInfo(FunctionInfo):
+    def __init__(self, dims: list[str], k: int, size: Symbol):
+        super().__init__("topk", eval=self.eval, derivative=self.derivative)
+        self.dims = dims
+        self.k = k
+        self.size = size
+
+    def eval(self, x):
+        flat, batch, _ = _flatten_dims(x, self.dims)
+        return flat.topk(self.k, -1).values.rename(*batch, self.size.name)
+
+    def derivative(self, i: int, new_edges: dict[str, Symbol], t: Tensor):
+        # The r-th output is the entry picked by the r-th one-hot mask
+        mask = Function(
+            TopKMaskFunctionInfo(self.dims, self.k, self.size),
+            {self.size.name: self.size} | {d: t.shape[d] for d in self.dims},
+            (t, *self.dims),
+        )
+        return mask.rename(**dict(zip(self.dims, new_edges)))
+
+
+class TopKMaskFunctionInfo(FunctionInfo):
+    def __init__(self, dims: list[str], k: int, size: Symbol):
+        super().__init__("topk_mask", eval=self.eval, derivative=self.derivative)
+        self.dims = dims
+        self.k = k
+        self.size = size
+
+    def eval(self, x):
+        # mask[..., r, idx] is 1 if idx is the position of the r-th largest entry
+        flat, batch, sizes = _flatten_dims(x, self.dims)
+        indices = flat.topk(self.k, -1).indices
+        mask = flat.new_zeros(*indices.shape, flat.shape[-1]).scatter_(-1, indices.unsqueeze(-1), 1.0)
+        return mask.unflatten(-1, sizes).rename(*batch, self.size.name, *self.dims)
+
+    def derivative(self, i: int, new_edges: dict[str, Symbol], t: Tensor):
+        return Zero(**(t.shape | {self.size.name: self.size} | new_edges))
+
+
+def topk(t: Tensor, dim: str | Iterable[str], k: int, size: Symbol) -> Tensor:
+    """The k largest entries of t over the given edges, in decreasing order, along a new edge.
+
+    The new edge is named after the size symbol, which must have the value k when evaluating.
+    """
+    dims = _check_reduce_dims(t, dim)
+    if size.name in t.edges:
+        raise ValueError(f"The new edge {size.name} is already an edge of t")
+    return Function(TopKFunctionInfo(dims, k, size), {size.name: size}, (t, *dims))
+
+
+# Linear algebra. A matrix is a tensor with a pair of edges (i, j) of the same size, and any other edges are
+# broadcasted over, so evaluation dispatches to the batched torch.linalg functions.
+# The inverse of a matrix maps the j-space back to the i-space, so inverse(X, ["i", "j"]) has the same edges as X,
+# but with their roles swapped: sum_j X[i, j] inverse(X)[j, k] = δ(i, k), after renaming i to k in the inverse.
+
+
+def _check_matrix(t: Tensor, dims: list[str]) -> tuple[str, str]:
+    if len(dims) != 2 or set(dims) - set(t.edges):
+        raise ValueError(f"dims must be two edges of the tensor, got {dims=} for {t.edges=}")
+    i, j = dims
+    if t.shape[i] != t.shape[j]:
+        raise ValueError(f"The matrix must be square, got {t.shape[i]} != {t.shape[j]}")
+    return i, j
+
+
+def _as_matrix(x: torch.Tensor, i: str, j: str) -> tuple[torch.Tensor, tuple[str, ...]]:
+    """Move the (i, j) edges of a named tensor last, returning the unnamed tensor and the batch names."""
+    batch = tuple(n for n in x.names if n not in (i, j))
+    return x.align_to(*batch, i, j).rename(None), batch
+
+
+class InverseFunctionInfo(FunctionInfo):
+    def __init__(self, dims: tuple[str, str]):
+        super().__init__("inverse", eval=self.eval, derivative=self.derivative)
+        self.dims = dims
+
+    def eval(self, x):
+        i, j = self.dims
+        m, batch = _as_matrix(x, i, j)
+        return torch.linalg.inv(m).rename(*batch, j, i)
+
+    def derivative(self, i: int, new_edges: dict[str, Symbol], t: Tensor):
+        # d X⁻¹ = -X⁻¹ dX X⁻¹
+        ci, cj = new_edges
+        e_i, e_j = self.dims
+        inv = inverse(t, self.dims)
+        return -(inv.rename(**{e_i: ci}) * inv.rename(**{e_j: cj}))
+
+
+def inverse(t: Tensor, dims: list[str]) -> Tensor:
+    """The matrix inverse of t over the pair of edges dims, broadcasted over the other edges."""
+    i, j = _check_matrix(t, dims)
+    return Function(InverseFunctionInfo((i, j)), {i: t.shape[i], j: t.shape[j]}, (t, i, j))
+
+
+class LogDetFunctionInfo(FunctionInfo):
+    def __init__(self, dims: tuple[str, str]):
+        super().__init__("logdet", eval=self.eval, derivative=self.derivative)
+        self.dims = dims
+
+    def eval(self, x):
+        m, batch = _as_matrix(x, *self.dims)
+        return torch.linalg.slogdet(m).logabsdet.rename(*batch)
+
+    def derivative(self, i: int, new_edges: dict[str, Symbol], t: Tensor):
+        # d log|det X| = tr(X⁻¹ dX)
+        ci, cj = new_edges
+        e_i, e_j = self.dims
+        return inverse(t, self.dims).rename(**{e_i: ci, e_j: cj})
+
+
+def logdet(t: Tensor, dims: list[str]) -> Tensor:
+    """The log of the absolute determinant of t over the pair of edges dims, broadcasted over the other edges."""
+    i, j = _check_matrix(t, dims)
+    return Function(LogDetFunctionInfo((i, j)), {}, (t, i, j))
+
+
+class SolveFunctionInfo(FunctionInfo):
+    def __init__(self, dims: tuple[str, str], batch: list[str]):
+        # Like cross_entropy, the edges shared by A and b are input edges to both, and returned as outputs.
+        super().__init__("solve", eval=self.eval, derivative=self.derivative, simplify=self.simplify)
+        self.dims = dims
+        self.batch = batch
+
+    def eval(self, a, b):
+        i, j = self.dims
+        a_rest = [n for n in a.names if n not in (i, j, *self.batch)]
+        b_rest = [n for n in b.names if n not in (i, *self.batch)]
+        # Line up the batch edges, and broadcast the remaining edges of A and b against each other
+        m = a.align_to(*self.batch, *a_rest, *b_rest, i, j).rename(None)
+        v = b.align_to(*self.batch, *a_rest, *b_rest, i).rename(None)
+        res = torch.linalg.solve(m, v.unsqueeze(-1)).squeeze(-1)
+        return res.rename(*self.batch, *a_rest, *b_rest, j)
+
+    def derivative(self, i: int, new_edges: dict[str, Symbol], a: Tensor, b: Tensor):
+        e_i, e_j = self.dims
+        connection = dict(zip((e_i, e_j, *self.batch) if i == 0 else (e_i, *self.batch), new_edges))
+        inv = inverse(a, self.dims).rename(**{e_i: connection[e_i]})
+        if i == 0:
+            # d A⁻¹b = -A⁻¹ dA A⁻¹b
+            part = -(inv * solve(a, b, self.dims).rename(**{e_j: connection[e_j]}))
+        else:
+            b_rest = {e: s for e, s in b.shape.items() if e not in (e_i, *self.batch)}
+            part = inv @ Ones(**b_rest) if b_rest else inv
+        # The output is diagonal in the batch edges
+        return part * Product([Copy(a.shape[e], e, connection[e]) for e in self.batch])
+
+    def simplify(self, func: Function, args: dict[str, Any]) -> Tensor:
+        # solve(A, A @ x) = x, so we never need to evaluate the inverse
+        (a, *_), (b, *_) = func.inputs
+        e_i, e_j = self.dims
+        if not isinstance(b, Product):
+            return func
+        for k, factor in enumerate(b.tensors):
+            # The factor should be A with its j edge contracted with the rest of b
+            extra = factor.edges - a.edges
+            if e_i not in factor.edges or e_j in factor.edges or len(extra) != 1 or extra <= b.edges:
+                continue
+            (e,) = extra
+            # The other edges of A must be free in b, or A is contracted with more than x
+            if not factor.edges - {e} <= b.edges:
+                continue
+            if MatchEdgesKey(factor.rename(**{e: e_j})) != MatchEdgesKey(a):
+                continue
+            res = Product(b.tensors[:k] + b.tensors[k + 1 :]).rename(**{e: e_j})
+            if res.edges == func.edges:
+                profiling.fired("SolveFunctionInfo.simplify")
+                return res.simplify(args)
+        return func
+
+
+def solve(a: Tensor, b: Tensor, dims: list[str]) -> Tensor:
+    """The solution x to the linear system A x = b, where A is a matrix over the pair of edges dims = (i, j).
+
+    b is contracted with the i edge of A, and x has the j edge in its place. Edges shared by A and b,
+    other than dims, are batch edges. The remaining edges of A and b are broadcasted over.
+    """
+    i, j = _check_matrix(a, dims)
+    if i not in b.edges:
+        raise ValueError(f"b must have the edge {i}")
+    if j in b.edges:
+        raise ValueError(f"b can't have the edge {j}, since it's the output edge of the solution")
+    batch = [e for e in a.edges if e in b.edges and e not in (i, j)]
+    return Function(
+        SolveFunctionInfo((i, j), batch),
+        {j: a.shape[j]} | {e: a.shape[e] for e in batch},
+        (a, i, j, *batch),
+        (b, i, *batch),
+    )
+
+
+# The FunctionInfos that can be stored by reference, like in the binary serializer. Each name maps to the class,
+# and the attributes holding the arguments of its constructor, which must be plain values (edge names, ints,
+# Fractions, or lists of those) or size symbols. Only these classes are ever created when loading.
+FUNCTION_INFOS: dict[str, tuple[type[FunctionInfo], tuple[str, ...]]] = {
+    "log": (LogFunctionInfo, ()),
+    "pow": (PowFunctionInfo, ("k",)),
+    "exp": (ExpFunctionInfo, ()),
+    "softmax": (SoftmaxFunctionInfo, ("dims",)),
+    "log_softmax": (LogSoftmaxFunctionInfo, ("dims",)),
+    "logsumexp": (LogSumExpFunctionInfo, ("dims",)),
+    "cross_entropy": (CrossEntropyFunctionInfo, ("dims", "batch")),
+    "relu": (ReluFunctionInfo, ()),
+    "abs": (AbsFunctionInfo, ()),
+    "gt0": (Gt0FunctionInfo, ()),
+    "max": (MaxFunctionInfo, ("dims",)),
+    "argmax": (ArgmaxFunctionInfo, ("dims",)),
+    "topk": (TopKFunctionInfo, ("dims", "k", "size")),
+    "topk_mask": (TopKMaskFunctionInfo, ("dims", "k", "size")),
+    "inverse": (InverseFunctionInfo, ("dims",)),
+    "logdet": (LogDetFunctionInfo, ("dims",)),
+    "solve": (SolveFunctionInfo, ("dims", "batch")),
+}
 
 
 # Convolution is equivalent with Unfold + Matrix Multiplication + Fold (or view to output shape)
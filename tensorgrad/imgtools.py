@@ -86,16 +86,10 @@ def combine_images_vertically(
 
 def save_steps_old(expr, min_steps=None):
     images = []
-    latex_code = to_tikz(expr)
-    images.append(compile_latex(expr, suffix=f"0"))
-    old = expr
-    while True:
-        new = expr.simplify({"grad_steps": len(images)})
-        if new == old and (min_steps is None or len(images) >= min_steps):
-            print(f"{new=} = {old=}")
-            break
-        old = new
-        images.append(compile_latex(to_tikz(new), suffix=f"{len(images)}"))
+    for step in expr.simplify_steps(grad_steps=1):
+        images.append(compile_latex(to_tikz(step), suffix=f"{len(images)}"))
+    while min_steps is not None and len(images) < min_steps:
+        images.append(images[-1])
 
     output_path = combine_images_vertically(images)
     print(f"Combined image saved to {output_path}")
@@ -115,24 +109,14 @@ def save_steps(expr, slow_grad=False):
         expr = expr.simplify({"grad_steps": cnt_derivatives})
         images.append(compile_latex(to_tikz(expr), suffix=f"{len(images)}"))
 
-    expand = False
-    while True:
-        try:
-            args = {"grad_steps": 1} if slow_grad else {}
-            if expand:
-                args["expand"] = True
-            new = expr.simplify(args).simplify()
-        except Exception as e:
-            print("ERROR:", e)
-            break
-        if new == expr:
-            if not expand:
-                expand = True
-                continue
-            break
-        print(new)
-        images.append(compile_latex(to_tikz(new), suffix=f"{len(images)}"))
-        expr = new
+    steps = expr.simplify_steps(grad_steps=1 if slow_grad else float("inf"))
+    next(steps)  # The first step is expr itself, which we already have
+    try:
+        for new in steps:
+            print(new)
+            images.append(compile_latex(to_tikz(new), suffix=f"{len(images)}"))
+    except Exception as e:
+        print("ERROR:", e)
 
     output_path = combine_images_vertically(images)
     print(f"Combined image saved to {output_path}")
@@ -0,0 +1,111 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import time
+from typing import Any, Iterator
+
+# Instrumentation of the simplification machinery.
+# Usage:
+#     with profile() as prof:
+#         expr.full_simplify()
+#     print(prof)
+# The hooks below are called from the hot paths in tensor.py and functions.py, so they must be cheap
+# when no profile is active. Times are inclusive, so e.g. the time of "Sum.combine_terms" includes
+# the hashing and isomorphism tests it does.
+
+_active: "Profile | None" = None
+
+
+@dataclass
+class RuleStats:
+    calls: int = 0
+    fired: int = 0
+    time: float = 0.0
+
+
+@dataclass
+class Round:
+    name: str
+    nodes_before: int
+    nodes_after: int
+    time: float
+
+
+@dataclass
+class Profile:
+    rules: dict[str, RuleStats] = field(default_factory=lambda: defaultdict(RuleStats))
+    rounds: list[Round] = field(default_factory=list)
+
+    def report(self) -> dict[str, Any]:
+        """Returns the profile as a plain dict, e.g. for json serialization."""
+        return {
+            "rules": {
+                name: {"calls": s.calls, "fired": s.fired, "time": s.time}
+                for name, s in sorted(self.rules.items(), key=lambda kv: -kv[1].time)
+            },
+            "rounds": [vars(r).copy() for r in self.rounds],
+        }
+
+    def __str__(self):
+        lines = [f"{'rule':<40} {'calls':>8} {'fired':>8} {'time (s)':>10}"]
+        for name, s in sorted(self.rules.items(), key=lambda kv: -kv[1].time):
+            lines.append(f"{name:<40} {s.calls:>8} {s.fired:>8} {s.time:>10.4f}")
+        for i, r in enumerate(self.rounds):
+            lines.append(f"round {i} ({r.name}): {r.nodes_before} -> {r.nodes_after} nodes in {r.time:.4f}s")
+        return "\n".join(lines)
+
+
+@contextmanager
+def profile() -> Iterator[Profile]:
+    """Record statistics for all simplification work done inside the context."""
+    global _active
+    outer, _active = _active, Profile()
+    try:
+        yield _active
+    finally:
+        _active = outer
+
+
+def is_active() -> bool:
+    return _active is not None
+
+
+class timed:
+    """Context manager timing a named section, if profiling is active."""
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter() if _active is not None else None
+
+    def __exit__(self, *exc):
+        if _active is not None and self.start is not None:
+            stats = _active.rules[self.name]
+            stats.calls += 1
+            stats.time += time.perf_counter() - self.start
+
+
+def fired(name: str, count: int = 1):
+    """Record that a rewrite rule changed the expression."""
+    if _active is not None:
+        _active.rules[name].fired += count
+
+
+def record_round(name: str, before, after, elapsed: float):
+    if _active is not None:
+        _active.rounds.append(Round(name, node_count(before), node_count(after), elapsed))
+
+
+def node_count(tensor) -> int:
+    """The number of nodes in the expression tree of a tensor."""
+    children = []
+    if hasattr(tensor, "tensors"):
+        children = tensor.tensors
+    elif hasattr(tensor, "inputs"):
+        children = [t for t, *_ in tensor.inputs]
+    elif hasattr(tensor, "tensor"):
+        children = [tensor.tensor]
+    return 1 + sum(node_count(t) for t in children)
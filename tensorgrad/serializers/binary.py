@@ -0,0 +1,340 @@
+import io
+import struct
+from fractions import Fraction
+from typing import Any, BinaryIO
+from sympy import Symbol
+
+from tensorgrad.tensor import (
+    Copy,
+    Derivative,
+    Function,
+    FunctionInfo,
+    Product,
+    Sum,
+    Tensor,
+    Variable,
+    Zero,
+    _DummyFunctionInfo,
+)
+from tensorgrad.functions import FUNCTION_INFOS
+
+# A compact binary format for tensor expressions.
+#
+# The expression is stored as a table of nodes, where each node refers to its children by their index
+# in the table. Nodes are hash-consed, so identical sub-expressions (including their edge names) are
+# written only once, no matter how many times they occur in the expression.
+# Strings (edge names, variable names) are interned, and size symbols are stored in their own table.
+# FunctionInfos are stored by reference: their name in functions.FUNCTION_INFOS, and the arguments needed
+# to recreate them. Loading only creates the registered classes, so it never runs code from the file.
+#
+# The layout is
+#     MAGIC, version, values...
+# where every value is a tagged, varint encoded int, str, float, Fraction or list.
+
+MAGIC = b"TGRD"
+VERSION = 2
+
+# Value tags
+_INT, _STR, _STR_REF, _LIST, _FLOAT, _FRACTION = range(6)
+
+# Node kinds
+_VARIABLE, _COPY, _ZERO, _FUNCTION, _DERIVATIVE, _PRODUCT, _SUM = range(7)
+
+# Function info kinds
+_INFO_DUMMY, _INFO_REGISTERED = range(2)
+
+# Function info argument kinds
+_ARG_VALUE, _ARG_SYMBOL = range(2)
+
+# The registered name of each FunctionInfo class
+_INFO_NAMES = {cls: name for name, (cls, _) in FUNCTION_INFOS.items()}
+
+
+################################################################################
+# Low level encoding
+################################################################################
+
+
+class _Writer:
+    def __init__(self):
+        self.out = io.BytesIO()
+        self.strings = {}
+
+    def varint(self, n: int):
+        while True:
+            byte, n = n & 0x7F, n >> 7
+            if n:
+                self.out.write(bytes([byte | 0x80]))
+            else:
+                self.out.write(bytes([byte]))
+                return
+
+    def value(self, v: Any):
+        # bool is a subclass of int, which is fine, since we never need to distinguish them.
+        if isinstance(v, int):
+            self.varint(_INT)
+            # Zig-zag encoding, so small negative numbers stay small
+            self.varint(2 * v if v >= 0 else -2 * v - 1)
+        elif isinstance(v, str):
+            if (i := self.strings.get(v)) is not None:
+                self.varint(_STR_REF)
+                self.varint(i)
+            else:
+                self.strings[v] = len(self.strings)
+                data = v.encode()
+                self.varint(_STR)
+                self.varint(len(data))
+                self.out.write(data)
+        elif isinstance(v, (list, tuple)):
+            self.varint(_LIST)
+            self.varint(len(v))
+            for x in v:
+                self.value(x)
+        elif isinstance(v, float):
+            self.varint(_FLOAT)
+            self.out.write(struct.pack("<d", v))
+        elif isinstance(v, Fraction):
+            self.varint(_FRACTION)
+            self.value(v.numerator)
+            self.value(v.denominator)
+        else:
+            raise ValueError(f"Can't serialize value {v!r} of type {type(v)}")
+
+
+class _Reader:
+    def __init__(self, data: bytes, pos: int = 0):
+        self.data = data
+        self.pos = pos
+        self.strings = []
+
+    def varint(self) -> int:
+        n, shift = 0, 0
+        while True:
+            byte = self.data[self.pos]
+            self.pos += 1
+            n |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return n
+            shift += 7
+
+    def value(self) -> Any:
+        tag = self.varint()
+        if tag == _INT:
+            n = self.varint()
+            return n >> 1 if not n & 1 else -((n + 1) >> 1)
+        if tag == _STR:
+            length = self.varint()
+            s = self.data[self.pos : self.pos + length].decode()
+            self.pos += length
+            self.strings.append(s)
+            return s
+        if tag == _STR_REF:
+            return self.strings[self.varint()]
+        if tag == _LIST:
+            return [self.value() for _ in range(self.varint())]
+        if tag == _FLOAT:
+            (v,) = struct.unpack_from("<d", self.data, self.pos)
+            self.pos += 8
+            return v
+        if tag == _FRACTION:
+            return Fraction(self.value(), self.value())
+        raise ValueError(f"Unknown tag {tag} at position {self.pos}")
+
+
+################################################################################
+# Dumping
+################################################################################
+
+
+class _Dumper:
+    def __init__(self):
+        self.nodes = []
+        self.node_index = {}  # record -> index, for hash-consing
+        self.id_index = {}  # id(tensor) -> index, to avoid re-encoding shared objects
+        self.symbols = []
+        self.symbol_index = {}
+        self.keep_alive = []  # Keep tensors alive, so their ids aren't reused
+
+    def symbol(self, s: Symbol) -> int:
+        if (i := self.symbol_index.get(s)) is None:
+            assumptions = getattr(s, "_assumptions_orig", {})
+            true = tuple(sorted(k for k, v in assumptions.items() if v))
+            false = tuple(sorted(k for k, v in assumptions.items() if v is False))
+            record = (s.name, true, false)
+            i = self.symbol_index[s] = len(self.symbols)
+            self.symbols.append(record)
+        return i
+
+    def shape(self, shape: dict[str, Symbol]) -> list:
+        return [(e, self.symbol(s)) for e, s in shape.items()]
+
+    def node(self, tensor: Tensor) -> int:
+        if (i := self.id_index.get(id(tensor))) is not None:
+            return i
+        record = self.record(tensor)
+        if (i := self.node_index.get(record)) is None:
+            i = self.node_index[record] = len(self.nodes)
+            self.nodes.append(record)
+        self.id_index[id(tensor)] = i
+        self.keep_alive.append(tensor)
+        return i
+
+    def record(self, t: Tensor) -> tuple:
+        if isinstance(t, Variable):
+            symmetries = tuple(sorted(tuple(sorted(group)) for group in t._symmetries))
+            return (_VARIABLE, t.name, _freeze(self.shape(t.shape)), _freeze(t.orig.items()), symmetries)
+        if isinstance(t, Copy):
+            return (_COPY, self.symbol(t.size), tuple(t.edges))
+        if isinstance(t, Zero):
+            return (_ZERO, _freeze(self.shape(t.shape)))
+        if isinstance(t, Function):
+            inputs = tuple((self.node(u), tuple(es)) for u, *es in t.inputs)
+            return (
+                _FUNCTION,
+                self.function_info(t.fn_info),
+                _freeze(self.shape(t.shape_out)),
+                _freeze(t.orig_out.items()),
+                inputs,
+            )
+        if isinstance(t, Derivative):
+            return (_DERIVATIVE, self.node(t.tensor), self.node(t.x), _freeze(t.new_names.items()))
+        if isinstance(t, Product):
+            return (_PRODUCT, tuple(self.node(u) for u in t.tensors))
+        if isinstance(t, Sum):
+            return (_SUM, tuple(self.node(u) for u in t.tensors), tuple(t.weights))
+        raise ValueError(f"Can't serialize tensors of type {type(t).__name__}")
+
+    def function_info(self, info: FunctionInfo) -> tuple:
+        if isinstance(info, _DummyFunctionInfo):
+            # Dummy infos are recreated by Function from the name and the inputs
+            return (_INFO_DUMMY, info.name)
+        if (name := _INFO_NAMES.get(type(info))) is None:
+            raise ValueError(f"Can't serialize {type(info).__name__}, it's not in functions.FUNCTION_INFOS")
+        _, attrs = FUNCTION_INFOS[name]
+        args = []
+        for attr in attrs:
+            arg = getattr(info, attr)
+            if isinstance(arg, Symbol):
+                args.append((_ARG_SYMBOL, self.symbol(arg)))
+            else:
+                # Lists of edge names are stored as tuples, so the record can be hash-consed
+                args.append((_ARG_VALUE, tuple(arg) if isinstance(arg, (list, tuple)) else arg))
+        return (_INFO_REGISTERED, name, tuple(args))
+
+
+def _freeze(items) -> tuple:
+    return tuple(tuple(x) for x in items)
+
+
+def dumps(tensor: Tensor) -> bytes:
+    """Serialize a tensor expression to bytes."""
+    dumper = _Dumper()
+    root = dumper.node(tensor)
+    writer = _Writer()
+    writer.out.write(MAGIC)
+    writer.varint(VERSION)
+    writer.value(dumper.symbols)
+    writer.value(dumper.nodes)
+    writer.value(root)
+    return writer.out.getvalue()
+
+
+def dump(tensor: Tensor, fp: BinaryIO):
+    """Serialize a tensor expression to a binary file."""
+    fp.write(dumps(tensor))
+
+
+################################################################################
+# Loading
+################################################################################
+
+
+class ExpressionTable:
+    def __init__(self, data: bytes):
+        """
+        The decoded node table of a serialized expression.
+
+        Tensors are only constructed when requested, so looking at a small part of a large
+        expression doesn't pay for the rest.
+        """
+        if data[: len(MAGIC)] != MAGIC:
+            raise ValueError("Not a serialized tensorgrad expression")
+        reader = _Reader(data, len(MAGIC))
+        if (version := reader.varint()) != VERSION:
+            raise ValueError(f"Unsupported version {version}")
+        self.symbols = [
+            Symbol(name, **{k: True for k in true}, **{k: False for k in false})
+            for name, true, false in reader.value()
+        ]
+        self.nodes = reader.value()
+        self.root_index = reader.value()
+        self._tensors = {}
+
+    @property
+    def root(self) -> Tensor:
+        return self.tensor(self.root_index)
+
+    def tensor(self, i: int) -> Tensor:
+        if (t := self._tensors.get(i)) is None:
+            t = self._tensors[i] = self._build(self.nodes[i])
+        return t
+
+    def _shape(self, shape: list) -> dict[str, Symbol]:
+        return {e: self.symbols[s] for e, s in shape}
+
+    def _build(self, record: list) -> Tensor:
+        kind, *args = record
+        if kind == _VARIABLE:
+            name, shape, orig, symmetries = args
+            return Variable(
+                name,
+                **self._shape(shape),
+                _symmetries={frozenset(group) for group in symmetries},
+                _orig=dict(orig),
+            )
+        if kind == _COPY:
+            size, edges = args
+            return Copy(self.symbols[size], *edges)
+        if kind == _ZERO:
+            (shape,) = args
+            return Zero(**self._shape(shape))
+        if kind == _FUNCTION:
+            info, shape_out, orig_out, inputs = args
+            return Function(
+                self._function_info(info),
+                self._shape(shape_out),
+                *[(self.tensor(i), *es) for i, es in inputs],
+                orig_out=dict(orig_out),
+            )
+        if kind == _DERIVATIVE:
+            tensor, x, new_names = args
+            return Derivative(self.tensor(tensor), self.tensor(x), dict(new_names))
+        if kind == _PRODUCT:
+            (children,) = args
+            return Product([self.tensor(i) for i in children])
+        if kind == _SUM:
+            children, weights = args
+            return Sum([self.tensor(i) for i in children], weights)
+        raise ValueError(f"Unknown node kind {kind}")
+
+    def _function_info(self, ref: list) -> FunctionInfo | str:
+        kind, name, *rest = ref
+        if kind == _INFO_DUMMY:
+            return name
+        if kind != _INFO_REGISTERED:
+            raise ValueError(f"Unknown function info kind {kind}")
+        if name not in FUNCTION_INFOS:
+            raise ValueError(f"Unknown function info {name!r}")
+        cls, _ = FUNCTION_INFOS[name]
+        (args,) = rest
+        return cls(*(self.symbols[v] if k == _ARG_SYMBOL else v for k, v in args))
+
+
+def loads(data: bytes) -> Tensor:
+    """Deserialize a tensor expression from bytes."""
+    return ExpressionTable(data).root
+
+
+def load(fp: BinaryIO) -> Tensor:
+    """Deserialize a tensor expression from a binary file."""
+    return loads(fp.read())
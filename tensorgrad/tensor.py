@@ -1,16 +1,32 @@
 from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from functools import cached_property
 import math
-from typing import Any, Callable, Iterable, Optional
+import time
+from typing import Any, Callable, Iterable, Iterator, Optional
 from abc import ABC
 from fractions import Fraction
+import itertools
 from numbers import Number
 import networkx as nx
+import sympy
 from sympy import Symbol
 
 import torch
 
+from tensorgrad import profiling
+from tensorgrad.utils import DisjointSets
+
+# Enables expensive self-checks, like isomorphism tests of tensors that should be unchanged.
+DEBUG = False
+
+# Evaluate chains of elementwise functions, sums and Hadamard products as one fused program.
+FUSE_ELEMENTWISE = True
+# Run the fused programs through torch.compile, if available. Compilation is slow, so it only pays off
+# when the same expression is evaluated many times, or on very large tensors.
+COMPILE_FUSED = False
+
 
 # TODO:
 # - Code generation (e.g. Triton, Pytorch)
@@ -21,27 +37,20 @@ import torch
 #   This is kinda what the FunctionInfo objects are, no?
 # - Support broadcasting in functions, since simple two input functions like Cross Entropy is currently basically not possible.
 #   Can't you just user Copy tensors?
-# - Taking the derivative with respect to multiple variables at the same time (full backprop)
-#   Maybe we can still take derivatives individually, and just use the isomorphic hashing to avoid recomputions?
 # - Having a reduce function at applies a function along a given dimension could be a way to implement RNNs.
 
 # More simplification rules:
-# - Optional "function expand" that converts e.g. "softmax" into it's components
 
 # Smaller things:
 # - Stuff from https://en.wikipedia.org/wiki/Penrose_graphical_notation
 #   - Symmetrization/Antisymmetrization
-#   - Matrix inverses. Should be easy to do as a function that takes a matrix and returns a matrix.
-#     In principle it could also be done using Penrose's construction, but that's probably overkill.
-#     The derivative seems pretty simple too. just D(X)^-1 = -X^-1 D(X) X^-1.
-#     With matrix inverse we can solve https://math.stackexchange.com/questions/1371878
-#   - Determinant. Again, should be easy to do as a function.
-#     We can use the derivative function ∂(det(X)) = det(X)Tr(X^−1 ∂X).
-# - Nested derivatives should create symmetries between the edges they create.
-#   This would probably require expanding the Derivative class to take multiple wrts?
-#   This is similar to how we handle commutivity and associativeity of Sums and Products.
 
 # Done:
+# X Matrix inverses and (log) determinants, see functions.inverse, solve and logdet.
+#   With matrix inverse we can solve https://math.stackexchange.com/questions/1371878
+# X Optional "function expand" that converts e.g. "softmax" into it's components, see args["function_expand"]
+# X Nested derivatives should create symmetries between the edges they create. See functions.grad(t, x, order)
+# X Taking the derivative with respect to multiple variables at the same time (full backprop), see grad_all
 # X Prettier printing. At least indentation.
 # X Support taking the Expectation, at least for Gaussian tensors. Can be done via Gaussian integration by parts.
 # X Optional "expand" setting that expands the expression to a sum of products
@@ -55,6 +64,28 @@ import torch
 #   The current Constant(link=...) system is broken, because it doesn't connect a specific edge.
 
 
+@dataclass
+class Cost:
+    """Estimated cost of evaluating a tensor expression.
+
+    The fields are sympy expressions in the edge-size symbols, or plain numbers if dims were given.
+    - flops: The number of multiply/add operations.
+    - peak: The size of the largest intermediate tensor, including the output.
+    - size: The number of entries in the output.
+    """
+
+    flops: Any
+    peak: Any
+    size: Any
+
+    def subs(self, dims: dict[Symbol, int]) -> "Cost":
+        return Cost(*(_subs_dims(v, dims) for v in (self.flops, self.peak, self.size)))
+
+    def __add__(self, other: "Cost") -> "Cost":
+        """Cost of computing both self and other, e.g. two independent sub-expressions."""
+        return Cost(self.flops + other.flops, sympy.Max(self.peak, other.peak), self.size + other.size)
+
+
 class Tensor(ABC):
     @property
     def edges(self) -> set[str]:
@@ -120,32 +151,179 @@ class Tensor(ABC):
         """
         return self
 
-    def full_simplify(self) -> "Tensor":
-        """Applies multiple simplification rules until the expression no longer changes"""
+    def full_simplify(self, workers: int | None = None) -> "Tensor":
+        """Applies multiple simplification rules until the expression no longer changes
+
+        Args:
+            workers: If given, independent Sum terms and Function inputs are simplified in parallel
+                using a pool with this many processes.
+        """
+        if workers is not None:
+            with ProcessPoolExecutor(workers) as executor:
+                return self._full_simplify({"executor": executor})
+        return self._full_simplify({})
+
+    def _full_simplify(self, args: dict[str, Any]) -> "Tensor":
         expr = self
-        while (new := expr.simplify()) != expr:
+        while (new := expr._profiled_simplify("simplify", args.copy())) != expr:
             expr = new
-        expr = expr.simplify({"expand": True})
-        while (new := expr.simplify()) != expr:
+        expr = expr._profiled_simplify("expand", args | {"expand": True})
+        while (new := expr._profiled_simplify("simplify", args.copy())) != expr:
             expr = new
         return expr
 
+    def simplify_steps(self, grad_steps: int | float = 1) -> Iterator["Tensor"]:
+        """Yields each intermediate form on the way to full_simplify, starting with the tensor itself.
+
+        Each step pushes derivatives at most grad_steps levels further. Simplified sub-expressions are
+        remembered between steps, so consuming all the steps costs about the same as full_simplify,
+        and the consumer is free to stop early.
+        """
+        args = {"grad_steps": grad_steps, "memo": _SimplifyMemo()}
+        expr = self
+        yield expr
+        # The same schedule as full_simplify: simplify, expand once, and simplify again.
+        for expand in (False, True):
+            round_args = args | {"expand": expand}
+            name = "expand" if expand else "simplify"
+            while (new := expr._profiled_simplify(name, round_args.copy())) != expr:
+                expr = new
+                yield expr
+                round_args["expand"], name = False, "simplify"
+
+    def _profiled_simplify(self, name: str, args: dict[str, Any] = None) -> "Tensor":
+        """Runs simplify, recording the round if profiling is active."""
+        if not profiling.is_active():
+            return self.simplify(args)
+        start = time.perf_counter()
+        new = self.simplify(args)
+        profiling.record_round(name, self, new, time.perf_counter() - start)
+        return new
+
     def __hash__(self) -> int:
         return hash(self.weisfeiler_lehman)
 
     @cached_property
     def weisfeiler_lehman(self) -> str:
         """Hexadecimal string corresponding to hash of the input graph."""
-        G, _ = self.edge_structural_graph(match_edges=False)
-        return nx.algorithms.weisfeiler_lehman_graph_hash(G, node_attr="name")
+        with profiling.timed("hashing"):
+            G, _ = self.edge_structural_graph(match_edges=False)
+            return nx.algorithms.weisfeiler_lehman_graph_hash(G, node_attr="name")
 
     def __eq__(self, other) -> bool:
         return self.is_isomorphic(other)
 
+    def __getstate__(self) -> dict[str, Any]:
+        # Cached properties live in __dict__. The structural hash includes the ids of the size symbols,
+        # so it isn't valid in another process, and we drop it. Everything else is plain data.
+        state = self.__dict__.copy()
+        state.pop("weisfeiler_lehman", None)
+        return state
+
     def depends_on(self, x: "Variable") -> bool:
         """Check if this tensor depends on the variable x."""
+        return x.key in self.dependencies
+
+    def substitute(self, mapping: dict["Variable", "Tensor"]) -> "Tensor":
+        """
+        Replace variables by other tensors.
+
+        Every occurrence of a variable is replaced, including renamed ones, in which case the replacement is
+        renamed the same way. Sub-expressions that don't depend on the substituted variables are reused as is,
+        so they keep their cached hashes and values, and shared sub-expressions are only rewritten once.
+
+        Args:
+            mapping: A dictionary from variables to tensors with the same shape.
+
+        Returns:
+            The tensor with the variables replaced.
+        """
+        replacements = {}
+        for v, t in mapping.items():
+            if not isinstance(v, Variable):
+                raise ValueError(f"Can only substitute variables, got {v}")
+            if t.shape != v.shape:
+                raise ValueError(f"The replacement must have the shape of the variable, {t.shape=} != {v.shape=}")
+            # The replacements use the original names of the variable, like the values in evaluate
+            replacements[v.key] = t.rename(**v.orig)
+        return self._substitute(replacements, {})
+
+    def _substitute(self, replacements: dict[tuple, "Tensor"], memo: dict[int, "Tensor"]) -> "Tensor":
+        if self.dependencies.isdisjoint(replacements):
+            return self
+        if (res := memo.get(id(self))) is None:
+            res = memo[id(self)] = self._inner_substitute(replacements, memo)
+            assert res.edges == self.edges, f"{res.edges=} != {self.edges=}"
+        return res
+
+    def _inner_substitute(self, replacements: dict[tuple, "Tensor"], memo: dict[int, "Tensor"]) -> "Tensor":
+        """
+        The inner implementation of substitute, called only if the tensor depends on the replaced variables.
+
+        Args:
+            replacements: Map from the keys of the replaced variables to their replacements,
+                using the original edge names of the variables.
+            memo: The results for the tensors already rewritten, by id, to keep shared sub-expressions shared.
+        """
+        raise NotImplementedError
+
+    def partial_evaluate(
+        self,
+        values: dict["Variable", torch.Tensor],
+        dims: dict[Symbol, int] | None = None,
+    ) -> "Tensor":
+        """
+        Evaluate the sub-expressions that only depend on the given variables, and replace them by constants
+        holding their values. Evaluating the result with values for the remaining variables gives the same
+        result as evaluating the original tensor, but without recomputing the folded parts.
+
+        Note:
+            The folded parts are constants, so derivatives with respect to the given variables are lost.
+            Derivatives must be simplified before they can be folded.
+
+        Args:
+            values: A dictionary mapping the fixed variables to their values.
+            dims: An optional dictionary specifying the dimensions of free edges.
+
+        Returns:
+            The tensor with the folded sub-expressions.
+        """
+        dims = {} if dims is None else dims
+        # Evaluation stores the intermediate values, so the folded parts share their computations
+        values = values.copy()
+        keys = frozenset(v.key for v in values if isinstance(v, Variable))
+
+        def fold(t: Tensor) -> Tensor:
+            return Folded(t.evaluate(values, dims), t.shape)
+
+        return self._partial_evaluate(keys, fold, {})
+
+    def _partial_evaluate(self, keys: frozenset[tuple], fold: Callable, memo: dict[int, "Tensor"]) -> "Tensor":
+        if self.dependencies.isdisjoint(keys):
+            return self
+        if (res := memo.get(id(self))) is None:
+            res = fold(self) if self.dependencies <= keys else self._inner_partial_evaluate(keys, fold, memo)
+            memo[id(self)] = res
+        return res
+
+    def _inner_partial_evaluate(self, keys: frozenset[tuple], fold: Callable, memo: dict[int, "Tensor"]) -> "Tensor":
+        """Fold the parts of a tensor that depends on both fixed and free variables.
+        By default nothing is folded, which is always correct."""
+        return self
+
+    @cached_property
+    def dependencies(self) -> frozenset[tuple]:
+        """The keys (see Variable.key) of the variables this tensor depends on.
+        Computed once per tensor, so depends_on is a simple membership test."""
         raise NotImplementedError
 
+    @cached_property
+    def _fused_program(self) -> Optional["_ElementwiseProgram"]:
+        """The fused elementwise program of the tensor, if it has at least two elementwise operations.
+        Built once per tensor, so repeated evaluations reuse the program, and its compiled kernel."""
+        program = _ElementwiseProgram(self)
+        return program if program.ops >= 2 else None
+
     @cached_property
     def structural_graph(self) -> tuple[nx.MultiDiGraph, dict[str, str]]:
         """Create a graph representation of the tensor, which can be used for isomorphism testing.
@@ -249,9 +427,10 @@ class Tensor(ABC):
     def is_isomorphic(self, other, match_edges=False, edge_names: None | dict[str, str] = None) -> bool:
         if self.weisfeiler_lehman != other.weisfeiler_lehman:
             return False
-        G1, _ = self.edge_structural_graph(match_edges=match_edges, edge_names=edge_names)
-        G2, _ = other.edge_structural_graph(match_edges=match_edges, edge_names=edge_names)
-        return nx.is_isomorphic(G1, G2, node_match=lambda n1, n2: n1.get("name") == n2.get("name"))
+        with profiling.timed("isomorphism"):
+            G1, _ = self.edge_structural_graph(match_edges=match_edges, edge_names=edge_names)
+            G2, _ = other.edge_structural_graph(match_edges=match_edges, edge_names=edge_names)
+            return nx.is_isomorphic(G1, G2, node_match=lambda n1, n2: n1.get("name") == n2.get("name"))
 
     def isomorphisms(self, other):
         """Given self and other are isomorphic, this method returns a dictionary that renames self into other."""
@@ -344,6 +523,32 @@ class Tensor(ABC):
         """
         raise NotImplementedError
 
+    def cost(self, dims: dict[Symbol, int] | None = None) -> Cost:
+        """
+        Estimate the cost of evaluating this tensor.
+
+        Args:
+            dims: An optional dictionary giving numerical values for the edge sizes.
+                If not given, the cost is returned symbolically in terms of the size symbols.
+                The dims are also used to pick the contraction order of Products. Without them
+                all sizes are assumed equal.
+
+        Returns:
+            A Cost object with the flops, peak intermediate size and output size.
+        """
+        dims = {} if dims is None else dims
+        cost = self._inner_cost(dims)
+        return cost.subs(dims) if dims else cost
+
+    def _inner_cost(self, dims: dict[Symbol, int]) -> Cost:
+        """
+        The inner implementation of the cost estimate. Should return the symbolic cost.
+
+        Args:
+            dims: Edge sizes used only to make decisions, like the contraction order. May be empty.
+        """
+        raise NotImplementedError
+
     def _check_rename(self, kwargs: dict[str, str]):
         """Check that the renaming is valid, and return the renaming dictionary."""
         if len({kwargs.get(e, e) for e in self.edges}) != len(self.edges):
@@ -383,6 +588,14 @@ class Tensor(ABC):
         args.setdefault("combine_products", True)
         args.setdefault("factor_components", True)
         args.setdefault("expand", False)
+        # Replace fused functions, like softmax, by their definition in terms of simpler functions
+        args.setdefault("function_expand", False)
+        # An optional concurrent.futures.Executor, used to simplify independent children in parallel
+        args.setdefault("executor", None)
+        # An optional memo of simplified sub-expressions, shared between rounds of simplification
+        args.setdefault("memo", None)
+        # Simplified derivatives, shared by the whole simplify call. Set to None to disable.
+        args.setdefault("derivative_cache", {})
         return args
 
     @staticmethod
@@ -533,8 +746,19 @@ class Variable(Tensor):
             _orig={kwargs.get(e, e): o for e, o in self.orig.items()},
         )
 
-    def depends_on(self, x: "Variable") -> bool:
-        return x == self
+    @cached_property
+    def key(self) -> tuple:
+        """A hashable key identifying the variable, which doesn't change when the variable is renamed.
+        Two variables have the same key exactly when they are isomorphic."""
+        orbits = frozenset(frozenset(self.orig[e] for e in group) for group in self._symmetries)
+        return (self.name, frozenset((o, self.shape[e]) for e, o in self.orig.items()), orbits)
+
+    @cached_property
+    def dependencies(self) -> frozenset[tuple]:
+        return frozenset([self.key])
+
+    def _inner_substitute(self, replacements: dict[tuple, Tensor], memo: dict[int, Tensor]) -> Tensor:
+        return replacements[self.key].rename(**{o: e for e, o in self.orig.items()})
 
     def _inner_evaluate(self, values: dict["Tensor", torch.Tensor], dims: dict[Symbol, int]) -> torch.Tensor:
         tensor = values.get(self)
@@ -545,6 +769,10 @@ class Variable(Tensor):
         old_to_new = {o: e for e, o in self.orig.items()}
         return tensor.rename(*[old_to_new[e] for e in tensor.names])
 
+    def _inner_cost(self, dims: dict[Symbol, int]) -> Cost:
+        size = _shape_size(self.shape)
+        return Cost(0, size, size)
+
 
 ################################################################################
 # Constants
@@ -599,8 +827,14 @@ class Constant(Tensor, ABC):
         new_names = self._check_grad(x, new_names)
         return Zero(**(self.shape | {new_names[e]: s for e, s in x.shape.items()}))
 
-    def depends_on(self, x: "Variable") -> bool:
-        return False
+    @cached_property
+    def dependencies(self) -> frozenset[tuple]:
+        return frozenset()
+
+    def _inner_cost(self, dims: dict[Symbol, int]) -> Cost:
+        # Constants are materialized as dense tensors during evaluation
+        size = _shape_size(self.shape)
+        return Cost(0, size, size)
 
 
 class Copy(Constant):
@@ -640,10 +874,11 @@ class Copy(Constant):
     @classmethod
     def simplify_outer(cls, tensors: list[Tensor]) -> list[Tensor]:
         """Simplifies a list of tensors assumed to be a product."""
-        while True:
-            tensors, done = cls._simplify_step(tensors)
-            if done:
-                break
+        with profiling.timed("Copy.simplify_outer"):
+            while True:
+                tensors, done = cls._simplify_step(tensors)
+                if done:
+                    break
         return tensors
 
     def structural_graph(self) -> tuple[nx.MultiDiGraph, dict[str, int]]:
@@ -671,6 +906,7 @@ class Copy(Constant):
 
             for simplification in [cls._merge_copy_tensors, cls._remove_identity_matrix]:
                 if (new := simplification(t1, t2, e)) is not None:
+                    profiling.fired(f"Copy.{simplification.__name__}")
                     return other + new, False
 
         return tensors, True
@@ -724,6 +960,45 @@ class Zero(Constant):
         return torch.zeros([dims[s] for s in self.shape.values()]).rename(*self.edges)
 
 
+class Folded(Constant):
+    def __init__(self, value: torch.Tensor, shape: dict[str, Symbol], orig: dict[str, str] | None = None):
+        """
+        A constant holding a precomputed value, like the sub-expressions folded by Tensor.partial_evaluate.
+
+        Args:
+            value: The named torch tensor, using the original edge names.
+            shape: The sizes of the edges.
+            orig: Map from the (possibly renamed) edges to the original edge names. Defaults to the identity.
+        """
+        super().__init__(**shape)
+        self.value = value
+        self.orig = {e: e for e in self.edges} if orig is None else orig
+        assert set(value.names) == set(self.orig.values()), f"{value.names=} {self.orig=}"
+
+    def __repr__(self):
+        return f"Folded({', '.join(self.edges)})"
+
+    def rename(self, **kwargs: dict[str, str]):
+        kwargs = self._check_rename(kwargs)
+        shape = {kwargs.get(e, e): s for e, s in self.shape.items()}
+        return Folded(self.value, shape, {kwargs.get(e, e): o for e, o in self.orig.items()})
+
+    def structural_graph(self) -> tuple[nx.MultiDiGraph, dict[str, int]]:
+        # Folded tensors are only equal if they hold the same value, and we don't know their symmetries,
+        # so every edge gets its own node, labeled by its original name.
+        G = nx.MultiDiGraph()
+        G.add_node(0, name=("Folded", id(self.value)), tensor=self)
+        edges = {}
+        for e, s in self.shape.items():
+            G.add_node(edges.setdefault(e, G.number_of_nodes()), name=("Edge", self.orig[e], id(s)))
+            G.add_edge(0, edges[e])
+        return G, edges
+
+    def _inner_evaluate(self, values: dict["Tensor", torch.Tensor], dims: dict[Symbol, int]) -> torch.Tensor:
+        old_to_new = {o: e for e, o in self.orig.items()}
+        return self.value.rename(*(old_to_new[o] for o in self.value.names)).align_to(*self.edges)
+
+
 def Ones(*shape0: Symbol, **shape1: Symbol) -> Tensor:
     """Matrix such that O_{i,j,k} = 1 for all i, j, k"""
     # Implemented in practice by a simple outer product of Copy's
@@ -742,28 +1017,39 @@ class FunctionInfo:
     eval: Callable[[list[torch.Tensor]], torch.Tensor] = None
     derivative: Callable[[int, dict[str, Symbol], None], Tensor] = None
     simplify: Callable[["Function", dict[str, Any]], Tensor] = None
+    # Elementwise functions have a single input, no input edges, and a diagonal Jacobian.
+    elementwise: bool = False
+    # The function written in terms of simpler functions, given the inputs. Used by "function_expand".
+    expand: Callable[..., Tensor] = None
 
 
-def _dummy_function_info(
-    name,
-    shape_out: dict[str, Symbol],
-    inputs: Iterable[tuple[Tensor | str]],
-    orig_out: dict[str, str],
-):
-    assert isinstance(orig_out, dict)
-
-    # If no FunctionInfo instance is given, we create a dummy one from a string name
-    def derivative(i, new_edges_shape, *ts):
+class _DummyFunctionInfo(FunctionInfo):
+    def __init__(
+        self,
+        name,
+        shape_out: dict[str, Symbol],
+        inputs: Iterable[tuple[Tensor | str]],
+        orig_out: dict[str, str],
+    ):
+        # If no FunctionInfo instance is given, we create a dummy one from a string name.
+        # This is a class rather than a closure, so Functions can be pickled.
+        assert isinstance(orig_out, dict)
+        super().__init__(name=name, eval=NotImplementedError, derivative=self.derivative)
+        self.shape_out = shape_out
+        self.input_edges = [ies for _, *ies in inputs]
+        self.orig_out = orig_out
+
+    def derivative(self, i, new_edges_shape, *ts):
         # We have to use ts here, rather than the original inputs we got,
         # since the tensors may have been renamed since the function was created.
-        new_inputs = [(t, *ies) for t, (_, *ies) in zip(ts, inputs)]
+        new_inputs = [(t, *ies) for t, ies in zip(ts, self.input_edges)]
         # Test that the input edges have not been renamed
         for t, *ies in new_inputs:
             assert all(e in t.edges for e in ies), f"{t.edges=} {ies=}"
-        new_orig_out = orig_out | {e: e for e in new_edges_shape}
-        return Function(f"D_{i}{name}", shape_out | new_edges_shape, *new_inputs, orig_out=new_orig_out)
-
-    return FunctionInfo(name=name, eval=NotImplementedError, derivative=derivative)
+        new_orig_out = self.orig_out | {e: e for e in new_edges_shape}
+        return Function(
+            f"D_{i}{self.name}", self.shape_out | new_edges_shape, *new_inputs, orig_out=new_orig_out
+        )
 
 
 class Function(Tensor):
@@ -831,7 +1117,7 @@ class Function(Tensor):
         assert isinstance(self.orig_out, dict)
 
         self.fn_info = (
-            _dummy_function_info(fn_info, self.shape_out, self.inputs, self.orig_out)
+            _DummyFunctionInfo(fn_info, self.shape_out, self.inputs, self.orig_out)
             if isinstance(fn_info, str)
             else fn_info
         )
@@ -859,6 +1145,16 @@ class Function(Tensor):
                     # Save the size of the edge to _shape
                     self._shape[e] = s
 
+    def __getstate__(self) -> dict[str, Any]:
+        # edges_out is a view of shape_out, which can't be pickled
+        state = super().__getstate__()
+        del state["edges_out"]
+        return state
+
+    def __setstate__(self, state: dict[str, Any]):
+        self.__dict__.update(state)
+        self.edges_out = self.shape_out.keys()
+
     def rename(self, **kwargs: dict[str, str]):
         kwargs = self._check_rename(kwargs)
         renamed_inputs = []
@@ -877,7 +1173,8 @@ class Function(Tensor):
 
     def simplify(self, args: dict[str, Any] = None):
         args = self._check_simplify(args)
-        new_inputs = [(t.simplify(args=args), *es) for t, *es in self.inputs]
+        simplified = _simplify_all([t for t, *_ in self.inputs], args)
+        new_inputs = [(t, *es) for t, (_, *es) in zip(simplified, self.inputs)]
 
         # Broadcasting can be pulled out of the function.
         pulled_out = []
@@ -909,6 +1206,10 @@ class Function(Tensor):
         if self.fn_info.simplify is not None:
             res = self.fn_info.simplify(res, args)
 
+        if args["function_expand"] and isinstance(res, Function) and res.fn_info.expand is not None:
+            expanded = res.fn_info.expand(*[t for t, *_ in res.inputs])
+            res = expanded.rename(**{o: e for e, o in res.orig_out.items()}).simplify(args)
+
         if pulled_out:
             res = Product([res] + pulled_out)
 
@@ -921,6 +1222,17 @@ class Function(Tensor):
         new_names = self._check_grad(x, new_names)
         new_edges = set(new_names.values())
 
+        # For elementwise functions the chain rule is just a Hadamard product with the derivative.
+        # Going through dot would give the same thing, but wrapped in an extra Product.
+        if self.fn_info.elementwise:
+            ((t,),) = self.inputs
+            if not t.depends_on(x):
+                return Zero(**(self.shape | {new_names[o]: x.shape[e] for e, o in x.orig.items()}))
+            part_a = self.fn_info.derivative(0, {}, t).rename(**{o: e for e, o in self.orig_out.items()})
+            res = part_a * Derivative(t, x, new_names)
+            assert res.edges == self.edges | new_edges, f"{res.edges} != {self.edges} | {new_edges}"
+            return res
+
         # We sum over each input function, just like the normal chain rule:
         # d/dx f(g₁(x), …, gₖ(x)) = Σᵢ₌₁ᵏ (d/dx gᵢ(x)) Dᵢf(g₁(x), …, gₖ(x))
 
@@ -929,6 +1241,9 @@ class Function(Tensor):
         # clash with an existing output edge of f.
         parts = []
         for i, (t, *input_edges) in enumerate(self.inputs):
+            # Inputs that don't depend on x don't contribute to the derivative
+            if not t.depends_on(x):
+                continue
             # Take the derivative of the outer function
             # We need "connection" edges for each edge in input_edges. Mostly we could just use the same name
             # but they need to avoid clashing with "new_names" and the output edges of the tensor.
@@ -950,6 +1265,8 @@ class Function(Tensor):
 
             part = dot(part_a, part_b, connection_names.values())
             parts.append(part)
+        if not parts:
+            return Zero(**(self.shape | {new_names[o]: x.shape[e] for e, o in x.orig.items()}))
         res = Sum(parts)
         assert res.edges == self.edges | new_edges, f"{res.edges} != {self.edges} | {new_edges}"
         return res
@@ -992,12 +1309,34 @@ class Function(Tensor):
         return f"Function({', '.join(args)})"
 
     def _inner_evaluate(self, values: dict["Tensor", torch.Tensor], dims: dict[Symbol, int]) -> torch.Tensor:
+        if self.fn_info.elementwise and (res := _evaluate_fused(self, values, dims)) is not None:
+            return res
         out = self.fn_info.eval(*[t.evaluate(values, dims) for t, *_ in self.inputs])
         # After evaluation we need to rename the output edges back to their current values.
-        return out.rename(*(self.orig_out.get(e, e) for e in out.names))
+        orig_to_current = {o: e for e, o in self.orig_out.items()}
+        return out.rename(*(orig_to_current.get(e, e) for e in out.names)).align_to(*self.edges)
+
+    def _inner_cost(self, dims: dict[Symbol, int]) -> Cost:
+        inputs = [t._inner_cost(dims) for t, *_ in self.inputs]
+        size = _shape_size(self.shape)
+        # We assume each output entry reads every entry of the input edges once.
+        # For element-wise functions this is just one operation per output entry.
+        work = math.prod((_shape_size({e: t.shape[e] for e in es}) for t, *es in self.inputs), start=size)
+        flops = _sum_exprs(c.flops for c in inputs) + work
+        peak = sympy.Max(size, *(c.peak for c in inputs))
+        return Cost(flops, peak, size)
 
-    def depends_on(self, x: "Variable") -> bool:
-        return any(t.depends_on(x) for t, *_ in self.inputs)
+    @cached_property
+    def dependencies(self) -> frozenset[tuple]:
+        return frozenset().union(*(t.dependencies for t, *_ in self.inputs))
+
+    def _inner_substitute(self, replacements: dict[tuple, Tensor], memo: dict[int, Tensor]) -> Tensor:
+        inputs = [(t._substitute(replacements, memo), *es) for t, *es in self.inputs]
+        return Function(self.fn_info, self.shape_out, *inputs, orig_out=self.orig_out)
+
+    def _inner_partial_evaluate(self, keys: frozenset[tuple], fold: Callable, memo: dict[int, Tensor]) -> Tensor:
+        inputs = [(t._partial_evaluate(keys, fold, memo), *es) for t, *es in self.inputs]
+        return Function(self.fn_info, self.shape_out, *inputs, orig_out=self.orig_out)
 
 
 class Derivative(Tensor):
@@ -1026,9 +1365,25 @@ class Derivative(Tensor):
             # If grad_steps is 0, we pass the simplify through the derivative.
             res = Derivative(inner, self.x, self.new_names)
         else:
+            # The same derivative often shows up in many branches, e.g. d exp(logits)/d logits, so we cache
+            # them. Only fully pushed derivatives are cached, since the result depends on the grad_steps left.
+            # Tensors that only differ in their edge names share a cache entry.
+            cache, key = args["derivative_cache"], None
+            if cache is not None and args["grad_steps"] == float("inf"):
+                key = (_simplify_mode(args), inner, self.x)
+                if (hit := cache.get(key)) is not None:
+                    profiling.fired("Derivative.cache")
+                    cached_inner, new_names, res = hit
+                    rename = next(cached_inner.isomorphisms(inner))
+                    rename |= {e: self.new_names[o] for o, e in new_names.items()}
+                    res = res.rename(**rename)
+                    assert res.shape == self.shape, f"Shape changed from {self.shape} to {res.shape}"
+                    return res
             args["grad_steps"] -= 1
             # Have to call simplify twice to avoid an infinite loop when stacking multiple derivatives.
             res = inner.grad(self.x, self.new_names).simplify(args)
+            if key is not None:
+                cache[key] = (inner, self.new_names, res)
         assert res.shape == self.shape, f"Shape changed from {self.shape} to {res.shape}"
         return res
 
@@ -1074,8 +1429,17 @@ class Derivative(Tensor):
         # evaluations, since we need to evaluate the tensor in all directions.
         raise ValueError("Derivative tensors cannot be evaluated directly. Please use simplify() first.")
 
-    def depends_on(self, x: "Variable") -> bool:
-        return self.tensor.depends_on(x)
+    def _inner_cost(self, dims: dict[Symbol, int]) -> Cost:
+        raise ValueError("Derivative tensors have no evaluation cost. Please use simplify() first.")
+
+    @cached_property
+    def dependencies(self) -> frozenset[tuple]:
+        return self.tensor.dependencies
+
+    def _inner_substitute(self, replacements: dict[tuple, Tensor], memo: dict[int, Tensor]) -> Tensor:
+        if self.x.key in replacements:
+            raise ValueError(f"Can't substitute {self.x}, since it's the variable of a derivative. Simplify first.")
+        return Derivative(self.tensor._substitute(replacements, memo), self.x, self.new_names)
 
 
 ################################################################################
@@ -1144,18 +1508,24 @@ class Product(Tensor):
         # none of the other tensors in the product have edges that clash with these new edges.
         inner_names = {e for t in self.tensors for e in t.edges if e not in self.edges}
         new_edges = set(new_names.values()) | self.edges
-        rename = unused_edge_names(inner_names, new_edges)
-        new_prod = Product([t.rename(**rename) for t in self.tensors])
-        assert new_prod == self and new_prod.shape == self.shape, "Renaming should not change the product"
+        rename = {e: n for e, n in unused_edge_names(inner_names, new_edges).items() if e != n}
+        # Only the tensors with clashing edges need to be renamed
+        tensors = [t.rename(**rename) if rename.keys() & t.edges else t for t in self.tensors]
+        if DEBUG:
+            new_prod = Product(tensors)
+            assert new_prod == self and new_prod.shape == self.shape, "Renaming should not change the product"
         # Note: We don't have to update they keys of new_names, sinc ethey refer to variable orig_names, which never change
 
         # The classic product rule of Calculus: d/dx (f * g) = f' * g + f * g'
-        res = Sum(
-            [
-                Product(new_prod.tensors[:i] + [Derivative(t, x, new_names)] + new_prod.tensors[i + 1 :])
-                for i, t in enumerate(new_prod.tensors)
-            ]
-        )
+        # Factors that don't depend on x have derivative zero, so they don't contribute a term.
+        terms = [
+            Product(tensors[:i] + [Derivative(t, x, new_names)] + tensors[i + 1 :])
+            for i, t in enumerate(tensors)
+            if t.depends_on(x)
+        ]
+        if not terms:
+            return Zero(**(self.shape | {new_names[o]: x.shape[e] for e, o in x.orig.items()}))
+        res = Sum(terms)
         assert res.edges == self.edges | new_edges, f"{res.edges} != {self.edges} | {new_edges}"
         return res
 
@@ -1169,11 +1539,14 @@ class Product(Tensor):
     def _inner_evaluate(self, values: dict["Tensor", torch.Tensor], dims: dict[Symbol, int]) -> torch.Tensor:
         if not self.tensors:
             return torch.tensor(1.0)
+        if (res := _evaluate_fused(self, values, dims)) is not None:
+            return res
         # TODO: Keep track of how many contractions we made
         # extras["contractions"] = extras.get("contractions", 0) + len(self.contractions)
         # We use "operator" einsum interface, which doesn't require single letter names.
+        if (index := self._copy_indices()) is not None:
+            return self._evaluate_without_copies(index, values, dims)
         edge_numbers = {e: i for i, e in enumerate({e for t in self.tensors for e in t.edges})}
-        # TODO: We can make this more efficient by removing Copy tensors.
         parts = []
         for t in self.tensors:
             parts.append(t.evaluate(values, dims).rename(None))
@@ -1183,10 +1556,92 @@ class Product(Tensor):
         assert out.names == tuple(self.edges)
         return out
 
+    def _copy_indices(self) -> dict[str, str] | None:
+        """Einsum indices for the edges in the product, where all the edges of a Copy tensor share one index.
+        This way the Copy tensors don't have to be materialized, which keeps e.g. Hadamard products linear
+        in the size of the tensors. Returns None if the Copy tensors can't be removed this way, e.g. because
+        two free edges would share an index."""
+        copies = [t for t in self.tensors if isinstance(t, Copy)]
+        others = [t for t in self.tensors if not isinstance(t, Copy)]
+        if not copies or not others:
+            return None
+        ds = DisjointSets()
+        for t in self.tensors:
+            for e in t.edges:
+                ds.find(e)
+        for c in copies:
+            for e1, e2 in itertools.pairwise(c.edges):
+                ds.union(e1, e2)
+        index = {e: ds.find(e) for e in ds.parent}
+        # Einsum can't output the same index twice, or an index that isn't in any of the inputs.
+        out = [index[e] for e in self.edges]
+        if len(set(out)) != len(out) or not set(out) <= {index[e] for t in others for e in t.edges}:
+            return None
+        return index
+
+    def _evaluate_without_copies(
+        self, index: dict[str, str], values: dict["Tensor", torch.Tensor], dims: dict[Symbol, int]
+    ) -> torch.Tensor:
+        numbers = {}
+        parts = []
+        for t in self.tensors:
+            if not isinstance(t, Copy):
+                parts.append(t.evaluate(values, dims).rename(None))
+                parts.append([numbers.setdefault(index[e], len(numbers)) for e in t.edges])
+        parts.append([numbers[index[e]] for e in self.edges])
+        out = torch.einsum(*parts)
+        # Indices only used by Copy tensors, like the trace of an identity matrix, give a factor of the size.
+        # So does a Copy tensor without edges.
+        factor, seen = 1, set(numbers)
+        for t in self.tensors:
+            if isinstance(t, Copy):
+                for e in t.edges or [None]:
+                    if e is None or index[e] not in seen:
+                        factor *= dims[t.size]
+                        seen.add(index.get(e))
+        if factor != 1:
+            out = out * factor
+        return out.rename(*self.edges)
+
+    def _inner_cost(self, dims: dict[Symbol, int]) -> Cost:
+        if not self.tensors:
+            return Cost(0, 1, 1)
+        # Like in evaluation, Copy tensors are removed when possible, by identifying their edges.
+        tensors, operands, output = self.tensors, [t.shape for t in self.tensors], set(self.edges)
+        if (index := self._copy_indices()) is not None:
+            tensors = [t for t in self.tensors if not isinstance(t, Copy)]
+            operands = [{index[e]: s for e, s in t.shape.items()} for t in tensors]
+            output = {index[e] for e in self.edges}
+        children = [t._inner_cost(dims) for t in tensors]
+        flops = _sum_exprs(c.flops for c in children)
+        peak = sympy.Max(*(c.peak for c in children))
+
+        # Greedily contract the pair of operands giving the smallest intermediate, preferring pairs
+        # that actually share an edge, so we don't create needless outer products. An edge is contracted
+        # once no other operand needs it. If dims are not given, we pretend all edges have the same size.
+        def contract(i: int, j: int) -> dict[str, Symbol]:
+            keep = output.union(*(o.keys() for k, o in enumerate(operands) if k not in (i, j)))
+            return {e: s for e, s in (operands[i] | operands[j]).items() if e in keep}
+
+        while len(operands) > 1:
+            i, j = min(
+                itertools.combinations(range(len(operands)), 2),
+                key=lambda ij: (
+                    not (operands[ij[0]].keys() & operands[ij[1]].keys()),
+                    _guess_size(contract(*ij), dims),
+                ),
+            )
+            flops += _shape_size(operands[i] | operands[j])
+            out = contract(i, j)
+            peak = sympy.Max(peak, _shape_size(out))
+            operands = [o for k, o in enumerate(operands) if k not in (i, j)] + [out]
+
+        return Cost(flops, peak, _shape_size(self.shape))
+
     def simplify(self, args: dict[str, Any] = None):
         args = self._check_simplify(args)
 
-        tensors = [t.simplify(args=args) for t in self.tensors]
+        tensors = [_simplify_child(t, args) for t in self.tensors]
 
         # If any tensor in a product is 0, so is the whole product
         if any(isinstance(t, Zero) for t in tensors):
@@ -1300,8 +1755,32 @@ class Product(Tensor):
         assert edges.keys() == self.edges
         return G, edges
 
-    def depends_on(self, x: "Variable") -> bool:
-        return any(t.depends_on(x) for t in self.tensors)
+    @cached_property
+    def dependencies(self) -> frozenset[tuple]:
+        return frozenset().union(*(t.dependencies for t in self.tensors))
+
+    def _inner_substitute(self, replacements: dict[tuple, Tensor], memo: dict[int, Tensor]) -> Tensor:
+        return Product([t._substitute(replacements, memo) for t in self.tensors])
+
+    def _inner_partial_evaluate(self, keys: frozenset[tuple], fold: Callable, memo: dict[int, Tensor]) -> Tensor:
+        # The fixed factors that are contracted with each other are folded together. We don't include the
+        # Copy tensors, since folding e.g. the Copy of a Hadamard product would make a dense diagonal tensor.
+        fixed = [i for i, t in enumerate(self.tensors) if t.dependencies and t.dependencies <= keys]
+        ds = DisjointSets()
+        owners = defaultdict(list)
+        for i in fixed:
+            ds.find(i)
+            for e in self.tensors[i].edges:
+                owners[e].append(i)
+        for ids in owners.values():
+            if len(ids) == 2:
+                ds.union(*ids)
+        components = defaultdict(list)
+        for i in fixed:
+            components[ds.find(i)].append(self.tensors[i])
+        tensors = [fold(ts[0] if len(ts) == 1 else Product(ts)) for ts in components.values()]
+        tensors += [t._partial_evaluate(keys, fold, memo) for i, t in enumerate(self.tensors) if i not in fixed]
+        return Product(tensors)
 
 
 ################################################################################
@@ -1348,18 +1827,33 @@ class Sum(Tensor):
 
     def grad(self, x: Variable, new_names: Optional[dict[str, str]] = None):
         new_names = self._check_grad(x, new_names)
-        return Sum([Derivative(t, x, new_names) for t in self.tensors], self.weights)
+        # Terms that don't depend on x have derivative zero
+        ws_terms = [
+            (w, Derivative(t, x, new_names)) for w, t in zip(self.weights, self.tensors) if t.depends_on(x)
+        ]
+        if not ws_terms:
+            return Zero(**(self.shape | {new_names[o]: x.shape[e] for e, o in x.orig.items()}))
+        weights, terms = zip(*ws_terms)
+        return Sum(terms, weights)
 
     def simplify(self, args: dict[str, Any] = None):
         args = self._check_simplify(args)
 
+        terms = _simplify_all(self.tensors, args)
+
         term_counter = Counter()
-        for w, t in zip(self.weights, (t.simplify(args=args) for t in self.tensors)):
-            if args["associative_sums"] and isinstance(t, Sum):
-                for w1, t1 in zip(t.weights, t.tensors):
-                    term_counter[MatchEdgesKey(t1)] += w * w1
-            else:
-                term_counter[MatchEdgesKey(t)] += w
+        n_terms = 0
+        with profiling.timed("Sum.combine_terms"):
+            for w, t in zip(self.weights, terms):
+                if args["associative_sums"] and isinstance(t, Sum):
+                    for w1, t1 in zip(t.weights, t.tensors):
+                        term_counter[MatchEdgesKey(t1)] += w * w1
+                        n_terms += 1
+                else:
+                    term_counter[MatchEdgesKey(t)] += w
+                    n_terms += 1
+        # Each combined term counts as one application of the rule
+        profiling.fired("Sum.combine_terms", n_terms - len(term_counter))
 
         if args["sum_combine_terms"]:
             # Identify tensors with multiplicity and combine them. We use tensor.canon_with_edges to identify tensors.
@@ -1410,14 +1904,470 @@ class Sum(Tensor):
         assert edges.keys() == self.edges
         return G, edges
 
+    @property
+    def _torch_weights(self) -> list[int | float]:
+        # Torch doesn't multiply by Fractions, like the weights made by dividing a tensor by an int
+        return [float(w) if isinstance(w, Fraction) else w for w in self.weights]
+
+    @cached_property
+    def _projection(self) -> list[dict[str, str]] | None:
+        """If all the terms are renamings of the first one, like the terms made by F.symmetrize, the maps
+        from the edges of the first term to the edges of each term. Otherwise None."""
+        first = self.tensors[0]
+        if len(self.tensors) < 2 or any(t.weisfeiler_lehman != first.weisfeiler_lehman for t in self.tensors):
+            return None
+        mappings = []
+        for t in self.tensors:
+            if (mapping := next(first.isomorphisms(t), None)) is None:
+                return None
+            mappings.append(mapping)
+        return mappings
+
     def _inner_evaluate(self, values: dict["Tensor", torch.Tensor], dims: dict[Symbol, int]) -> torch.Tensor:
+        if (mappings := self._projection) is not None:
+            # We only evaluate the first term, and get the others by permuting its axes
+            value = self.tensors[0].evaluate(values, dims)
+            res = sum(
+                w * value.rename(*(m[n] for n in value.names)).align_to(*self.edges)
+                for w, m in zip(self._torch_weights, mappings)
+            )
+            assert res.names == tuple(self.edges), f"Expected {self.edges}, got {res.names}"
+            return res
+        if (res := _evaluate_fused(self, values, dims)) is not None:
+            return res
         values = [t.evaluate(values, dims).align_to(*self.edges) for t in self.tensors]
-        res = sum(w * v for w, v in zip(self.weights, values))
+        res = sum(w * v for w, v in zip(self._torch_weights, values))
         assert res.names == tuple(self.edges), f"Expected {self.edges}, got {res.names}"
         return res
 
-    def depends_on(self, x: "Variable") -> bool:
-        return any(t.depends_on(x) for t in self.tensors)
+    def _inner_cost(self, dims: dict[Symbol, int]) -> Cost:
+        children = [t._inner_cost(dims) for t in self.tensors]
+        size = _shape_size(self.shape)
+        # Each term is scaled and added into a tensor of the full (broadcasted) shape.
+        # The broadcasting itself is part of the terms, since Sum wraps them in Ones products.
+        flops = _sum_exprs(c.flops for c in children) + len(self.tensors) * size
+        peak = sympy.Max(size, *(c.peak for c in children))
+        return Cost(flops, peak, size)
+
+    @cached_property
+    def dependencies(self) -> frozenset[tuple]:
+        return frozenset().union(*(t.dependencies for t in self.tensors))
+
+    def _inner_substitute(self, replacements: dict[tuple, Tensor], memo: dict[int, Tensor]) -> Tensor:
+        return Sum([t._substitute(replacements, memo) for t in self.tensors], self.weights)
+
+    def _inner_partial_evaluate(self, keys: frozenset[tuple], fold: Callable, memo: dict[int, Tensor]) -> Tensor:
+        return Sum([t._partial_evaluate(keys, fold, memo) for t in self.tensors], self.weights)
+
+
+################################################################################
+# Elementwise fusion
+################################################################################
+
+
+class _ElementwiseProgram:
+    # Elementwise functions, sums and Hadamard products all keep the edges of their inputs, so a tree of them
+    # can be evaluated on plain torch tensors aligned to the same edge order, without creating named tensors
+    # or caching the intermediate results. Sub-expressions that aren't elementwise are the leaves, which are
+    # evaluated normally.
+
+    def __init__(self, root: Tensor):
+        self.names = tuple(root.edges)
+        # Each step produces one register: ("leaf", (tensor, names)), ("fn", eval), ("sum", weights)
+        # or ("prod", None), together with the registers it reads.
+        self.steps: list[tuple[str, Any, list[int]]] = []
+        self._memo: dict[tuple[int, tuple[str, ...]], int] = {}
+        self.out = self._build(root, self.names)
+        self.ops = sum(kind != "leaf" for kind, _, _ in self.steps)
+        # The last step reading each register, so we can free it, or overwrite it in place
+        self.last_use = {i: k for k, (_, _, inputs) in enumerate(self.steps) for i in inputs}
+        self._compiled = None
+
+    @staticmethod
+    def hadamard_factors(t: "Product") -> list[tuple[Tensor, dict[str, str]]] | None:
+        """The factors of a Hadamard product, with a map from their edges to the edges of the product.
+        That is, a product where each Copy tensor joins one edge of every factor into a free edge."""
+        copies = [u for u in t.tensors if isinstance(u, Copy)]
+        factors = [u for u in t.tensors if not isinstance(u, Copy)]
+        if len(factors) < 2 or any(u.order != len(copies) for u in factors):
+            return None
+        owner = {e: k for k, u in enumerate(factors) for e in u.edges}
+        renames = [{} for _ in factors]
+        for c in copies:
+            free = [e for e in c.edges if e in t.edges]
+            inner = [e for e in c.edges if e not in t.edges]
+            if len(free) != 1 or len(inner) != len(factors) or {owner.get(e) for e in inner} != set(range(len(factors))):
+                return None
+            for e in inner:
+                renames[owner[e]][e] = free[0]
+        if any(len(rename) != u.order for u, rename in zip(factors, renames)):
+            return None
+        return list(zip(factors, renames))
+
+    def _step(self, kind: str, arg: Any, inputs: list[int]) -> int:
+        self.steps.append((kind, arg, inputs))
+        return len(self.steps) - 1
+
+    def _build(self, t: Tensor, names: tuple[str, ...]) -> int:
+        # Shared sub-expressions are only computed once
+        key = (id(t), names)
+        if (i := self._memo.get(key)) is not None:
+            return i
+        if isinstance(t, Function) and t.fn_info.elementwise and len(t.inputs) == 1 and len(t.inputs[0]) == 1:
+            ((u,),) = t.inputs
+            i = self._step("fn", t.fn_info.eval, [self._build(u, names)])
+        elif isinstance(t, Sum) and t.tensors:
+            i = self._step("sum", t._torch_weights, [self._build(u, names) for u in t.tensors])
+        elif isinstance(t, Product) and (factors := self.hadamard_factors(t)) is not None:
+            inputs = []
+            for u, rename in factors:
+                to_u = {e: o for o, e in rename.items()}
+                inputs.append(self._build(u, tuple(to_u[e] for e in names)))
+            i = self._step("prod", None, inputs)
+        else:
+            i = self._step("leaf", (t, names), [])
+        self._memo[key] = i
+        return i
+
+    def run(self, values: dict["Tensor", torch.Tensor], dims: dict[Symbol, int]) -> torch.Tensor:
+        leaves = [
+            t.evaluate(values, dims).align_to(*names).rename(None)
+            for kind, (t, names), _ in (step for step in self.steps if step[0] == "leaf")
+        ]
+        kernel = self._kernel
+        if COMPILE_FUSED and hasattr(torch, "compile"):
+            if self._compiled is None:
+                self._compiled = torch.compile(self._kernel)
+            kernel = self._compiled
+        return kernel(*leaves).rename(*self.names)
+
+    def _kernel(self, *leaves: torch.Tensor) -> torch.Tensor:
+        leaves = iter(leaves)
+        regs: list[torch.Tensor | None] = []
+        # Registers computed by this kernel, which we are free to overwrite once nothing else reads them
+        owned = set()
+        for k, (kind, arg, inputs) in enumerate(self.steps):
+            if kind == "leaf":
+                regs.append(next(leaves))
+                continue
+            if kind == "fn":
+                res, own = arg(regs[inputs[0]]), True
+            else:
+                res, own = None, False
+                for n, i in enumerate(inputs):
+                    v = regs[i]
+                    if kind == "sum" and arg[n] != 1:
+                        v, fresh = arg[n] * v, True
+                    else:
+                        fresh = i in owned and self.last_use[i] == k and inputs.count(i) == 1
+                    if res is None:
+                        res, own = v, fresh
+                    elif own and self._can_overwrite(res, v):
+                        res = res.add_(v) if kind == "sum" else res.mul_(v)
+                    else:
+                        res, own = (res + v if kind == "sum" else res * v), True
+            regs.append(res)
+            if own:
+                owned.add(k)
+            # Free the registers we no longer need
+            for i in inputs:
+                if self.last_use[i] == k and i != self.out:
+                    regs[i] = None
+        return regs[self.out]
+
+    @staticmethod
+    def _can_overwrite(res: torch.Tensor, v: torch.Tensor) -> bool:
+        return (
+            torch.result_type(res, v) == res.dtype
+            and res.shape == torch.broadcast_shapes(res.shape, v.shape)
+            and not (torch.is_grad_enabled() and res.requires_grad)
+        )
+
+
+def _evaluate_fused(t: Tensor, values: dict["Tensor", torch.Tensor], dims: dict[Symbol, int]) -> torch.Tensor | None:
+    """Evaluate t as a fused elementwise program, if it has at least two elementwise operations."""
+    if not FUSE_ELEMENTWISE:
+        return None
+    if (program := t._fused_program) is None:
+        return None
+    return program.run(values, dims)
+
+
+################################################################################
+# Backpropagation
+################################################################################
+
+
+def grad_all(
+    expr: Tensor,
+    xs: Iterable[Variable],
+    new_names: dict[Variable, dict[str, str]] | None = None,
+) -> dict[Variable, Tensor]:
+    """
+    Take the derivative of expr with respect to each of the variables in xs in a single backward sweep.
+
+    Calling expr.grad(x) for each variable repeats the product and chain rule over the whole expression.
+    Here we instead propagate an "adjoint" from the root to the leaves, like reverse mode automatic
+    differentiation, so each node is visited once, and the gradients share the adjoints of the nodes
+    they have in common.
+
+    Args:
+        expr: The tensor to differentiate.
+        xs: The variables to take the derivatives with respect to.
+        new_names: Optional dict from each variable to the names of its new edges, like in grad.
+
+    Returns:
+        A dict from each variable to the derivative of expr with respect to it.
+        Like grad, the results are not simplified.
+    """
+    return _Backprop(expr, list(xs), {} if new_names is None else new_names).run()
+
+
+class _Backprop:
+    # The adjoint of a node u is a tensor with the free edges of expr, plus a "cotangent" edge for each
+    # free edge of u. We store it together with the dict from the edges of u to their cotangent names.
+    # The derivative of expr with respect to x is the sum of the adjoints of the occurrences of x.
+    # All cotangent names are fresh, and every tensor we combine with an adjoint gets all its free
+    # edges renamed, so the only names we have to avoid are the free edges of expr and the new names.
+
+    def __init__(self, expr: Tensor, xs: list[Variable], new_names: dict[Variable, dict[str, str]]):
+        self.expr = expr
+        self.xs = xs
+        self.new_names = [expr._check_grad(x, new_names.get(x)) for x in xs]
+        self.used = set(expr.edges) | {e for names in self.new_names for e in names.values()}
+        self.grads = [[] for _ in xs]
+
+    def run(self) -> dict[Variable, Tensor]:
+        # Count the number of times each node is used, so we know when all its adjoints have arrived.
+        # Nodes are identified by id, so sub-expressions shared by reference are only propagated once.
+        pending = Counter()
+        nodes = {}
+        stack = [self.expr]
+        while stack:
+            t = stack.pop()
+            if id(t) in nodes:
+                continue
+            nodes[id(t)] = t
+            for child in self._children(t):
+                pending[id(child)] += 1
+                stack.append(child)
+
+        cot = self._fresh(self.expr.edges)
+        adjoints = defaultdict(list)
+        adjoints[id(self.expr)].append(
+            (Product(Copy(s, e, cot[e]) for e, s in self.expr.shape.items()), cot)
+        )
+        ready = [self.expr]
+        while ready:
+            t = ready.pop()
+            adjoint, cot = self._accumulate(adjoints.pop(id(t)))
+            for child, child_adjoint in self._propagate(t, adjoint, cot):
+                adjoints[id(child)].append(child_adjoint)
+                pending[id(child)] -= 1
+                if pending[id(child)] == 0:
+                    ready.append(child)
+
+        res = {}
+        for x, names, parts in zip(self.xs, self.new_names, self.grads):
+            shape = self.expr.shape | {names[o]: x.shape[e] for e, o in x.orig.items()}
+            res[x] = Sum(parts) if len(parts) > 1 else parts[0] if parts else Zero(**shape)
+            assert res[x].shape == shape, f"{res[x].shape=} != {shape=}"
+        return res
+
+    def _relevant(self, t: Tensor) -> bool:
+        return any(t.depends_on(x) for x in self.xs)
+
+    def _children(self, t: Tensor) -> list[Tensor]:
+        if isinstance(t, (Product, Sum)):
+            children = t.tensors
+        elif isinstance(t, Function):
+            children = [u for u, *_ in t.inputs]
+        else:
+            children = []
+        return [u for u in children if self._relevant(u)]
+
+    def _fresh(self, edges: Iterable[str]) -> dict[str, str]:
+        rename = unused_edge_names(edges, self.used, suffix="_")
+        self.used |= set(rename.values())
+        return rename
+
+    @staticmethod
+    def _accumulate(adjoints: list[tuple[Tensor, dict[str, str]]]) -> tuple[Tensor, dict[str, str]]:
+        (first, cot), *rest = adjoints
+        if not rest:
+            return first, cot
+        # Rename the cotangent edges of the other adjoints to match the first one
+        terms = [first] + [a.rename(**{c: cot[e] for e, c in c2.items()}) for a, c2 in rest]
+        return Sum(terms), cot
+
+    def _propagate(self, t: Tensor, adjoint: Tensor, cot: dict[str, str]):
+        if isinstance(t, Variable):
+            for x, names, parts in zip(self.xs, self.new_names, self.grads):
+                if t == x:
+                    parts.append(adjoint.rename(**{cot[e]: names[t.orig[e]] for e in t.edges}))
+
+        elif isinstance(t, Constant):
+            pass
+
+        elif isinstance(t, Sum):
+            # The terms of a sum all have the same edges as the sum
+            for w, u in zip(t.weights, t.tensors):
+                if self._relevant(u):
+                    yield u, (adjoint if w == 1 else Sum([adjoint], [w]), cot)
+
+        elif isinstance(t, Product):
+            # The adjoint of a factor is the adjoint of the product contracted with the other factors
+            for i, u in enumerate(t.tensors):
+                if not self._relevant(u):
+                    continue
+                u_cot = {e: cot[e] if e in t.edges else None for e in u.edges}
+                u_cot |= self._fresh(e for e, c in u_cot.items() if c is None)
+                rename = {}
+                others = t.tensors[:i] + t.tensors[i + 1 :]
+                for v in others:
+                    for e in v.edges:
+                        if e in t.edges:
+                            rename[e] = cot[e]
+                        elif e in u_cot:
+                            rename[e] = u_cot[e]
+                        elif e not in rename:
+                            rename |= self._fresh([e])
+                others = [v.rename(**{e: rename[e] for e in v.edges}) for v in others]
+                yield u, (Product([adjoint] + others), u_cot)
+
+        elif isinstance(t, Function):
+            # The chain rule, like in Function.grad, but with the adjoint instead of the derivative of the input
+            for i, (u, *input_edges) in enumerate(t.inputs):
+                if not self._relevant(u):
+                    continue
+                connection_names = unused_edge_names(input_edges, t.edges, suffix="_")
+                connection_shape = {connection_names[e]: u.shape[e] for e in input_edges}
+                part_a = t.fn_info.derivative(i, connection_shape, *[v for v, *_ in t.inputs])
+                part_a = part_a.rename(**{o: e for e, o in t.orig_out.items()})
+                u_cot = self._fresh(u.edges)
+                rename = {connection_names[e]: u_cot[e] for e in input_edges}
+                copies = []
+                for e in t.edges:
+                    if e in u.edges and e not in input_edges:
+                        # Edges broadcasted from u are diagonal in the derivative, so we need a hyper-edge
+                        # connecting the adjoint, the derivative and the new cotangent edge.
+                        (hyper,) = self._fresh([e]).values()
+                        rename[e] = hyper
+                        copies.append(Copy(u.shape[e], cot[e], hyper, u_cot[e]))
+                    else:
+                        rename[e] = cot[e]
+                yield u, (Product([adjoint, part_a.rename(**rename)] + copies), u_cot)
+
+        else:
+            # Other tensors, like Derivatives, fall back to the forward derivative
+            renamed = t.rename(**cot)
+            for x, names, parts in zip(self.xs, self.new_names, self.grads):
+                if t.depends_on(x):
+                    parts.append(Product([adjoint, Derivative(renamed, x, names)]))
+
+
+def jvp(expr: Tensor, x: Variable, v: Tensor) -> Tensor:
+    """
+    The derivative of expr with respect to x, contracted with the direction v.
+
+    Unlike contracting expr.grad(x) with v, the direction is pushed through the chain rule during
+    differentiation (forward mode), so the intermediate expressions never get the new edges of x.
+
+    Args:
+        expr: The tensor to differentiate.
+        x: The variable to take the derivative with respect to.
+        v: The direction. Must have the same edges as x, and not depend on x.
+
+    Returns:
+        A tensor with the same edges as expr. Like grad, the result is not simplified.
+    """
+    if v.shape != x.shape:
+        raise ValueError(f"The direction must have the same shape as x, got {v.shape=} {x.shape=}")
+    res = _Forward(x, v).tangent(expr)
+    assert res.edges == expr.edges, f"{res.edges=} != {expr.edges=}"
+    return res
+
+
+def hvp(expr: Tensor, x: Variable, v: Tensor, new_names: Optional[dict[str, str]] = None) -> Tensor:
+    """
+    The Hessian of expr with respect to x, contracted with the direction v.
+
+    This is the gradient of jvp(expr, x, v), so only one set of new edges is ever created,
+    rather than the two sets of expr.grad(x).grad(x).
+
+    Args:
+        expr: The tensor to differentiate.
+        x: The variable to take the derivative with respect to.
+        v: The direction. Must have the same edges as x, and not depend on x.
+        new_names: Optional names for the new edges, like in grad.
+
+    Returns:
+        A tensor with the edges of expr plus the new edges. Like grad, the result is not simplified.
+    """
+    tangent = jvp(expr, x, v)
+    return grad_all(tangent, [x], None if new_names is None else {x: new_names})[x]
+
+
+class _Forward:
+    # The tangent of a node u is the derivative of u with respect to x, contracted with v.
+    # It has the same edges as u, so it can replace u directly, and no renaming is needed.
+
+    def __init__(self, x: Variable, v: Tensor):
+        self.x = x
+        self.v = v
+        self.tangents: dict[int, tuple[Tensor, Tensor]] = {}
+
+    def tangent(self, t: Tensor) -> Tensor:
+        # Sub-expressions shared by reference are only differentiated once
+        if (hit := self.tangents.get(id(t))) is not None:
+            return hit[1]
+        res = self._tangent(t)
+        assert res.edges == t.edges, f"{res.edges=} != {t.edges=}"
+        self.tangents[id(t)] = (t, res)
+        return res
+
+    def _tangent(self, t: Tensor) -> Tensor:
+        if not t.depends_on(self.x):
+            return Zero(**t.shape)
+
+        if isinstance(t, Variable):
+            # t is x, but maybe with renamed edges. We match the edges of v to t using the original names.
+            orig_to_t = {o: e for e, o in t.orig.items()}
+            return self.v.rename(**{e: orig_to_t[o] for e, o in self.x.orig.items()})
+
+        if isinstance(t, Sum):
+            return Sum([self.tangent(u) for u in t.tensors], t.weights)
+
+        if isinstance(t, Product):
+            # The product rule, where the tangent simply replaces the factor
+            return Sum(
+                [
+                    Product(t.tensors[:i] + [self.tangent(u)] + t.tensors[i + 1 :])
+                    for i, u in enumerate(t.tensors)
+                    if u.depends_on(self.x)
+                ]
+            )
+
+        if isinstance(t, Function):
+            from tensorgrad.functions import dot  # Import here to avoid circular import
+
+            # The chain rule, like in Function.grad, but contracting with the tangent of the input
+            parts = []
+            for i, (u, *input_edges) in enumerate(t.inputs):
+                if not u.depends_on(self.x):
+                    continue
+                connection_names = unused_edge_names(input_edges, t.edges, suffix="_")
+                connection_shape = {connection_names[e]: u.shape[e] for e in input_edges}
+                part_a = t.fn_info.derivative(i, connection_shape, *[w for w, *_ in t.inputs])
+                part_a = part_a.rename(**{o: e for e, o in t.orig_out.items()})
+                part_b = self.tangent(u).rename(**connection_names)
+                parts.append(dot(part_a, part_b, connection_names.values()))
+            return Sum(parts)
+
+        # Other tensors, like Derivatives, fall back to contracting the derivative with v
+        new_names = t._check_grad(self.x)
+        direction = self.v.rename(**{e: new_names[o] for e, o in self.x.orig.items()})
+        return Product([Derivative(t, self.x, new_names), direction])
 
 
 ################################################################################
@@ -1444,6 +2394,78 @@ class MatchEdgesKey:
         return self.hash
 
 
+def _simplify_all(tensors: list[Tensor], args: dict[str, Any]) -> list[Tensor]:
+    """Simplify a list of independent tensors, in parallel if args has an executor."""
+    executor = args["executor"]
+    if executor is None or len(tensors) <= 1:
+        return [_simplify_child(t, args) for t in tensors]
+    # The workers don't get the executor, so only the top level of the expression is split up.
+    # Note that each worker gets its own copy of args, so e.g. grad_steps is counted per term.
+    # The memo lives in this process, so the workers don't get it either, and they make their own
+    # derivative cache.
+    worker_args = args | {"executor": None, "memo": None}
+    worker_args.pop("derivative_cache", None)
+    return list(executor.map(_simplify_worker, tensors, [worker_args] * len(tensors)))
+
+
+def _simplify_worker(tensor: Tensor, args: dict[str, Any]) -> Tensor:
+    return tensor.simplify(args=args)
+
+
+def _simplify_child(tensor: Tensor, args: dict[str, Any]) -> Tensor:
+    """Simplify a sub-expression, reusing earlier results if args has a memo."""
+    memo = args["memo"]
+    if memo is None:
+        return tensor.simplify(args=args)
+    return memo.simplify(tensor, args)
+
+
+def _simplify_mode(args: dict[str, Any]) -> tuple:
+    """The simplify args that influence the result, as a hashable key."""
+    ignored = ("grad_steps", "executor", "memo", "derivative_cache")
+    return tuple(sorted((k, v) for k, v in args.items() if k not in ignored))
+
+
+class _SimplifyMemo:
+    # Remembers the results of simplifying sub-expressions, so repeated rounds of simplify (as in
+    # Tensor.simplify_steps) don't redo the work on the parts of the expression that didn't change.
+    # Only sub-expressions without Derivatives (or other types consuming grad_steps) are memoized,
+    # since the result of simplifying those depends on how many grad_steps are left.
+
+    def __init__(self):
+        self.by_id: dict[int, tuple[Tensor, tuple, Tensor]] = {}
+        self.by_key: dict[tuple, Tensor] = {}
+        self.settled: dict[int, tuple[Tensor, bool]] = {}
+
+    def simplify(self, tensor: Tensor, args: dict[str, Any]) -> Tensor:
+        if not self._is_settled(tensor):
+            return tensor.simplify(args=args)
+        mode = _simplify_mode(args)
+        # Results of earlier rounds are reused as is, so we can usually find them by id
+        if (hit := self.by_id.get(id(tensor))) is not None and hit[0] is tensor and hit[1] == mode:
+            return hit[2]
+        key = (mode, MatchEdgesKey(tensor))
+        if (res := self.by_key.get(key)) is None:
+            res = self.by_key[key] = tensor.simplify(args=args)
+        # Keep the tensor alive, so its id isn't reused
+        self.by_id[id(tensor)] = (tensor, mode, res)
+        return res
+
+    def _is_settled(self, tensor: Tensor) -> bool:
+        if (hit := self.settled.get(id(tensor))) is not None and hit[0] is tensor:
+            return hit[1]
+        if isinstance(tensor, (Variable, Constant)):
+            settled = True
+        elif isinstance(tensor, (Product, Sum)):
+            settled = all(self._is_settled(t) for t in tensor.tensors)
+        elif isinstance(tensor, Function):
+            settled = all(self._is_settled(t) for t, *_ in tensor.inputs)
+        else:
+            settled = False
+        self.settled[id(tensor)] = (tensor, settled)
+        return settled
+
+
 def group_edges(tensors: Iterable[Tensor]) -> dict[str, list[Tensor]]:
     """Group tensors by their edge names."""
     groups = defaultdict(list)
@@ -1453,6 +2475,25 @@ def group_edges(tensors: Iterable[Tensor]) -> dict[str, list[Tensor]]:
     return groups
 
 
+def _shape_size(shape: dict[str, Symbol]) -> sympy.Expr:
+    """The number of entries in a tensor with the given shape."""
+    return sympy.Mul(*shape.values())
+
+
+def _sum_exprs(exprs: Iterable[Any]) -> Any:
+    return sympy.Add(*exprs)
+
+
+def _guess_size(shape: dict[str, Symbol], dims: dict[Symbol, int], default: int = 10) -> float:
+    """Numerical size of a shape, using default for sizes not in dims."""
+    return math.prod(dims.get(s, default) if isinstance(s, Symbol) else s for s in shape.values())
+
+
+def _subs_dims(value: Any, dims: dict[Symbol, int]) -> Any:
+    value = sympy.sympify(value).subs(dims)
+    return int(value) if value.is_Integer else value
+
+
 def add_structural_graph(G, tensor, root_edge_label=None):
     """Computes the structural graph of tensor, and unions it with G."""
     # We assert that Gx has nodes named [0, Gx.number_of_nodes())
@@ -0,0 +1,101 @@
+from sympy import symbols
+from tensorgrad import Variable, Derivative, Product, grad_all, hvp, jvp
+import tensorgrad.functions as F
+from tensorgrad.testutils import assert_close, rand_values
+
+
+def assert_grads_match(expr, xs, dims, constants=(), direct=True):
+    grads = grad_all(expr, xs)
+    ts = rand_values(list(xs) + list(constants), dims)
+    for x in xs:
+        expected = expr.grad(x).full_simplify().evaluate(ts.copy())
+        assert grads[x].edges == expr.grad(x).edges
+        # Without Derivatives in the expression, the gradients can be evaluated without simplifying
+        if direct:
+            assert_close(grads[x].evaluate(ts.copy()), expected, rtol=1e-3, atol=1e-3)
+        assert_close(grads[x].full_simplify().evaluate(ts.copy()), expected, rtol=1e-3, atol=1e-3)
+
+
+def test_mlp():
+    batch, i, h, o = symbols("batch i h o")
+    X = Variable("X", batch, i)
+    W1 = Variable("W1", i, h)
+    W2 = Variable("W2", h, o)
+    T = Variable("T", batch, o)
+    out = F.relu(X @ W1) @ W2
+    loss = F.frobenius2(out - T)
+    assert_grads_match(loss, [W1, W2, X], {batch: 3, i: 2, h: 4, o: 2}, constants=[T])
+
+
+def test_jacobian():
+    # Non-scalar expressions keep their edges, and functions broadcast over them
+    i, j = symbols("i j")
+    x = Variable("x", i)
+    A = Variable("A", i, j)
+    expr = F.exp(A @ x) * F.exp(x @ A)
+    assert_grads_match(expr, [x, A], {i: 2, j: 3})
+
+
+def test_multiple_inputs():
+    C = symbols("C")
+    logits = Variable("logits", C)
+    target = Variable("target", C)
+    expr = F.cross_entropy(logits, target, ["C"])
+    assert_grads_match(expr, [logits, target], {C: 3})
+
+
+def test_shared_subexpression():
+    i = symbols("i")
+    x = Variable("x", i)
+    y = Variable("y", i)
+    A = Variable("A", i, j=i)
+    h = F.exp(x) * y
+    # h is used twice, so its adjoints are summed before being propagated further
+    expr = F.exp(h) + h
+    assert expr.tensors[0].inputs[0][0] is expr.tensors[1]
+    assert_grads_match(expr, [x, y], {i: 3})
+    expr = h @ h.rename(i="j") @ A
+    assert grad_all(expr, [x, y])[x].edges == {"i_"}
+    assert_grads_match(expr, [x, y, A], {i: 3})
+
+
+def test_derivative_and_unused():
+    i = symbols("i")
+    x = Variable("x", i)
+    y = Variable("y", i)
+    z = Variable("z", i)
+    # Derivatives inside the expression fall back to forward differentiation
+    expr = Derivative(F.frobenius2(F.exp(x)), x) @ y
+    grads = grad_all(expr, [x, y, z], new_names={z: {"i": "k"}})
+    assert grads[z].edges == expr.edges | {"k"}
+    assert grads[z].full_simplify() == grads[z]
+    assert_grads_match(expr, [x, y], {i: 3}, direct=False)
+
+
+def test_jvp():
+    i, j = symbols("i j")
+    x = Variable("x", i)
+    A = Variable("A", i, j)
+    v = Variable("v", i)
+    expr = F.softmax(A @ F.exp(x), ["j"]) * F.frobenius2(x)
+    res = jvp(expr, x, v)
+    assert res.edges == expr.edges
+    expected = Product([expr.grad(x, {"i": "k"}), v.rename(i="k")])
+    ts = rand_values([x, A, v], {i: 3, j: 2})
+    assert_close(res.evaluate(ts.copy()), expected.full_simplify().evaluate(ts.copy()), rtol=1e-3, atol=1e-3)
+
+
+def test_hvp():
+    i = symbols("i")
+    x = Variable("x", i)
+    A = Variable("A", i, j=i)
+    v = Variable("v", i)
+    expr = F.frobenius2(F.exp(A @ x))
+    res = hvp(expr, x, v, {"i": "k"})
+    assert res.edges == {"k"}
+    hessian = expr.grad(x, {"i": "k"}).grad(x, {"i": "l"})
+    expected = Product([hessian, v.rename(i="l")])
+    ts = rand_values([x, A, v], {i: 3})
+    expected = expected.full_simplify().evaluate(ts.copy())
+    assert_close(res.evaluate(ts.copy()), expected, rtol=1e-3, atol=1e-3)
+    assert_close(res.full_simplify().evaluate(ts.copy()), expected, rtol=1e-3, atol=1e-3)
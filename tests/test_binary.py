@@ -0,0 +1,92 @@
+import io
+import pickle
+import pytest
+from sympy import symbols
+import torch
+from tensorgrad import Variable, Function, Derivative, Sum
+from tensorgrad.tensor import FunctionInfo
+import tensorgrad.functions as F
+from tensorgrad.serializers import binary
+from tensorgrad.testutils import assert_close, rand_values
+
+
+def test_roundtrip():
+    i, j = symbols("i j")
+    X = Variable("X", i, j)
+    y = Variable("y", j)
+    S = Variable("S", i, i2=i).with_symmetries("i i2")
+    expr = F.sum(F.exp(X @ y) + F.log(F.abs(X @ y)) - F.relu(X @ y) * F.gt0(X @ y) / 3, ["i"])
+    expr = expr + F.sum(Function("f", {"k": i}, (X, "i")), ["k"]) @ F.sqrt(F.pow(y, 2))
+    expr = expr + F.trace(S) * 0.5
+    res = binary.loads(binary.dumps(expr))
+    assert res == expr
+
+    ts = rand_values([X, y], {i: 2, j: 3})
+    ts[X] = ts[X].abs()
+    ts[S] = rand_values([S], {i: 2})[S]
+    no_f = F.sum(F.exp(X @ y) + F.trace(S), ["i"])
+    assert_close(binary.loads(binary.dumps(no_f)).evaluate(ts.copy()), no_f.evaluate(ts.copy()))
+
+
+def test_derivative_roundtrip():
+    C = symbols("C")
+    logits = Variable("logits", C)
+    target = Variable("target", C)
+    expr = Derivative(F.cross_entropy(logits, target, ["C"]), logits)
+    fp = io.BytesIO()
+    binary.dump(expr, fp)
+    fp.seek(0)
+    res = binary.load(fp)
+    assert res.full_simplify() == expr.full_simplify()
+
+
+def test_sharing():
+    # Equal sub-expressions are stored once, even if they are distinct objects
+    i = symbols("i")
+    x = Variable("x", i)
+    expr = Sum([F.exp(x) @ F.log(x) for _ in range(30)])
+    data = binary.dumps(expr)
+    assert len(data) < len(pickle.dumps(expr)) / 10
+    table = binary.ExpressionTable(data)
+    assert len(table.nodes) == 5
+    assert binary.loads(data) == expr
+
+
+def test_function_info_roundtrip():
+    # FunctionInfos with arguments are stored by name, together with their arguments
+    i, j, k = symbols("i j k")
+    X = Variable("X", i, j)
+    Y = Variable("Y", i, j)
+    A = Variable("A", i, j=i)
+    b = Variable("b", i)
+    exprs = [
+        F.softmax(X, ["i"]),
+        F.log_softmax(X, ["j"]),
+        F.logsumexp(X, ["i", "j"]),
+        F.cross_entropy(X, F.softmax(Y, ["i"]), ["i"]),
+        F.max(X, "i"),
+        F.argmax(X, "j"),
+        F.topk(X, "j", 2, k),
+        F.pow(F.exp(X), -2),
+        F.inverse(A, ["i", "j"]),
+        F.logdet(A, ["i", "j"]),
+        F.solve(A, b, ["i", "j"]),
+    ]
+    ts = rand_values([X, Y, b], {i: 3, j: 4})
+    ts[A] = torch.randn(3, 3, names=("i", "j")) + 3 * torch.eye(3)
+    for expr in exprs:
+        res = binary.loads(binary.dumps(expr))
+        assert res == expr
+        assert_close(res.evaluate(ts.copy()), expr.evaluate(ts.copy()))
+
+
+def test_function_info_not_registered():
+    i = symbols("i")
+    x = Variable("x", i)
+    custom = Function(FunctionInfo("custom", eval=lambda t: 2 * t), [], (x,))
+    with pytest.raises(ValueError):
+        binary.dumps(custom)
+    # Loading only creates the registered function infos
+    data = binary.dumps(F.softmax(x, ["i"])).replace(b"softmax", b"softmaz")
+    with pytest.raises(ValueError):
+        binary.loads(data)
@@ -0,0 +1,74 @@
+import pytest
+from sympy import symbols
+from tensorgrad import Variable, Copy, Derivative, Product
+import tensorgrad.functions as F
+from tensorgrad.tensor import Cost
+
+
+def test_variable_cost():
+    i, j = symbols("i j")
+    A = Variable("A", i, j)
+    assert A.cost() == Cost(0, i * j, i * j)
+    assert A.cost({i: 2, j: 3}) == Cost(0, 6, 6)
+
+
+def test_matmul_cost():
+    i, j, k = symbols("i j k")
+    A = Variable("A", i, j)
+    B = Variable("B", j, k)
+    cost = (A @ B).cost()
+    assert cost.flops == i * j * k
+    assert cost.size == i * k
+    assert (A @ B).cost({i: 2, j: 3, k: 4}) == Cost(24, 12, 8)
+
+
+def test_contraction_order():
+    # A (i x j) @ B (j x k) @ x (k) should contract B and x first when j, k are large
+    i, j, k = symbols("i j k")
+    A = Variable("A", i, j)
+    B = Variable("B", j, k)
+    x = Variable("x", k)
+    expr = Product([A, B, x])
+    dims = {i: 10, j: 100, k: 100}
+    assert expr.cost(dims).flops == 100 * 100 + 10 * 100
+    assert expr.cost(dims).peak == 100 * 100
+
+
+def test_sum_broadcast_cost():
+    i, j = symbols("i j")
+    A = Variable("A", i, j)
+    a = Variable("a", i)
+    cost = (A + a).cost({i: 2, j: 3})
+    # The broadcasted a costs 6 flops (outer product with Ones), the sum 2 * 6.
+    assert cost.size == 6
+    assert cost.flops == 6 + 2 * 6
+
+
+def test_function_cost():
+    i = symbols("i")
+    x = Variable("x", i)
+    assert F.exp(x).cost() == Cost(i, i, i)
+    assert F.exp(F.exp(x)).cost({i: 5}).flops == 10
+
+
+def test_copy_cost():
+    i = symbols("i")
+    assert Copy(i).cost() == Cost(0, 1, 1)
+    assert Copy(i, "a, b").cost({i: 3}).size == 9
+
+
+def test_derivative_cost():
+    i = symbols("i")
+    x = Variable("x", i)
+    with pytest.raises(ValueError):
+        Derivative(F.exp(x), x).cost()
+    assert Derivative(F.exp(x), x).simplify().cost({i: 3}).size == 9
+
+
+def test_hadamard_cost():
+    # Copy tensors are removed by identifying their edges, so Hadamard products stay linear in the size
+    i, j = symbols("i j")
+    X = Variable("X", i, j)
+    cost = (F.exp(X) * F.relu(X)).cost({i: 10, j: 20})
+    assert cost.flops == 200 + 200 + 200
+    assert cost.peak == 200
@@ -0,0 +1,63 @@
+from sympy import symbols
+from tensorgrad import Variable
+from tensorgrad.tensor import Product, Sum
+import tensorgrad.functions as F
+from tensorgrad.egraph import RULES, Saturation, estimated_cost, saturate_simplify
+from tensorgrad.testutils import assert_close, rand_values
+
+
+def test_avoid_expansion():
+    # full_simplify expands A B (x + y) into A B x + A B y, which doubles the work
+    i, j, k = symbols("i j k")
+    A = Variable("A", i, j)
+    B = Variable("B", j, k)
+    x = Variable("x", k)
+    y = Variable("y", k)
+    expr = A @ B @ (x + y)
+    dims = {i: 10, j: 100, k: 100}
+    res = saturate_simplify(expr, dims=dims)
+    assert estimated_cost(res, dims) < estimated_cost(expr.full_simplify(), dims)
+
+    ts = rand_values([A, B, x, y], {i: 2, j: 3, k: 4})
+    assert_close(res.evaluate(ts.copy()), expr.evaluate(ts.copy()))
+
+
+def test_gradient():
+    C = symbols("C")
+    logits = Variable("logits", C)
+    target = Variable("target", C)
+    expr = F.cross_entropy(logits, target, ["C"]).grad(logits)
+    res = saturate_simplify(expr)
+    assert res.edges == expr.edges
+    assert estimated_cost(res, {}) <= estimated_cost(expr.full_simplify(), {})
+
+    ts = rand_values([logits, target], {C: 3})
+    assert_close(res.evaluate(ts.copy()), expr.full_simplify().evaluate(ts.copy()))
+
+
+def test_budget():
+    i = symbols("i")
+    x = Variable("x", i)
+    expr = F.exp(x) * F.exp(x) * F.pow(F.exp(x), -1)
+    saturation = Saturation(max_nodes=2)
+    assert len(saturation.saturate(expr)) <= 2
+
+
+def test_individual_rules():
+    # Without the greedy simplify, the forms are found one rewrite at a time
+    i, j, k = symbols("i j k")
+    A = Variable("A", i, j)
+    B = Variable("B", j, k)
+    x = Variable("x", k)
+    y = Variable("y", k)
+    expr = A @ (B @ (x + y))
+    saturation = Saturation(rules=[(name, rule) for name, rule in RULES if name != "simplify"])
+    forms = list(saturation.saturate(expr))
+    # Flattening the products without distributing, and then distributing over the sum
+    assert any(isinstance(f, Product) and len(f.tensors) == 3 for f in forms)
+    assert any(isinstance(f, Sum) and len(f.tensors) == 2 for f in forms)
+
+    ts = rand_values([A, B, x, y], {i: 2, j: 3, k: 4})
+    expected = expr.evaluate(ts.copy())
+    for form in forms:
+        assert_close(form.evaluate(ts.copy()), expected)
@@ -13,6 +13,7 @@ from tensorgrad.tensor import (
     Variable,
     Zero,
 )
+from tensorgrad import tensor
 import tensorgrad.functions as F
 from tensorgrad.testutils import assert_close, random_tensor_expr, rand_values
 
@@ -190,6 +191,71 @@ def test_trace_square():
     assert_close(result, expected)
 
 
+def test_product_without_copies():
+    i, j = symbols("i j")
+    a = Variable("a", i, j)
+    b = Variable("b", i, j)
+    ts = rand_values([a, b], {i: 3, j: 4})
+    ta, tb = ts[a].rename(None), ts[b].rename(None)
+    # Hadamard product
+    assert_close((a * b).evaluate(ts.copy()), (ta * tb).rename("i", "j"))
+    # Diagonal, with a loop of Copy tensors that only contributes a factor of the size
+    copies = [Copy(i, "i, k"), Copy(j, "j, l"), Copy(j, "l, m"), Copy(j, "m, j2"), Copy(i, "x"), Copy(i, "x")]
+    expr = Product([a] + copies)
+    assert expr.edges == {"k", "j2"}
+    assert_close(expr.evaluate(ts.copy()), 3 * ta.rename("k", "j2"))
+    # Two free edges on the same Copy can't be done without the Copy tensor
+    expr = Product([a.rename(i="k"), Copy(i, "i, i2")])
+    expected = torch.einsum("kj,il->kjil", ta, torch.eye(3)).rename("k", "j", "i", "i2")
+    assert_close(expr.evaluate(ts.copy()), expected)
+
+
+@pytest.mark.parametrize("fuse", [True, False])
+def test_elementwise_fusion(fuse, monkeypatch):
+    monkeypatch.setattr(tensor, "FUSE_ELEMENTWISE", fuse)
+    i, j = symbols("i j")
+    x = Variable("x", i, j)
+    y = Variable("y", j, i)
+    ts = rand_values([x, y], {i: 3, j: 4})
+    tx, ty = ts[x].rename(None), ts[y].rename(None).T
+    expr = F.pow(F.exp(x) + 1, -1) * F.relu(x) * F.gt0(y) - 2 * F.exp(x)
+    values = ts.copy()
+    res = expr.simplify().evaluate(values)
+    expected = 1 / (tx.exp() + 1) * tx.relu() * (ty > 0) - 2 * tx.exp()
+    assert_close(res, expected.rename("i", "j"))
+    # The inputs are never overwritten, and the fused intermediate results aren't cached
+    assert_close(values[x], ts[x])
+    assert any(isinstance(t, Function) for t in values) != fuse
+
+
+def test_fusion_program():
+    i = symbols("i")
+    x = Variable("x", i)
+    # exp(x) is shared, so it's only computed once
+    e = F.exp(x)
+    program = tensor._ElementwiseProgram(F.pow(F.relu(e) + e, 2))
+    assert program.ops == 4
+    assert [kind for kind, _, _ in program.steps].count("leaf") == 1
+
+
+def test_fusion_program_cached(monkeypatch):
+    # The program, and its compiled kernel, are built once per tensor, not once per evaluation
+    compiled = []
+    monkeypatch.setattr(tensor, "COMPILE_FUSED", True)
+    monkeypatch.setattr(torch, "compile", lambda fn: compiled.append(fn) or fn, raising=False)
+    i = symbols("i")
+    x = Variable("x", i)
+    expr = F.pow(F.relu(x) + F.exp(x), 2)
+    program = expr._fused_program
+    for _ in range(3):
+        ts = rand_values([x], {i: 3})
+        assert_close(expr.evaluate(ts), (ts[x].relu() + ts[x].exp()) ** 2)
+    assert expr._fused_program is program
+    assert len(compiled) == 1
+    # Products without elementwise operations have no program
+    assert (x @ x)._fused_program is None
+
+
 def test_trace_rectangular():
     i, j = symbols("i j")
     a = Variable("a", i, j)
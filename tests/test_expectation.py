@@ -1,4 +1,5 @@
 import itertools
+import pytest
 from sympy import symbols
 import torch
 from einops import einsum
@@ -249,3 +250,95 @@ def test_strassen():
             Copy(p),
         ]
     )
+
+
+def test_isserlis():
+    n = symbols("n")
+    x = Variable("x", i=n)
+    # E[|x|^6] = n (n + 2) (n + 4) for a standard normal x
+    norm2 = x @ x
+    expr = Expectation(norm2 @ norm2 @ norm2, x)
+    # The 15 pairings of the six occurrences of x only give 3 distinct terms
+    assert len(expr._isserlis(expr.tensor.simplify({"combine_products": False})).tensors) == 3
+    res = expr.full_simplify().evaluate({}, {n: 3})
+    assert res.item() == 3 * 5 * 7
+
+    # Fourth moment with a general covariance and mean
+    Sh = Variable("Sh", i=n, r=n)
+    covar = Sh @ Sh.rename(i="j")
+    mu = Variable("mu", i=n)
+    outer = Product([x.rename(i=e) for e in "abcd"])
+    expr = Expectation(outer, x, mu, covar, {"i": "j"}).full_simplify()
+    ts = rand_values([Sh, mu], {n: 3})
+    tSh, tm = ts[Sh].rename(None), ts[mu].rename(None)
+    tS = tSh @ tSh.T
+    # The sum over all ways of splitting the edges into covariance pairs and means
+    expected = torch.einsum("a,b,c,d->abcd", tm, tm, tm, tm)
+    for p, q in ["ab", "cd"], ["ac", "bd"], ["ad", "bc"]:
+        expected += torch.einsum(f"{p},{q}->abcd", tS, tS)
+    for p in itertools.combinations("abcd", 2):
+        r, s = (e for e in "abcd" if e not in p)
+        expected += torch.einsum(f"{''.join(p)},{r},{s}->abcd", tS, tm, tm)
+    assert_close(expr.evaluate(ts.copy()), expected.rename("a", "b", "c", "d"))
+
+
+@pytest.mark.parametrize("antithetic", [False, True])
+def test_monte_carlo(antithetic):
+    sampling = {"samples": 40_000, "chunk_size": 3_000, "antithetic": antithetic}
+    torch.manual_seed(0)
+    i, k = symbols("i k")
+    x = Variable("x", i)
+    a = Variable("a", i, k)
+    mu = Variable("mu", i)
+    Sh = Variable("Sh", i, r=i)
+    covar = Sh @ Sh.rename(i="j")
+    ts = rand_values([a, mu, Sh], {i: 3, k: 2})
+    ts[Sh] = ts[Sh] / 3
+    ta, tm, tSh = (ts[v].rename(None) for v in [a, mu, Sh])
+    tS = tSh @ tSh.T
+
+    # E[exp(a^T x)] = exp(a^T mu + a^T S a / 2), which simplify can't find
+    res = Expectation(F.exp(a @ x), x, mu, covar, {"i": "j"}, **sampling).evaluate(ts.copy())
+    expected = torch.exp(ta.T @ tm + torch.einsum("ik,ij,jk->k", ta, tS, ta) / 2)
+    assert_close(res, expected.rename("k"), rtol=0.05, atol=0.05)
+
+    # The sampled and the closed form quartic moments agree
+    quartic = Product([x.rename(i=e) for e in "abcd"])
+    sampled = Expectation(quartic, x, mu, covar, {"i": "j"}, **sampling).evaluate(ts.copy())
+    exact = Expectation(quartic, x, mu, covar, {"i": "j"}).full_simplify().evaluate(ts.copy())
+    assert_close(sampled, exact, rtol=0.1, atol=0.1)
+
+    # The options are per expectation, so differently sampled expectations don't share cached values
+    values = ts.copy()
+    mu.evaluate(values), covar.evaluate(values)
+    before = len(values)
+    few = Expectation(F.exp(a @ x), x, mu, covar, {"i": "j"}, samples=2)
+    assert few != Expectation(F.exp(a @ x), x, mu, covar, {"i": "j"}, **sampling)
+    # exp(a) doesn't depend on the samples, so it's only computed once, but not added to the values
+    few = Expectation(F.exp(a @ x) @ F.exp(a), x, mu, covar, {"i": "j"}, samples=2, chunk_size=1)
+    few.evaluate(values)
+    # Only the expectation itself is added to the values, not the intermediate values of the chunks
+    assert len(values) == before + 1
+    res = Expectation(F.exp(a @ x), x, mu, covar, {"i": "j"}, **sampling).evaluate(values)
+    assert_close(res, expected.rename("k"), rtol=0.05, atol=0.05)
+
+
+def test_monte_carlo_grad():
+    # The gradient of a sampled expectation uses the same mean and covariance
+    torch.manual_seed(0)
+    i = symbols("i")
+    x = Variable("x", i)
+    a = Variable("a", i)
+    mu = Variable("mu", i)
+    Sh = Variable("Sh", i, r=i)
+    covar = Sh @ Sh.rename(i="j")
+    ts = rand_values([a, mu, Sh], {i: 3})
+    ts[Sh] = ts[Sh] / 3
+    ta, tm, tSh = (ts[v].rename(None) for v in [a, mu, Sh])
+    tS = tSh @ tSh.T
+
+    # d/da E[exp(a^T x)] = E[x exp(a^T x)] = exp(a^T mu + a^T S a / 2) (mu + S a)
+    expr = Expectation(F.exp(a @ x), x, mu, covar, {"i": "j"}, samples=40_000, chunk_size=4_000)
+    res = expr.grad(a).simplify().evaluate(ts.copy())
+    expected = torch.exp(ta @ tm + ta @ tS @ ta / 2) * (tm + tS @ ta)
+    assert_close(res, expected.rename("i_"), rtol=0.05, atol=0.05)
@@ -1,11 +1,12 @@
+import itertools
 import pytest
 import torch
 from torch.autograd.functional import jacobian, hessian
 import torch.nn.functional as tF
 from sympy import symbols
-from tensorgrad import Variable, Function
+from tensorgrad import Variable, Function, Ones
 import tensorgrad.functions as F
-from tensorgrad.tensor import Copy, Tensor
+from tensorgrad.tensor import Copy, Product, Tensor, Zero
 from tensorgrad.testutils import rand_values, assert_close
 
 
@@ -149,6 +150,28 @@ def test_pow_cancel_3():
     assert expr.full_simplify() == F.pow(ST, 2)
 
 
+def test_pow_cancel_copy():
+    # The pow of a Copy is the Copy, unless the exponents cancel, in which case it's ones
+    i = symbols("i")
+    c = Copy(i, "i, j")
+    for k, expected in [(-2, Ones(i, j=i)), (-1, c)]:
+        expr = F.pow(c, 2) * F.pow(c, k)
+        # Combine the powers directly, since simplify would first replace the pows of the Copy by the Copy
+        res = Product(F.PowFunctionInfo.simplify_outer(expr.tensors, Tensor._check_simplify()))
+        assert res.full_simplify() == expected
+        assert_close(res.evaluate({}, {i: 3}), expected.evaluate({}, {i: 3}))
+
+
+def test_pow_cancel_chain():
+    # x0 * x1^-1 * x0 * x2^-1 * x1 * ... telescopes into x0^2 * x_{n-1}^-1
+    i = symbols("i")
+    xs = [Variable(f"x{k}", i) for k in range(12)]
+    expr = xs[0]
+    for k in range(1, len(xs)):
+        expr = expr * F.pow(xs[k], -1) * xs[k - 1]
+    assert expr.full_simplify() == (F.pow(xs[0], 2) * F.pow(xs[-1], -1)).full_simplify()
+
+
 def test_log():
     i, j = symbols("i j")
     a = Variable("a", i=i, j=j)
@@ -312,6 +335,58 @@ def test_ce_hess():
             assert_close(my_hessians[i][j], torch_hessians[i][j].rename("C_", "C__"))
 
 
+def test_softmax_stable():
+    # The fused softmax doesn't overflow for large logits, unlike exp(t) / sum(exp(t))
+    i, j = symbols("i j")
+    A = Variable("A", i, j)
+    ts = {A: 100 * torch.randn(3, 4, names=("i", "j"))}
+    assert_close(F.softmax(A, ["i"]).evaluate(ts.copy()), ts[A].rename(None).softmax(dim=0).rename("i", "j"))
+    assert_close(
+        F.log_softmax(A, ["i", "j"]).evaluate(ts.copy()),
+        ts[A].rename(None).flatten().log_softmax(dim=0).reshape(3, 4).rename("i", "j"),
+    )
+    assert_close(F.logsumexp(A, ["j"]).evaluate(ts.copy()), ts[A].rename(None).logsumexp(dim=1).rename("i"))
+
+
+@pytest.mark.parametrize("name", ["softmax", "log_softmax", "logsumexp"])
+def test_softmax_family_jac(name):
+    i, j = symbols("i j")
+    A = Variable("A", i, j)
+    ts = rand_values([A], {i: 3, j: 2})
+    expr = getattr(F, name)(A, ["i"])
+    res = expr.grad(A).simplify().evaluate(ts.copy())
+    torch_fn = {"softmax": torch.softmax, "log_softmax": torch.log_softmax, "logsumexp": torch.logsumexp}[name]
+    expected = jacobian(lambda A: torch_fn(A, 0), ts[A].rename(None))
+    assert_close(res, expected.rename(*expr.edges, "i_", "j_"))
+
+
+def test_function_expand():
+    i, j = symbols("i j")
+    A = Variable("A", i, j)
+    expr = F.softmax(A, ["i"]).rename(i="k")
+    expanded = expr.simplify({"function_expand": True})
+    assert "softmax" not in repr(expanded)
+    assert expanded.edges == expr.edges
+    ts = rand_values([A], {i: 3, j: 2})
+    assert_close(expanded.evaluate(ts.copy()), expr.evaluate(ts.copy()))
+
+
+def test_ce_batch_grad():
+    N, C = symbols("N C")
+    logits = Variable("logits", N, C)
+    target = Variable("target", N, C)
+    ts = rand_values([logits, target], {N: 2, C: 3})
+    ce = F.cross_entropy(logits, target, ["C"])
+    assert isinstance(ce, Function) and ce.edges == {"N"}
+    for x, i in [(logits, 0), (target, 1)]:
+        res = ce.grad(x).simplify().evaluate(ts.copy())
+        expected = jacobian(
+            lambda x, y: tF.cross_entropy(x, y, reduction="none"),
+            (ts[logits].rename(None), ts[target].rename(None)),
+        )[i]
+        assert_close(res, expected.rename("N", "N_", "C_"))
+
+
 def test_pow_hess():
     i = symbols("i")
     x = Variable("x", i=i)
@@ -440,26 +515,172 @@ def test_max(keepdim):
     tX = ts[X].rename(None)
 
     for dims in [(), ["i"], ["j"], ["i", "j"]]:
-        res = F.max(X, dims, keepdim=keepdim).evaluate(ts)
-        adims = tuple(ts[X].names.index(d) for d in dims)
-        expected = tX.amax(adims, keepdim=keepdim)
-        names = ts[X].names if keepdim else tuple(n for n in ts[X].names if n not in dims)
         # Note that dims == () is the same as dims == ("i", "j") in torch.amax.
-        expected = expected if dims == () else expected.rename(*names)
-        assert_close(res, expected)
+        adims = tuple(ts[X].names.index(d) for d in dims) or (0, 1)
 
-    res = F.max(X, keepdim=keepdim).grad(X).simplify().evaluate(ts)
-    expected = (tX == tX.amax()).float()
-    assert_close(res, expected)
+        def torch_max(x):
+            res = x.amax(adims, keepdim=keepdim)
+            return res.expand(x.shape) if keepdim else res
 
-    res = F.max(X, "i", keepdim=keepdim).grad(X).simplify().evaluate(ts)
-    expected = (tX == tX.amax(dim=0).values).float()
-    assert_close(res, expected)
+        names = ts[X].names if keepdim else tuple(n for n in ts[X].names if n not in (dims or ["i", "j"]))
+        expr = F.max(X, dims, keepdim=keepdim)
+        assert_close(expr.evaluate(ts.copy()), torch_max(tX).rename(*names))
 
-    res = F.max(X, "j", keepdim=keepdim).grad(X).simplify().evaluate(ts)
-    expected = (tX == tX.amax(dim=1).values[:, None]).float()
-    assert_close(res, expected)
+        res = expr.grad(X, {"i": "di", "j": "dj"}).simplify().evaluate(ts.copy())
+        expected = jacobian(torch_max, tX)
+        assert_close(res, expected.rename(*names, "di", "dj"))
+
+
+def test_argmax():
+    i, j, k = symbols("i j k")
+    X = Variable("X", i, j, k)
+    ts = rand_values([X], {i: 2, j: 3, k: 4})
+    tX = ts[X].rename(None)
+    res = F.argmax(X, ["j", "k"]).evaluate(ts.copy())
+    expected = (tX == tX.amax((1, 2), keepdim=True)).float()
+    assert_close(res, expected.rename("i", "j", "k"))
+    # The one-hot mask is piecewise constant
+    assert F.argmax(X, "j").grad(X).simplify() == Zero(i, j, k, i_=i, j_=j, k_=k)
 
-    res = F.max(X, ("i", "j"), keepdim=keepdim).grad(X).simplify().evaluate(ts)
-    expected = torch.ones_like(tX)
+
+def test_topk():
+    i, j, k = symbols("i j k")
+    X = Variable("X", i, j)
+    ts = rand_values([X], {i: 3, j: 5})
+    tX = ts[X].rename(None)
+    expr = F.topk(X, "j", 2, k)
+    assert expr.edges == {"i", "k"}
+    assert_close(expr.evaluate(ts.copy()), tX.topk(2, 1).values.rename("i", "k"))
+
+    jac = expr.grad(X).simplify()
+    # The derivative is a one-hot mask, not a dense Jacobian
+    assert "topk_mask" in repr(jac)
+    expected = jacobian(lambda x: x.topk(2, 1).values, tX)
+    assert_close(jac.evaluate(ts.copy()), expected.rename("i", "k", "i_", "j_"))
+
+    # Top-k over several edges
+    res = F.topk(X, ["i", "j"], 3, k).evaluate(ts.copy())
+    assert_close(res, tX.flatten().topk(3).values.rename("k"))
+
+
+def test_max_pool_grad():
+    # Hard attention: pick the value at the position with the largest score
+    n, d = symbols("n d")
+    scores = Variable("scores", n)
+    values = Variable("values", n, d)
+    expr = F.argmax(scores, "n") @ values + F.max(values, "n")
+    ts = rand_values([scores, values], {n: 5, d: 3})
+    res = expr.grad(values).simplify().evaluate(ts.copy())
+    tS, tV = ts[scores].rename(None), ts[values].rename(None)
+    expected = jacobian(lambda v: v[tS.argmax()] + v.amax(0), tV)
+    assert_close(res, expected.rename("d", "n_", "d_"))
+
+
+def test_inverse():
+    b, n = symbols("b n")
+    X = Variable("X", b, i=n, j=n)
+    ts = {X: torch.randn(2, 3, 3, names=("b", "i", "j")) + 3 * torch.eye(3)}
+    res = F.inverse(X, ["i", "j"]).evaluate(ts.copy())
+    # The roles of i and j are swapped in the inverse
+    assert_close(res, torch.linalg.inv(ts[X].rename(None)).rename("b", "j", "i"))
+    jac = F.inverse(X, ["i", "j"]).grad(X).simplify().evaluate(ts.copy())
+    expected = jacobian(torch.linalg.inv, ts[X].rename(None)).rename("b", "j", "i", "b_", "i_", "j_")
+    assert_close(jac, expected)
+
+
+def test_logdet():
+    n = symbols("n")
+    X = Variable("X", i=n, j=n)
+    ts = {X: torch.randn(3, 3, names=("i", "j")) + 3 * torch.eye(3)}
+    assert_close(F.logdet(X, ["i", "j"]).evaluate(ts.copy()), torch.linalg.slogdet(ts[X].rename(None)).logabsdet)
+    res = F.logdet(X, ["i", "j"]).grad(X).simplify().evaluate(ts.copy())
+    expected = jacobian(lambda X: torch.linalg.slogdet(X).logabsdet, ts[X].rename(None)).rename("i_", "j_")
     assert_close(res, expected)
+
+
+def test_solve():
+    n, k, b = symbols("n k b")
+    A = Variable("A", b, i=n, j=n)
+    y = Variable("y", b, k, i=n)
+    ts = {
+        A: torch.randn(4, 3, 3, names=("b", "i", "j")) + 3 * torch.eye(3),
+        y: torch.randn(4, 2, 3, names=("b", "k", "i")),
+    }
+    expr = F.solve(A, y, ["i", "j"])
+    assert expr.edges == {"b", "k", "j"}
+    res = expr.evaluate(ts.copy())
+    expected = torch.linalg.solve(ts[A].rename(None), ts[y].rename(None).transpose(1, 2))
+    assert_close(res, expected.rename("b", "j", "k"))
+
+    for x, i in [(A, 0), (y, 1)]:
+        jac = expr.grad(x).simplify().evaluate(ts.copy())
+        expected = jacobian(
+            lambda a, y: torch.linalg.solve(a, y.transpose(1, 2)),
+            (ts[A].rename(None), ts[y].rename(None)),
+        )[i]
+        assert_close(jac, expected.rename("b", "j", "k", *(e + "_" for e in x.edges)))
+
+
+def test_solve_cancel():
+    n = symbols("n")
+    A = Variable("A", i=n, j=n)
+    v = Variable("v", j=n)
+    # A @ v, with the contracted edge renamed so it doesn't clash with the output edge j
+    expr = F.solve(A, A.rename(j="k") @ v.rename(j="k"), ["i", "j"])
+    assert expr.simplify() == v
+    assert "solve" not in repr(expr.grad(v).full_simplify())
+
+
+def test_solve_cancel_contracted_batch():
+    n, m = symbols("n m")
+    A = Variable("A", m, i=n, j=n)
+    x = Variable("x", m, j=n)
+    # The edge m of A is contracted with x inside b, so b isn't A @ x for each m, and solve doesn't cancel
+    expr = F.solve(A, A.rename(j="k") @ x.rename(j="k"), ["i", "j"])
+    assert expr.edges == {"j", "m"}
+    assert "solve" in repr(expr.simplify())
+    ts = rand_values([A, x], {n: 3, m: 2})
+    ts[A] = ts[A] + 3 * torch.eye(3)
+    assert_close(expr.simplify().evaluate(ts.copy()), expr.evaluate(ts.copy()))
+
+
+def test_symmetrize_cosets():
+    n = symbols("n")
+    # Symmetric in (a, b) and in (c, d, e), so 5! / (2! 3!) = 10 distinct terms
+    T = Variable("T", a=n, b=n, c=n, d=n, e=n).with_symmetries("a b, c d e")
+    sym = F.symmetrize(T)
+    assert len(sym.tensors) == 10
+    assert set(sym.weights) == {12}
+    # A cycle of four matrices, joined by Copy tensors with one free edge each, is only cyclically symmetric
+    A = Variable("A", i=n, j=n)
+    T2 = Product([A.rename(i=f"i{k}", j=f"j{k}") @ Copy(n, f"j{k}", f"i{(k + 1) % 4}", f"e{k}") for k in range(4)])
+    assert len(T2.edges) == 4
+    sym2 = F.symmetrize(T2)
+    assert len(sym2.tensors) == 6
+    assert set(sym2.weights) == {4}
+
+    for t, s in [(T, sym), (T2, sym2)]:
+        ts = rand_values([A], {n: 3})
+        # A value of T with the declared symmetries
+        u, v = torch.randn(3), torch.randn(3)
+        ts[T] = torch.einsum("a,b,c,d,e->abcde", u, u, v, v, v).rename("a", "b", "c", "d", "e")
+        expected = sum(
+            t.rename(**dict(zip(t.edges, perm))).evaluate(ts.copy()).align_to(*t.edges)
+            for perm in itertools.permutations(t.edges)
+        )
+        assert_close(s.evaluate(ts.copy()), expected)
+
+
+def test_taylor():
+    i, j = symbols("i j")
+    A = Variable("A", i, j)
+    x = Variable("x", j)
+    eps = Variable("eps", j)
+    expr = F.taylor(F.exp(A @ x), x, eps, 3)
+    assert expr.edges == {"i"}
+    ts = rand_values([A, x, eps], {i: 2, j: 3})
+    tA, tx, te = (ts[v].rename(None) for v in [A, x, eps])
+    # The derivatives of exp(A x) in the direction eps are exp(A x) (A eps)^k
+    d = tA @ te
+    expected = torch.exp(tA @ tx) * (1 + d + d**2 / 2 + d**3 / 6)
+    assert_close(expr.evaluate(ts.copy()), expected.rename("i"))
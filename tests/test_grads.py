@@ -1,6 +1,6 @@
 import torch
 from sympy import symbols
-from tensorgrad import Variable, Function
+from tensorgrad import Variable, Function, profiling
 import tensorgrad.functions as F
 from tensorgrad.tensor import Copy, Product
 from tensorgrad.testutils import assert_close, rand_values
@@ -292,3 +292,67 @@ def test_f_2_2_double_nested():
     print(expr)
     print(expected)
     assert expr == expected
+
+
+def test_derivative_cache():
+    i = symbols("i")
+    x = Variable("x", i, j=i)
+    A = Variable("A", i, j=i)
+    # The two terms only differ in their edge names, so the second derivative is taken from the cache
+    expr = F.frobenius2(F.exp(x) @ A) + F.frobenius2(F.exp(x.rename(i="j", j="i")) @ A)
+    with profiling.profile() as prof:
+        res = expr.grad(x).simplify()
+    assert prof.rules["Derivative.cache"].fired > 0
+    uncached = expr.grad(x).simplify({"derivative_cache": None})
+    assert res == uncached
+    ts = rand_values([x, A], {i: 3})
+    assert_close(res.evaluate(ts.copy()), uncached.evaluate(ts.copy()))
+
+
+def test_higher_order_grad():
+    i = symbols("i")
+    x = Variable("x", i)
+    A = Variable("A", i, j=i)
+    ts = rand_values([x, A], {i: 3})
+    for f, order in [(F.exp(x @ A @ x.rename(i="j")), 2), (F.sum(F.exp(x) * F.pow(x, 3)), 3)]:
+        res = F.grad(f, x, order)
+        nested = f
+        for _ in range(order):
+            nested = nested.grad(x)
+        nested = nested.full_simplify()
+        assert res.edges == nested.edges
+        assert_close(res.evaluate(ts.copy()), nested.evaluate(ts.copy()), rtol=1e-3, atol=1e-3)
+
+
+def test_higher_order_grad_fraction():
+    i = symbols("i")
+    x = Variable("x", i)
+    # The weights stay exact, so the result is equal to the nested derivatives
+    t = F.pow(x @ x, 2) / 3
+    for order in [2, 3]:
+        nested = t
+        for _ in range(order):
+            nested = nested.grad(x)
+        assert F.grad(t, x, order) == nested.full_simplify()
+
+
+def test_higher_order_grad_names():
+    i = symbols("i")
+    x = Variable("x", i)
+    res = F.grad(F.frobenius2(x), x, 2, new_names=[{"i": "a"}, {"i": "b"}])
+    assert res.edges == {"a", "b"}
+    assert res == (2 * Copy(i, "a, b")).full_simplify()
+    assert F.grad(F.frobenius2(x), x) == (2 * x).full_simplify()
+
+
+def test_elementwise_chain_rule():
+    i, j = symbols("i j")
+    X = Variable("X", i, j)
+    # The chain rule of an elementwise function is a plain Hadamard product, without connection edges
+    grad = F.exp(X).grad(X)
+    assert isinstance(grad, Product)
+    assert F.exp(X).fn_info.elementwise
+    ts = rand_values([X], {i: 2, j: 3})
+    expected = torch.einsum("ij,ik,jl->ijkl", ts[X].rename(None).exp(), torch.eye(2), torch.eye(3))
+    res = grad.full_simplify().evaluate(ts.copy())
+    assert_close(res, expected.rename("i", "j", "i_", "j_"))
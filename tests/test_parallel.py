@@ -0,0 +1,30 @@
+import pickle
+from sympy import symbols
+from tensorgrad import Variable, Function
+import tensorgrad.functions as F
+from tensorgrad.testutils import assert_close, rand_values
+
+
+def test_pickle_roundtrip():
+    i, j = symbols("i j")
+    X = Variable("X", i, j)
+    y = Variable("y", j)
+    expr = F.sum(F.exp(X @ y) + F.log(F.abs(X @ y)) + F.relu(X @ y) * F.gt0(X @ y), ["i"])
+    expr = expr + F.sum(Function("f", {"k": i}, (X, "i")), ["k"])
+    hash(expr)  # Populate the hash cache
+    expr2 = pickle.loads(pickle.dumps(expr))
+    assert expr2 == expr
+    assert "weisfeiler_lehman" not in pickle.loads(pickle.dumps(expr)).__dict__
+
+
+def test_parallel_full_simplify():
+    C = symbols("C")
+    logits = Variable("logits", C)
+    target = Variable("target", C)
+    expr = F.cross_entropy(logits, target, ["C"]).grad(logits).grad(logits)
+    expected = expr.full_simplify()
+    res = expr.full_simplify(workers=2)
+    assert res == expected
+
+    ts = rand_values([logits, target], {C: 3})
+    assert_close(res.evaluate(ts.copy()), expected.evaluate(ts.copy()))
@@ -0,0 +1,62 @@
+from sympy import symbols
+from tensorgrad import Variable, Product
+import tensorgrad.functions as F
+from tensorgrad.tensor import Folded, Sum
+from tensorgrad.testutils import rand_values, assert_close
+
+
+def _count(t, cls) -> int:
+    if isinstance(t, cls):
+        return 1
+    if isinstance(t, (Product, Sum)):
+        return sum(_count(u, cls) for u in t.tensors)
+    if hasattr(t, "inputs"):
+        return sum(_count(u, cls) for u, *_ in t.inputs)
+    return 0
+
+
+def test_partial_evaluate():
+    n = symbols("n")
+    W = Variable("W", i=n, j=n)
+    b = Variable("b", i=n)
+    x = Variable("x", j=n)
+    expr = F.relu(W @ x + F.exp(b)) + F.softmax(b, "i") * (W @ W.rename(i="j", j="k") @ x.rename(j="k"))
+    ts = rand_values([W, b, x], {n: 3})
+
+    res = expr.partial_evaluate({W: ts[W], b: ts[b]})
+    assert res.edges == expr.edges
+    assert res.depends_on(x)
+    assert not res.depends_on(W) and not res.depends_on(b)
+    assert _count(res, Folded) > 0
+    assert_close(res.evaluate({x: ts[x]}), expr.evaluate(ts))
+
+
+def test_partial_evaluate_product():
+    # The fixed matrices are contracted with each other, so they fold into a single matrix
+    i, j, k, l = symbols("i j k l")
+    A = Variable("A", i, j)
+    B = Variable("B", j, k)
+    C = Variable("C", k, l)
+    x = Variable("x", l)
+    expr = A @ B @ C @ x
+    ts = rand_values([A, B, C, x], {i: 2, j: 3, k: 4, l: 5})
+
+    res = expr.partial_evaluate({A: ts[A], B: ts[B], C: ts[C]})
+    assert _count(res, Folded) == 1
+    assert_close(res.evaluate({x: ts[x]}), expr.evaluate(ts))
+
+    # Folded tensors can be renamed like other tensors
+    renamed = res.rename(i="a")
+    assert_close(renamed.evaluate({x: ts[x]}), expr.evaluate(ts).rename(i="a"))
+
+
+def test_partial_evaluate_nothing_fixed():
+    i = symbols("i")
+    x = Variable("x", i)
+    y = Variable("y", i)
+    expr = F.exp(x) * y
+    assert expr.partial_evaluate({}) is expr
+    ts = rand_values([x, y], {i: 3})
+    res = expr.partial_evaluate(ts)
+    assert isinstance(res, Folded)
+    assert_close(res.evaluate({}), expr.evaluate(ts))
@@ -1,5 +1,5 @@
 from sympy import symbols
-from tensorgrad import Variable, Product
+from tensorgrad import Variable, Product, Copy, Sum, Zero
 
 
 def test_components():
@@ -7,3 +7,18 @@ def test_components():
     V = Variable("V", i)
     t = Product([V, V])
     assert t.components() == [t]
+
+
+def test_grad_skips_independent_factors():
+    i = symbols("i")
+    x = Variable("x", i)
+    A = Variable("A", i, j=i)
+    B = Variable("B", j=i, k=i)
+    prod = Product([A, B, Copy(i, "k, l"), x.rename(i="l")])
+    res = prod.grad(x)
+    # Only the factor depending on x gets a term
+    assert isinstance(res, Sum) and len(res.tensors) == 1
+    assert res.edges == {"i", "i_"}
+    assert res.full_simplify() == Product([A, B.rename(k="i_")]).full_simplify()
+    zero = Product([A, B]).grad(x)
+    assert isinstance(zero, Zero) and zero.edges == {"i", "k", "i_"}
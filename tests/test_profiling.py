@@ -0,0 +1,31 @@
+from sympy import symbols
+from tensorgrad import Variable
+import tensorgrad.functions as F
+from tensorgrad.profiling import profile, node_count
+
+
+def test_profile_simplify():
+    C = symbols("C")
+    logits = Variable("logits", C)
+    target = Variable("target", C)
+    expr = F.cross_entropy(logits, target, ["C"]).grad(logits)
+    with profile() as prof:
+        res = expr.full_simplify()
+    report = prof.report()
+    assert report["rules"]["hashing"]["calls"] > 0
+    assert report["rules"]["Copy.simplify_outer"]["calls"] > 0
+    assert report["rules"]["Copy._merge_copy_tensors"]["fired"] > 0
+    assert report["rules"]["PowFunctionInfo._combine_powers"]["calls"] > 0
+    assert prof.rounds[0].nodes_before == node_count(expr)
+    assert prof.rounds[-1].nodes_after == node_count(res)
+    assert "hashing" in str(prof)
+
+
+def test_profile_inactive():
+    i = symbols("i")
+    x = Variable("x", i)
+    with profile() as prof:
+        pass
+    (x + x).full_simplify()
+    assert not prof.rules
+    assert not prof.rounds
@@ -0,0 +1,83 @@
+import torch
+from torch.autograd.functional import jacobian
+from sympy import symbols
+from tensorgrad import Variable
+import tensorgrad.functions as F
+from tensorgrad.extras import Scan
+from tensorgrad.testutils import assert_close, rand_values
+
+
+def rnn_setup(activation=F.tanh):
+    d, hd, T = symbols("d hd T")
+    x = Variable("x", d)
+    h = Variable("h", hd)
+    W_ih = Variable("W_ih", d, o=hd)
+    W_hh = Variable("W_hh", hd, o=hd)
+    xs = Variable("xs", d, T)
+    h0 = Variable("h0", hd)
+    step = activation(W_ih @ x + W_hh @ h).rename(o="hd")
+    rnn = Scan([(h, step, h0)], [(x, xs)], "T")
+    ts = rand_values([xs, h0, W_ih, W_hh], {d: 3, hd: 4, T: 5})
+
+    def loop(xs, h0, W_ih, W_hh):
+        h = h0
+        for t in range(xs.shape[1]):
+            h = xs[:, t] @ W_ih + h @ W_hh
+            h = torch.tanh(h) if activation is F.tanh else h
+        return h
+
+    variables = [xs, h0, W_ih, W_hh]
+    return rnn, variables, ts, loop
+
+
+def test_scan_evaluate():
+    rnn, variables, ts, loop = rnn_setup()
+    assert rnn.edges == {"hd"}
+    expected = loop(*(ts[v].rename(None) for v in variables))
+    assert_close(rnn.evaluate(ts.copy()), expected.rename("hd"))
+    # Renaming the output
+    assert_close(rnn.rename(hd="k").evaluate(ts.copy()), expected.rename("k"))
+
+
+def test_scan_grad():
+    rnn, variables, ts, loop = rnn_setup()
+    expected = jacobian(loop, tuple(ts[v].rename(None) for v in variables))
+    for v, jac in zip(variables, expected):
+        grad = rnn.grad(v)
+        # The derivative is a scan too, so the expression doesn't grow with the sequence length
+        assert isinstance(grad, Scan)
+        res = grad.full_simplify().evaluate(ts.copy())
+        assert_close(res, jac.rename("hd", *(e + "_" for e in v.edges)))
+
+
+def test_scan_hessian():
+    rnn, variables, ts, loop = rnn_setup(activation=lambda t: t)
+    xs, h0, W_ih, W_hh = variables
+    loss = F.frobenius2(rnn)
+    hess = loss.grad(W_hh).grad(h0).full_simplify().evaluate(ts.copy())
+    expected = torch.autograd.functional.hessian(
+        lambda h0, W_hh: loop(ts[xs].rename(None), h0, ts[W_ih].rename(None), W_hh).pow(2).sum(),
+        (ts[h0].rename(None), ts[W_hh].rename(None)),
+    )[1][0]
+    assert_close(hess, expected.rename("hd_", "o_", "hd__"))
+
+
+def test_scan_multiple_carries():
+    # A running sum and product of the sequence
+    i, T = symbols("i T")
+    x = Variable("x", i)
+    s = Variable("s", i)
+    p = Variable("p", i)
+    xs = Variable("xs", i, T)
+    a = Variable("a", i)
+    carries = [(s, s + x, a), (p, p * x * a, a)]
+    total = Scan(carries, [(x, xs)], "T", output=0)
+    prod = Scan(carries, [(x, xs)], "T", output=1)
+    ts = rand_values([xs, a], {i: 2, T: 4})
+    txs, ta = ts[xs].rename(None), ts[a].rename(None)
+    assert_close(total.evaluate(ts.copy()), (ta + txs.sum(1)).rename("i"))
+    assert_close(prod.evaluate(ts.copy()), (ta**5 * txs.prod(1)).rename("i"))
+    # The derivative of the product carry wrt a depends on the product carry itself
+    res = prod.grad(a).full_simplify().evaluate(ts.copy())
+    assert_close(res, torch.diag(5 * ta**4 * txs.prod(1)).rename("i", "i_"))
+    assert total != prod
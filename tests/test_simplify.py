@@ -1,6 +1,9 @@
 import pytest
 from sympy import symbols
-from tensorgrad.tensor import Copy, Product, Sum, Variable
+from tensorgrad import tensor
+from tensorgrad.tensor import Copy, Derivative, Product, Sum, Variable
+import tensorgrad.functions as F
+from tensorgrad.testutils import assert_close, rand_values
 
 
 def test_copy_loop():
@@ -58,3 +61,44 @@ def test_expand():
     expr = expr.simplify({"expand": True})
     assert isinstance(expr, Sum)
     assert expr == Sum([Product([Copy(j, "j"), X, a]), Product([Copy(i, "i"), X, b])])
+
+
+def test_simplify_steps():
+    i = symbols("i")
+    x = Variable("x", i)
+    A = Variable("A", i, j=i)
+    expr = F.frobenius2(F.exp(A @ x)).grad(x).grad(x)
+    steps = list(expr.simplify_steps())
+    assert steps[0] is expr
+    # Each form is yielded once, and the last one is the fully simplified tensor
+    assert all(a != b for a, b in zip(steps, steps[1:]))
+    assert len(steps) > 2
+    assert steps[-1] == expr.full_simplify()
+    ts = rand_values([x, A], {i: 3})
+    assert_close(steps[-1].evaluate(ts.copy()), expr.full_simplify().evaluate(ts.copy()))
+
+
+def test_simplify_steps_memo(monkeypatch):
+    # Sub-expressions that are already simplified are only simplified once over all the steps
+    i = symbols("i")
+    x = Variable("x", i)
+    y = Variable("y", i)
+    expr = F.exp(x @ y) * Derivative(Derivative(F.exp(x) @ y, x), x)
+    calls = 0
+    original = Variable.simplify
+
+    def counting_simplify(self, args=None):
+        nonlocal calls
+        calls += 1
+        return original(self, args)
+
+    monkeypatch.setattr(Variable, "simplify", counting_simplify)
+    steps = list(expr.simplify_steps())
+    memo_calls, calls = calls, 0
+    # The same steps without the memo
+    monkeypatch.setattr(tensor, "_SimplifyMemo", lambda: None)
+    baseline = list(expr.simplify_steps())
+    assert len(steps) == len(baseline) > 3
+    assert all(a == b for a, b in zip(steps, baseline))
+    # Without the memo, the variables are simplified again in every step
+    assert memo_calls * 2 < calls
@@ -0,0 +1,51 @@
+import pytest
+import torch
+from sympy import symbols
+from tensorgrad import Variable, Derivative
+import tensorgrad.functions as F
+from tensorgrad.tensor import Sum
+from tensorgrad.testutils import rand_values, assert_close
+
+
+def test_substitute():
+    n = symbols("n")
+    A = Variable("A", i=n, j=n)
+    B = Variable("B", i=n, j=n)
+    x = Variable("x", j=n)
+    y = Variable("y", i=n)
+    # x occurs both as is, and renamed
+    expr = A @ x + F.exp(y) * (B @ x) + A.rename(i="k") @ x.rename(j="i")
+    res = expr.substitute({x: A.rename(i="k") @ y.rename(i="k")})
+    assert res.edges == expr.edges
+    assert not res.depends_on(x)
+
+    ts = rand_values([A, B, y], {n: 3})
+    ts[x] = (ts[A].rename(None).T @ ts[y].rename(None)).rename("j")
+    assert_close(res.evaluate(ts.copy()), expr.evaluate(ts.copy()))
+
+
+def test_substitute_sharing():
+    i = symbols("i")
+    x = Variable("x", i)
+    y = Variable("y", i)
+    untouched = F.softmax(y, ["i"])
+    shared = F.exp(x)
+    expr = Sum([untouched, shared, shared], [1, 2, 3])
+    hash(untouched)
+    res = expr.substitute({x: 2 * y})
+    # Untouched sub-expressions are reused, with their cached properties
+    assert res.tensors[0] is untouched
+    assert "weisfeiler_lehman" in untouched.__dict__
+    # Shared sub-expressions stay shared
+    assert res.tensors[1] is res.tensors[2]
+    assert expr.substitute({}) is expr
+
+
+def test_substitute_errors():
+    i, j = symbols("i j")
+    x = Variable("x", i)
+    A = Variable("A", i, j)
+    with pytest.raises(ValueError):
+        F.exp(x).substitute({x: A})
+    with pytest.raises(ValueError):
+        Derivative(F.exp(x), x).substitute({x: A @ Variable("z", j)})
@@ -2,6 +2,7 @@ import pytest
 import networkx as nx
 from sympy import symbols
 from tensorgrad import Variable, Copy, Product, Zero
+import tensorgrad.functions as F
 
 
 def test_variable_initialization():
@@ -78,3 +79,22 @@ def test_transpose_grad():
     Xt = X.rename(i="j", j="i")
     assert X == Xt
     assert (X + Xt).simplify() == (2 * X).simplify()
+
+
+def test_depends_on():
+    i, j = symbols("i j")
+    x = Variable("x", i, j)
+    y = Variable("y", i, j)
+    expr = F.exp(x.rename(i="k")) @ Copy(j, "j")
+    assert expr.depends_on(x)
+    assert not expr.depends_on(y)
+    assert expr.dependencies == {x.key}
+    assert not Product([Copy(i, "i"), Zero(j)]).dependencies
+    # Keys don't change when renaming, but do depend on the sizes and symmetries
+    assert x.key == x.rename(i="a", j="b").key
+    assert x.key != Variable("x", i, j=i).key
+    s = Variable("s", i, j=i)
+    assert s.key != s.with_symmetries("i j").key
+    # Independent terms are dropped by grad
+    assert (x + y).grad(x).dependencies == {x.key}
+    assert (x + F.exp(y)).grad(y).dependencies == {y.key}